@@ -1,158 +1,622 @@
+-- The per-point display range functions have been replaced by
+-- update_display_ranges.
+DROP FUNCTION IF EXISTS update_depth_display_ranges(INTEGER);
+DROP FUNCTION IF EXISTS update_position_display_ranges(INTEGER);
+-- update_display_ranges got a table suffix argument.
+DROP FUNCTION IF EXISTS update_display_ranges(INTEGER);
+DROP FUNCTION IF EXISTS get_min_depth_id(DOUBLE PRECISION,
+                                         DOUBLE PRECISION,
+                                         INTEGER);
+DROP FUNCTION IF EXISTS get_positions_in_area(DOUBLE PRECISION,
+                                              DOUBLE PRECISION,
+                                              INTEGER);
 
+
+-- Compute the display ranges of the depth and position rows of a
+-- trip in one pass. The ranges of the positions are copied to their
+-- position_sample rows.
+--
+-- The positions of the trip are bucketed into a latitude/longitude
+-- grid for each range in display_ranges. In every grid cell, the
+-- smallest depth and the first position of the trip are picked as
+-- the representatives of the cell. The display_range of a row
+-- becomes the largest range at which it was picked, or 0 if it was
+-- never picked. Depth measurements marked as erroneous are not
+-- considered as representatives.
+--
+-- The rows are read from and written to the tables position,
+-- depth and position_sample with the name suffix suffix_: by default
+-- the partitions of the trip, or the staging tables of a reload.
 CREATE OR REPLACE FUNCTION
-update_depth_display_ranges(trip_id_ INTEGER)
+update_display_ranges(trip_id_ INTEGER, suffix_ TEXT DEFAULT NULL)
 RETURNS void AS $$
 DECLARE
-    prev_lat DOUBLE PRECISION;
-    prev_lon DOUBLE PRECISION;
-    min_depth_id INTEGER;
-    range RECORD;
-    pos RECORD;
+    suffix TEXT := COALESCE(suffix_, trip_partition(trip_id_));
 BEGIN
-    FOR range IN SELECT * FROM display_ranges ORDER BY range
-    LOOP
-        prev_lat := NULL;
-        prev_lon := NULL;
-
-        FOR pos IN SELECT id, latitude, longitude
-                       FROM position
-                       WHERE trip_id = trip_id_
-                       ORDER BY id
-        LOOP
-            IF prev_lat IS NOT NULL AND
-               pos.latitude < prev_lat + range.lat_range AND
-               pos.latitude > prev_lat - range.lat_range AND
-               pos.longitude < prev_lon + range.lon_range AND
-               pos.longitude > prev_lon - range.lon_range THEN
-                   -- If the current position is within the bounds
-                   -- of the coordinate range of the previous
-                   -- point, continue to the next point.
-                   CONTINUE;
-            END IF;
-
-            min_depth_id := get_min_depth_id(pos.latitude,
-                                             pos.longitude,
-                                             range.range);
-
-            -- Note, this does an update to all depth
-            -- data within the area.
-            UPDATE depth
-                SET display_range = range.range
-                WHERE id = min_depth_id;
-
-            prev_lat := pos.latitude;
-            prev_lon := pos.longitude;
-        END LOOP;
-    END LOOP;
+    EXECUTE format($q$
+    WITH cells AS (
+        SELECT p.id AS position_id,
+               d.id AS depth_id,
+               r.range AS range,
+               row_number() OVER (PARTITION BY r.range,
+                                  floor(p.latitude / r.lat_range),
+                                  floor(p.longitude / r.lon_range)
+                                  ORDER BY p.id, d.id) AS pos_rank,
+               row_number() OVER (PARTITION BY r.range,
+                                  floor(p.latitude / r.lat_range),
+                                  floor(p.longitude / r.lon_range),
+                                  d.id IS NULL OR d.erroneous
+                                  ORDER BY d.depth, d.id) AS depth_rank,
+               d.id IS NOT NULL AND NOT d.erroneous AS depth_ok
+        FROM %1$I p
+        LEFT JOIN %2$I d ON p.id = d.position_id AND d.trip_id = $1
+        CROSS JOIN display_ranges r
+        WHERE p.trip_id = $1),
+    depth_ranges AS (
+        SELECT depth_id,
+               MAX(CASE WHEN depth_ok AND depth_rank = 1
+                        THEN range ELSE 0 END) AS range
+        FROM cells
+        WHERE depth_id IS NOT NULL
+        GROUP BY depth_id),
+    position_ranges AS (
+        SELECT position_id,
+               MAX(CASE WHEN pos_rank = 1
+                        THEN range ELSE 0 END) AS range
+        FROM cells
+        GROUP BY position_id),
+    depth_update AS (
+        UPDATE %2$I AS dt
+            SET display_range = dr.range
+            FROM depth_ranges dr
+            WHERE dt.id = dr.depth_id
+            AND dt.trip_id = $1
+            AND dt.display_range <> dr.range),
+    sample_update AS (
+        UPDATE %3$I AS st
+            SET display_range = pr.range
+            FROM position_ranges pr
+            WHERE st.position_id = pr.position_id
+            AND st.trip_id = $1
+            AND st.display_range <> pr.range)
+    UPDATE %1$I AS pt
+        SET display_range = pr.range
+        FROM position_ranges pr
+        WHERE pt.id = pr.position_id
+        AND pt.trip_id = $1
+        AND pt.display_range <> pr.range
+    $q$, 'position' || suffix, 'depth' || suffix,
+         'position_sample' || suffix)
+        USING trip_id_;
 END;
 $$
 LANGUAGE plpgsql;
 
+-- Recompute the display ranges of a trip incrementally after the
+-- positions in position_ids_ have been added or their depth
+-- measurements have changed.
+--
+-- Only the grid cells that contain one of the changed positions are
+-- affected. The rows of the trip that lie in those cells are ranked
+-- again (against the other rows of their cells at every range), and
+-- only their display_range values are written. The result is the
+-- same as running update_display_ranges for the whole trip.
 CREATE OR REPLACE FUNCTION
-update_position_display_ranges(trip_id_ INTEGER)
+update_display_ranges_near(trip_id_ INTEGER, position_ids_ INTEGER[])
+RETURNS void AS $$
+    WITH margin AS (
+        -- Rows further away than two of the largest cells from
+        -- the changed positions cannot be affected.
+        SELECT 2.0 * MAX(lat_range) AS lat_margin,
+               2.0 * MAX(lon_range) AS lon_margin
+        FROM display_ranges),
+    area AS (
+        SELECT MIN(p.latitude) - m.lat_margin AS lat0,
+               MAX(p.latitude) + m.lat_margin AS lat1,
+               MIN(p.longitude) - m.lon_margin AS lon0,
+               MAX(p.longitude) + m.lon_margin AS lon1
+        FROM position p, margin m
+        WHERE p.id = ANY ($2)
+        GROUP BY m.lat_margin, m.lon_margin),
+    trip_cells AS (
+        SELECT p.id AS position_id,
+               r.range AS range,
+               floor(p.latitude / r.lat_range) AS cell_lat,
+               floor(p.longitude / r.lon_range) AS cell_lon
+        FROM position p
+        JOIN area a
+        ON p.latitude BETWEEN a.lat0 AND a.lat1
+        AND p.longitude BETWEEN a.lon0 AND a.lon1
+        CROSS JOIN display_ranges r
+        WHERE p.trip_id = $1),
+    changed_cells AS (
+        SELECT DISTINCT range, cell_lat, cell_lon
+        FROM trip_cells
+        WHERE position_id = ANY ($2)),
+    candidates AS (
+        SELECT DISTINCT tc.position_id
+        FROM trip_cells tc
+        JOIN changed_cells USING (range, cell_lat, cell_lon)),
+    candidate_cells AS (
+        SELECT DISTINCT tc.range, tc.cell_lat, tc.cell_lon
+        FROM trip_cells tc
+        JOIN candidates USING (position_id)),
+    cells AS (
+        SELECT tc.position_id AS position_id,
+               d.id AS depth_id,
+               tc.range AS range,
+               row_number() OVER (PARTITION BY tc.range,
+                                  tc.cell_lat,
+                                  tc.cell_lon
+                                  ORDER BY tc.position_id, d.id)
+                   AS pos_rank,
+               row_number() OVER (PARTITION BY tc.range,
+                                  tc.cell_lat,
+                                  tc.cell_lon,
+                                  d.id IS NULL OR d.erroneous
+                                  ORDER BY d.depth, d.id) AS depth_rank,
+               d.id IS NOT NULL AND NOT d.erroneous AS depth_ok
+        FROM trip_cells tc
+        JOIN candidate_cells USING (range, cell_lat, cell_lon)
+        LEFT JOIN depth d ON tc.position_id = d.position_id
+                          AND d.trip_id = $1),
+    depth_ranges AS (
+        SELECT depth_id,
+               MAX(CASE WHEN depth_ok AND depth_rank = 1
+                        THEN range ELSE 0 END) AS range
+        FROM cells
+        JOIN candidates USING (position_id)
+        WHERE depth_id IS NOT NULL
+        GROUP BY depth_id),
+    position_ranges AS (
+        SELECT position_id,
+               MAX(CASE WHEN pos_rank = 1
+                        THEN range ELSE 0 END) AS range
+        FROM cells
+        JOIN candidates USING (position_id)
+        GROUP BY position_id),
+    depth_update AS (
+        UPDATE depth
+            SET display_range = dr.range
+            FROM depth_ranges dr
+            WHERE depth.id = dr.depth_id
+            AND depth.trip_id = $1
+            AND depth.display_range <> dr.range),
+    sample_update AS (
+        UPDATE position_sample
+            SET display_range = pr.range
+            FROM position_ranges pr
+            WHERE position_sample.position_id = pr.position_id
+            AND position_sample.trip_id = $1
+            AND position_sample.display_range <> pr.range)
+    UPDATE position
+        SET display_range = pr.range
+        FROM position_ranges pr
+        WHERE position.id = pr.position_id
+        AND position.trip_id = $1
+        AND position.display_range <> pr.range;
+$$
+LANGUAGE SQL;
+
+-- Number of trips in one partition of the trip data tables.
+CREATE OR REPLACE FUNCTION trip_partition_size()
+RETURNS INTEGER AS $$
+    SELECT 100;
+$$
+LANGUAGE SQL IMMUTABLE;
+
+-- Return the number of the partition of a trip.
+CREATE OR REPLACE FUNCTION trip_partition_number(trip_id_ INTEGER)
+RETURNS INTEGER AS $$
+    SELECT $1 / trip_partition_size();
+$$
+LANGUAGE SQL IMMUTABLE;
+
+-- Create position_sample_time_idx on the position_sample partition with
+-- the table suffix suffix_ unless it exists.
+CREATE OR REPLACE FUNCTION position_sample_time_index(suffix_ TEXT)
 RETURNS void AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_class
+                   WHERE relname = 'position_sample' || suffix_ ||
+                                   '_time_idx')
+    THEN
+        EXECUTE format('CREATE INDEX %I ON %I (trip_id, pos_time_utc)',
+                       'position_sample' || suffix_ || '_time_idx',
+                       'position_sample' || suffix_);
+    END IF;
+END;
+$$
+LANGUAGE plpgsql;
+
+-- Create the partitions of position, depth and position_sample for a
+-- trip unless they exist. Returns the suffix of the partition tables,
+-- such as '_t0001'.
+--
+-- A transaction that creates partitions holds a lock on the partition
+-- number until it ends, so that concurrent loaders do not try to
+-- create the same tables.
+CREATE OR REPLACE FUNCTION trip_partition(trip_id_ INTEGER)
+RETURNS TEXT AS $$
 DECLARE
-    prev_lat DOUBLE PRECISION;
-    prev_lon DOUBLE PRECISION;
-    pos RECORD;
-    range RECORD;
+    part INTEGER := trip_partition_number(trip_id_);
+    suffix TEXT := '_t' || lpad(part::TEXT, 4, '0');
+    trip_check TEXT;
 BEGIN
-    FOR range IN SELECT * FROM display_ranges ORDER BY range DESC
-    LOOP
-        prev_lat := NULL;
-        prev_lon := NULL;
-
-        FOR pos IN SELECT id, latitude, longitude, display_range
-                       FROM position
-                       WHERE trip_id = trip_id_
-                       ORDER BY id
-        LOOP
-            -- 1. First pos of the trip: unconditionally put range to max
-            --    if it has no previous display_range
-            -- 2. If pos is farther from the previous marked one than
-            --    the display_range.*_range suggest and has no previous
-            --    display_range, set it to current.
-
-            IF (prev_lat IS NULL AND pos.display_range < range.range) OR
-                ((pos.latitude > prev_lat + range.lat_range OR
-                  pos.latitude < prev_lat - range.lat_range OR
-                  pos.longitude > prev_lon + range.lon_range OR
-                  pos.longitude < prev_lon - range.lon_range) AND
-                 pos.display_range < range.range) THEN
-
-                UPDATE position SET display_range = range.range
-                    WHERE id = pos.id;
-
-                prev_lat := pos.latitude;
-                prev_lon := pos.longitude;
-            END IF;
-        END LOOP;
-   END LOOP;
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'position' || suffix)
+    THEN
+        RETURN suffix;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(hashtext('trip_partition'), part);
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'position' || suffix)
+    THEN
+        RETURN suffix;
+    END IF;
+
+    trip_check := format('CHECK (trip_id >= %s AND trip_id < %s)',
+                         part * trip_partition_size(),
+                         (part + 1) * trip_partition_size());
+
+    EXECUTE format('CREATE TABLE %I (PRIMARY KEY (id), %s, '
+                   'FOREIGN KEY (trip_id) REFERENCES trip (id) '
+                   'ON DELETE CASCADE) INHERITS (position)',
+                   'position' || suffix, trip_check);
+    EXECUTE format('CREATE INDEX %I ON %I (trip_id)',
+                   'position' || suffix || '_trip_id_idx',
+                   'position' || suffix);
+    EXECUTE format('CREATE INDEX %I ON %I '
+                   'USING gist (point(longitude, latitude))',
+                   'position' || suffix || '_point_idx',
+                   'position' || suffix);
+
+    EXECUTE format('CREATE TABLE %I (PRIMARY KEY (id), %s, '
+                   'FOREIGN KEY (trip_id) REFERENCES trip (id) '
+                   'ON DELETE CASCADE) INHERITS (depth)',
+                   'depth' || suffix, trip_check);
+    EXECUTE format('CREATE INDEX %I ON %I (position_id)',
+                   'depth' || suffix || '_pos_id_idx',
+                   'depth' || suffix);
+    EXECUTE format('CREATE INDEX %I ON %I (display_range, position_id)',
+                   'depth' || suffix || '_display_range_idx',
+                   'depth' || suffix);
+    EXECUTE format('CREATE INDEX %I ON %I (trip_id)',
+                   'depth' || suffix || '_trip_id_idx',
+                   'depth' || suffix);
+
+    EXECUTE format('CREATE TABLE %I (PRIMARY KEY (position_id), %s, '
+                   'FOREIGN KEY (trip_id) REFERENCES trip (id) '
+                   'ON DELETE CASCADE) INHERITS (position_sample)',
+                   'position_sample' || suffix, trip_check);
+    EXECUTE format('CREATE INDEX %I ON %I (trip_id, display_range)',
+                   'position_sample' || suffix || '_trip_idx',
+                   'position_sample' || suffix);
+    EXECUTE format('CREATE INDEX %I ON %I '
+                   'USING gist (point(longitude, latitude))',
+                   'position_sample' || suffix || '_point_idx',
+                   'position_sample' || suffix);
+    PERFORM position_sample_time_index(suffix);
+
+    RETURN suffix;
 END;
 $$
 LANGUAGE plpgsql;
 
--- Return the display range closest to the meters/pixel value
--- provided by the client.
-CREATE OR REPLACE FUNCTION
-get_display_range(meters_per_pixel DOUBLE PRECISION)
-RETURNS INTEGER
-AS $$
-    SELECT COALESCE(MAX(range), 0)
-        FROM display_ranges
-        WHERE range < $1;
+-- Move the rows of a trip that are still in the parent tables, from
+-- before the partitioning, to the partitions of the trip.
+CREATE OR REPLACE FUNCTION move_trip_to_partition(trip_id_ INTEGER)
+RETURNS void AS $$
+DECLARE
+    suffix TEXT := trip_partition(trip_id_);
+BEGIN
+    EXECUTE format('INSERT INTO %I '
+                   '(id, position_id, depth, display_range, erroneous, '
+                   ' trip_id) '
+                   'SELECT d.id, d.position_id, d.depth, d.display_range, '
+                   '       d.erroneous, p.trip_id '
+                   'FROM ONLY depth d '
+                   'JOIN ONLY position p ON p.id = d.position_id '
+                   'WHERE p.trip_id = $1',
+                   'depth' || suffix)
+        USING trip_id_;
+    DELETE FROM ONLY depth d
+        USING ONLY position p
+        WHERE p.id = d.position_id
+        AND p.trip_id = trip_id_;
+
+    EXECUTE format('INSERT INTO %I '
+                   'SELECT * FROM ONLY position_sample WHERE trip_id = $1',
+                   'position_sample' || suffix)
+        USING trip_id_;
+    DELETE FROM ONLY position_sample WHERE trip_id = trip_id_;
+
+    EXECUTE format('INSERT INTO %I '
+                   'SELECT * FROM ONLY position WHERE trip_id = $1',
+                   'position' || suffix)
+        USING trip_id_;
+    DELETE FROM ONLY position WHERE trip_id = trip_id_;
+END;
 $$
-LANGUAGE SQL;
+LANGUAGE plpgsql;
 
+-- Record a change in the data of a trip, or in the trip list: the
+-- version of the trip and the global generation are incremented.
+-- The HTTP validators of the API are derived from them, so this must
+-- be called in every transaction that changes trip data. The times
+-- are those of the call, not of the start of the transaction, so
+-- that they are never earlier than a response to an earlier state.
+CREATE OR REPLACE FUNCTION bump_data_version(trip_id_ INTEGER)
+RETURNS void AS $$
+    UPDATE trip
+        SET data_version = data_version + 1,
+            data_modified = clock_timestamp()
+        WHERE id = $1;
+    UPDATE data_generation
+        SET generation = generation + 1,
+            modified = clock_timestamp();
+$$
+LANGUAGE SQL;
 
--- Select position IDs that are within an area defined by
--- center_latitude, center_longitude, and display_range, which refers
--- to the display_ranges table.
+-- The times of the positions of a trip with their dates counted as
+-- the loader counts them (TripClock in nmea_parser.py), in id order.
+-- The positions are taken in runs that start where the stored date
+-- goes up: the first position and those appended with a later date.
+-- A run starts on its stored date. A day is added whenever the time
+-- of day goes back by more than half a day from the previous
+-- position, and taken away for a late fix from before midnight: a
+-- position in the last 600 seconds of a day after one in the first
+-- 600 seconds. Returns (id, pos_time_utc) of all the positions.
 CREATE OR REPLACE FUNCTION
-get_positions_in_area(center_latitude DOUBLE PRECISION,
-                      center_longitude DOUBLE PRECISION,
-                      display_range INTEGER)
-RETURNS SETOF integer AS $$
+trip_rollover_times(trip_id_ INTEGER)
+RETURNS TABLE (id INTEGER, pos_time_utc TIMESTAMP WITHOUT TIME ZONE) AS $$
+    SELECT r.id,
+           first_value(r.stored_date)
+               OVER (PARTITION BY r.run ORDER BY r.id) +
+           SUM(r.step) OVER (PARTITION BY r.run ORDER BY r.id)::INTEGER +
+           r.time_of_day
+    FROM (SELECT s.id, s.stored_date, s.time_of_day,
+                 SUM(CASE WHEN s.stored_date > s.previous_date THEN 1
+                          ELSE 0 END) OVER (ORDER BY s.id) AS run,
+                 CASE WHEN s.stored_date > s.previous_date THEN 0
+                      WHEN s.previous - s.seconds > 43200 THEN 1
+                      WHEN s.previous < 600 AND s.seconds >= 86400 - 600
+                      THEN -1
+                      ELSE 0 END AS step
+          FROM (SELECT id,
+                       pos_time_utc::DATE AS stored_date,
+                       pos_time_utc::TIME AS time_of_day,
+                       extract(epoch FROM pos_time_utc::TIME) AS seconds,
+                       lag(pos_time_utc::DATE)
+                           OVER (ORDER BY id) AS previous_date,
+                       extract(epoch FROM lag(pos_time_utc::TIME)
+                                          OVER (ORDER BY id)) AS previous
+                FROM position
+                WHERE trip_id = $1) s) r;
+$$
+LANGUAGE SQL STABLE;
+
+-- Fix the dates of the positions of a trip loaded before the loader
+-- counted the days: the positions after midnight were dated on the
+-- day the trip started. Returns the number of positions changed. The
+-- summary and the data version of the trip must be updated after it.
+CREATE OR REPLACE FUNCTION fix_day_rollover(trip_id_ INTEGER)
+RETURNS INTEGER AS $$
 DECLARE
-   lat_diff DOUBLE PRECISION;
-   lon_diff DOUBLE PRECISION;
+    changed INTEGER;
 BEGIN
-   SELECT lat_range/2.0, lon_range/2.0
-          INTO lat_diff, lon_diff
-          FROM display_ranges
-          WHERE range = display_range;
+    UPDATE position p
+        SET pos_time_utc = t.pos_time_utc
+        FROM trip_rollover_times(trip_id_) t
+        WHERE p.id = t.id
+        AND p.trip_id = trip_id_
+        AND p.pos_time_utc <> t.pos_time_utc;
+    GET DIAGNOSTICS changed = ROW_COUNT;
 
-    IF NOT FOUND THEN
-        RAISE EXCEPTION 'Bad depth range %', display_range;
-    END IF;
+    UPDATE position_sample s
+        SET pos_time_utc = p.pos_time_utc
+        FROM position p
+        WHERE p.id = s.position_id
+        AND p.trip_id = trip_id_
+        AND s.trip_id = trip_id_
+        AND s.pos_time_utc <> p.pos_time_utc;
 
-    RETURN QUERY SELECT id FROM position
-           WHERE latitude >= (center_latitude - lat_diff)
-           AND latitude <= (center_latitude + lat_diff)
-           AND longitude >=  (center_longitude - lon_diff)
-           AND longitude <= (center_longitude + lon_diff);
+    RETURN changed;
 END;
 $$
 LANGUAGE plpgsql;
 
+-- Recompute the trip_summary row of a trip from its positions and
+-- depths.
+CREATE OR REPLACE FUNCTION
+update_trip_summary(trip_id_ INTEGER)
+RETURNS void AS $$
+    DELETE FROM trip_summary WHERE trip_id = $1;
+    INSERT INTO trip_summary
+        (trip_id, lat0, lat1, lon0, lon1, start_time, end_time,
+         position_count, depth_count, min_depth, max_depth)
+    SELECT $1, p.lat0, p.lat1, p.lon0, p.lon1, p.start_time, p.end_time,
+           p.position_count, d.depth_count, d.min_depth, d.max_depth
+    FROM (SELECT MIN(latitude) AS lat0,
+                 MAX(latitude) AS lat1,
+                 MIN(longitude) AS lon0,
+                 MAX(longitude) AS lon1,
+                 MIN(pos_time_utc) AS start_time,
+                 MAX(pos_time_utc) AS end_time,
+                 COUNT(*) AS position_count
+          FROM position
+          WHERE trip_id = $1) p,
+         (SELECT COUNT(*) AS depth_count,
+                 MIN(d.depth) AS min_depth,
+                 MAX(d.depth) AS max_depth
+          FROM position p
+          JOIN depth d ON p.id = d.position_id AND d.trip_id = $1
+          WHERE p.trip_id = $1) d;
+$$
+LANGUAGE SQL;
+
+-- Changes to depth_grid are made by one transaction at a time, so
+-- that concurrent loaders do not both insert the same new cell.
+CREATE OR REPLACE FUNCTION depth_grid_lock()
+RETURNS void AS $$
+    SELECT pg_advisory_xact_lock(hashtext('depth_grid'));
+$$
+LANGUAGE SQL;
+
+-- Add the valid depths of a newly loaded trip to depth_grid. The
+-- depths are merged into the cells that already hold depths of other
+-- trips.
+CREATE OR REPLACE FUNCTION depth_grid_add(trip_id_ INTEGER)
+RETURNS void AS $$
+    SELECT depth_grid_lock();
+    WITH trip_cells AS (
+        SELECT r.range AS display_range,
+               floor(p.latitude / r.lat_range)::INTEGER AS cell_lat,
+               floor(p.longitude / r.lon_range)::INTEGER AS cell_lon,
+               MIN(d.depth) AS min_depth,
+               SUM(d.depth) AS depth_sum,
+               COUNT(*) AS depth_count
+        FROM position p
+        JOIN depth d ON p.id = d.position_id AND d.trip_id = $1
+        CROSS JOIN display_ranges r
+        WHERE p.trip_id = $1
+        AND p.latitude IS NOT NULL
+        AND p.longitude IS NOT NULL
+        AND NOT d.erroneous
+        GROUP BY 1, 2, 3),
+    merged AS (
+        UPDATE depth_grid g
+            SET min_depth = LEAST(g.min_depth, tc.min_depth),
+                depth_sum = g.depth_sum + tc.depth_sum,
+                depth_count = g.depth_count + tc.depth_count
+            FROM trip_cells tc
+            WHERE g.display_range = tc.display_range
+            AND g.cell_lat = tc.cell_lat
+            AND g.cell_lon = tc.cell_lon
+            RETURNING g.display_range, g.cell_lat, g.cell_lon)
+    INSERT INTO depth_grid (display_range, cell_lat, cell_lon,
+                            min_depth, depth_sum, depth_count)
+    SELECT tc.display_range, tc.cell_lat, tc.cell_lon,
+           tc.min_depth, tc.depth_sum, tc.depth_count
+    FROM trip_cells tc
+    WHERE NOT EXISTS (SELECT 1 FROM merged m
+                      WHERE m.display_range = tc.display_range
+                      AND m.cell_lat = tc.cell_lat
+                      AND m.cell_lon = tc.cell_lon);
+$$
+LANGUAGE SQL;
+
+-- The cells of depth_grid, at every display range, that contain the
+-- positions position_ids_ of a trip, or all of its positions if
+-- position_ids_ is NULL.
+CREATE OR REPLACE FUNCTION
+depth_grid_cells(trip_id_ INTEGER, position_ids_ INTEGER[])
+RETURNS TABLE (display_range INTEGER,
+               cell_lat INTEGER,
+               cell_lon INTEGER) AS $$
+    SELECT DISTINCT r.range,
+           floor(p.latitude / r.lat_range)::INTEGER,
+           floor(p.longitude / r.lon_range)::INTEGER
+    FROM position p
+    CROSS JOIN display_ranges r
+    WHERE p.trip_id = $1
+    AND ($2 IS NULL OR p.id = ANY ($2))
+    AND p.latitude IS NOT NULL
+    AND p.longitude IS NOT NULL;
+$$
+LANGUAGE SQL STABLE;
+
+-- Recompute the cells of depth_grid that contain the positions
+-- position_ids_ of a trip (all of its positions if NULL) from the
+-- valid depths of all trips. Used when depths have been appended to
+-- a trip or their validity has changed. If without_trip_ is true, the
+-- depths of the trip itself are left out, as when the data of the
+-- trip is about to be replaced.
+CREATE OR REPLACE FUNCTION
+depth_grid_refresh(trip_id_ INTEGER, position_ids_ INTEGER[],
+                   without_trip_ BOOLEAN DEFAULT FALSE)
+RETURNS void AS $$
+    SELECT depth_grid_lock();
+    DELETE FROM depth_grid g
+        USING depth_grid_cells($1, $2) c
+        WHERE g.display_range = c.display_range
+        AND g.cell_lat = c.cell_lat
+        AND g.cell_lon = c.cell_lon;
+    WITH margin AS (
+        -- The cells extend at most one of the largest cells from the
+        -- positions.
+        SELECT MAX(lat_range) AS lat_margin,
+               MAX(lon_range) AS lon_margin
+        FROM display_ranges),
+    area AS (
+        SELECT MIN(p.latitude) - m.lat_margin AS lat0,
+               MAX(p.latitude) + m.lat_margin AS lat1,
+               MIN(p.longitude) - m.lon_margin AS lon0,
+               MAX(p.longitude) + m.lon_margin AS lon1
+        FROM position p, margin m
+        WHERE p.trip_id = $1
+        AND ($2 IS NULL OR p.id = ANY ($2))
+        GROUP BY m.lat_margin, m.lon_margin),
+    area_depths AS (
+        SELECT p.latitude, p.longitude, d.depth
+        FROM area a
+        JOIN position p
+        ON point(p.longitude, p.latitude) <@
+           box(point(a.lon0, a.lat0), point(a.lon1, a.lat1))
+        JOIN depth d ON p.id = d.position_id AND d.trip_id = p.trip_id
+        WHERE NOT d.erroneous
+        AND NOT ($3 AND p.trip_id = $1)),
+    area_cells AS (
+        SELECT r.range AS display_range,
+               floor(ad.latitude / r.lat_range)::INTEGER AS cell_lat,
+               floor(ad.longitude / r.lon_range)::INTEGER AS cell_lon,
+               MIN(ad.depth) AS min_depth,
+               SUM(ad.depth) AS depth_sum,
+               COUNT(*) AS depth_count
+        FROM area_depths ad
+        CROSS JOIN display_ranges r
+        GROUP BY 1, 2, 3)
+    INSERT INTO depth_grid (display_range, cell_lat, cell_lon,
+                            min_depth, depth_sum, depth_count)
+    SELECT ac.display_range, ac.cell_lat, ac.cell_lon,
+           ac.min_depth, ac.depth_sum, ac.depth_count
+    FROM area_cells ac
+    JOIN depth_grid_cells($1, $2) c
+    USING (display_range, cell_lat, cell_lon);
+$$
+LANGUAGE SQL;
+
+-- Recompute all of depth_grid, as when the display ranges change.
+CREATE OR REPLACE FUNCTION depth_grid_rebuild()
+RETURNS void AS $$
+    SELECT depth_grid_lock();
+    DELETE FROM depth_grid;
+    INSERT INTO depth_grid (display_range, cell_lat, cell_lon,
+                            min_depth, depth_sum, depth_count)
+    SELECT r.range,
+           floor(p.latitude / r.lat_range)::INTEGER,
+           floor(p.longitude / r.lon_range)::INTEGER,
+           MIN(d.depth), SUM(d.depth), COUNT(*)
+    FROM position p
+    JOIN depth d ON p.id = d.position_id AND d.trip_id = p.trip_id
+    CROSS JOIN display_ranges r
+    WHERE p.latitude IS NOT NULL
+    AND p.longitude IS NOT NULL
+    AND NOT d.erroneous
+    GROUP BY 1, 2, 3;
+$$
+LANGUAGE SQL;
 
--- Get the depth_id of the row that has the
--- smallest depth within an area.
+-- Return the display range closest to the meters/pixel value
+-- provided by the client.
 CREATE OR REPLACE FUNCTION
-get_min_depth_id(center_latitude DOUBLE PRECISION,
-                 center_longitude DOUBLE PRECISION,
-                 display_range INTEGER)
+get_display_range(meters_per_pixel DOUBLE PRECISION)
 RETURNS INTEGER
 AS $$
-    WITH depths AS (SELECT id AS depth_id,
-                    depth,
-                    row_number() OVER (ORDER BY depth) AS rnum
-                    FROM depth
-                    WHERE position_id IN (SELECT * FROM
-                                          get_positions_in_area($1, $2, $3)))
-    SELECT depth_id FROM depths WHERE rnum = 1;
+    SELECT COALESCE(MAX(range), 0)
+        FROM display_ranges
+        WHERE range < $1;
 $$
-LANGUAGE SQL;
+LANGUAGE SQL STABLE;
 
 
 CREATE OR REPLACE FUNCTION calc_display_range(range INTEGER)
@@ -174,3 +638,94 @@ BEGIN
 END;
 $$
 LANGUAGE plpgsql;
+
+-- Mean of directions in degrees, as the direction of the sum of the
+-- unit vectors. The result is in [0, 360), or NULL if there are no
+-- values.
+CREATE OR REPLACE FUNCTION
+mean_direction_step(sums DOUBLE PRECISION[], angle DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION[] AS $$
+    SELECT CASE WHEN $2 IS NULL THEN $1
+                ELSE ARRAY[$1[1] + sin(radians($2)),
+                           $1[2] + cos(radians($2)),
+                           $1[3] + 1] END;
+$$
+LANGUAGE SQL IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION
+mean_direction_final(sums DOUBLE PRECISION[])
+RETURNS DOUBLE PRECISION AS $$
+    SELECT CASE WHEN $1[3] = 0 THEN NULL
+                ELSE degrees(atan2($1[1], $1[2])) + 360.0 -
+                     360.0 * floor((degrees(atan2($1[1], $1[2])) + 360.0)
+                                   / 360.0) END;
+$$
+LANGUAGE SQL IMMUTABLE;
+
+DROP AGGREGATE IF EXISTS mean_direction(DOUBLE PRECISION);
+CREATE AGGREGATE mean_direction(DOUBLE PRECISION) (
+    SFUNC = mean_direction_step,
+    STYPE = DOUBLE PRECISION[],
+    FINALFUNC = mean_direction_final,
+    INITCOND = '{0, 0, 0}'
+);
+
+-- Summaries for the trips loaded before trip_summary existed.
+SELECT update_trip_summary(t.id)
+    FROM trip t
+    WHERE NOT EXISTS (SELECT 1 FROM trip_summary s WHERE s.trip_id = t.id);
+
+-- Samples for the positions loaded before position_sample existed,
+-- merged from the measurement tables in the same way as the loader
+-- does.
+INSERT INTO position_sample (position_id, trip_id, pos_time_utc,
+                             latitude, longitude, display_range,
+                             depth, water_speed, ground_speed, course,
+                             apparent_wind_speed, apparent_wind_angle,
+                             true_wind_speed, true_wind_angle)
+    SELECT p.id, p.trip_id, p.pos_time_utc, p.latitude, p.longitude,
+           p.display_range,
+           (SELECT MIN(d.depth) FROM depth d WHERE d.position_id = p.id),
+           (SELECT AVG(ws.speed) FROM water_speed ws
+                WHERE ws.position_id = p.id),
+           gsc.speed, gsc.course,
+           aw.speed, aw.angle, tw.speed, tw.angle
+    FROM position p
+    LEFT JOIN (SELECT position_id,
+                      AVG(speed) AS speed,
+                      mean_direction(course) AS course
+               FROM ground_speed_course
+               GROUP BY position_id) gsc
+    ON gsc.position_id = p.id
+    LEFT JOIN (SELECT position_id,
+                      AVG(speed) AS speed,
+                      round(mean_direction(angle))::integer % 360 AS angle
+               FROM wind
+               WHERE true_apparent = 0
+               GROUP BY position_id) aw
+    ON aw.position_id = p.id
+    LEFT JOIN (SELECT position_id,
+                      AVG(speed) AS speed,
+                      round(mean_direction(angle))::integer % 360 AS angle
+               FROM wind
+               WHERE true_apparent = 1
+               GROUP BY position_id) tw
+    ON tw.position_id = p.id
+    WHERE NOT EXISTS (SELECT 1 FROM position_sample s
+                      WHERE s.position_id = p.id);
+
+-- Trips loaded before the partitioning.
+SELECT move_trip_to_partition(t.id)
+    FROM trip t
+    WHERE EXISTS (SELECT 1 FROM ONLY position p WHERE p.trip_id = t.id);
+
+-- The time index of the position_sample partitions created before it.
+SELECT position_sample_time_index(substr(c.relname,
+                                         length('position_sample') + 1))
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'position_sample'::regclass;
+
+-- The depth grid of the databases created before it.
+SELECT depth_grid_rebuild()
+    WHERE NOT EXISTS (SELECT 1 FROM depth_grid);
@@ -15,9 +15,77 @@ CREATE TABLE IF NOT EXISTS trip (
    trip_date DATE NOT NULL DEFAULT CURRENT_DATE,
    vessel_name TEXT NOT NULL DEFAULT '',
    load_time TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-   load_file TEXT
+   load_file TEXT,
+   -- Incremented, and data_modified set, by bump_data_version each
+   -- time the data of the trip changes.
+   data_version INTEGER NOT NULL DEFAULT 1,
+   data_modified TIMESTAMP WITH TIME ZONE NOT NULL
+      DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Databases created before the data versions.
+DO $$
+BEGIN
+    ALTER TABLE trip ADD COLUMN data_version INTEGER NOT NULL DEFAULT 1;
+    ALTER TABLE trip ADD COLUMN data_modified TIMESTAMP WITH TIME ZONE
+        NOT NULL DEFAULT CURRENT_TIMESTAMP;
+EXCEPTION WHEN duplicate_column THEN
+    NULL;
+END
+$$;
+
+-- The generation of all the data, incremented by bump_data_version
+-- whenever any trip changes. One row.
+CREATE TABLE IF NOT EXISTS data_generation (
+   generation INTEGER NOT NULL,
+   modified TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+INSERT INTO data_generation (generation, modified)
+    SELECT 1, CURRENT_TIMESTAMP
+    WHERE NOT EXISTS (SELECT 1 FROM data_generation);
+
+-- The trip list is paged by (trip_date, id).
+DROP INDEX IF EXISTS trip_date_id_idx;
+CREATE INDEX trip_date_id_idx ON trip (trip_date, id);
+
+-- Summary of the data of each trip, maintained by the loader with
+-- update_trip_summary. The bounding box, times and depths are NULL
+-- for a trip without positions or depths.
+CREATE TABLE IF NOT EXISTS trip_summary (
+   trip_id INTEGER PRIMARY KEY REFERENCES trip (id) ON DELETE CASCADE,
+   lat0 DOUBLE PRECISION,
+   lat1 DOUBLE PRECISION,
+   lon0 DOUBLE PRECISION,
+   lon1 DOUBLE PRECISION,
+   start_time TIMESTAMP WITHOUT TIME ZONE,
+   end_time TIMESTAMP WITHOUT TIME ZONE,
+   position_count INTEGER NOT NULL DEFAULT 0,
+   depth_count INTEGER NOT NULL DEFAULT 0,
+   min_depth DOUBLE PRECISION,
+   max_depth DOUBLE PRECISION
+);
+
+-- For finding the trips that overlap with the map view. The queries
+-- must use the same box expression.
+DROP INDEX IF EXISTS trip_summary_box_idx;
+CREATE INDEX trip_summary_box_idx ON trip_summary
+   USING gist (box(point(lon0, lat0), point(lon1, lat1)));
+
+-- The position, depth and position_sample tables are partitioned by
+-- trip id with table inheritance. The rows of the trips
+-- trip_partition_size() * n ... trip_partition_size() * (n + 1) - 1
+-- are in the child tables position_tNNNN, depth_tNNNN and
+-- position_sample_tNNNN, created by trip_partition() as trips are
+-- loaded. The parent tables themselves hold no rows. A query with a
+-- condition on trip_id only reads the partitions of those trips
+-- (constraint_exclusion must be "partition" or "on").
+--
+-- Rows in child tables cannot be the target of foreign keys, so the
+-- measurement tables do not refer to position. The rows of a trip
+-- are deleted by trip_id from each table; the child tables refer to
+-- trip with ON DELETE CASCADE.
+
 CREATE TABLE IF NOT EXISTS position (
    id SERIAL PRIMARY KEY,
    pos_time_utc TIMESTAMP WITHOUT TIME ZONE NOT NULL,
@@ -33,9 +101,21 @@ DROP INDEX IF EXISTS position_range_idx;
 CREATE INDEX position_range_idx ON position (latitude, longitude,
                                              trip_id);
 
+DROP INDEX IF EXISTS position_trip_id_idx;
+CREATE INDEX position_trip_id_idx ON position (trip_id);
+
+-- 2D index for bounding box queries. The queries must use the
+-- same point(longitude, latitude) expression.
+DROP INDEX IF EXISTS position_point_idx;
+CREATE INDEX position_point_idx ON position
+   USING gist (point(longitude, latitude));
+
+-- The wind, water_speed and ground_speed_course tables hold the
+-- measurements of the trips loaded before position_sample existed.
+-- The loader no longer writes them.
 CREATE TABLE IF NOT EXISTS ground_speed_course (
    id SERIAL PRIMARY KEY,
-   position_id INTEGER REFERENCES position (id) ON DELETE CASCADE,
+   position_id INTEGER,
    speed DOUBLE PRECISION NOT NULL,  -- kn
    course DOUBLE PRECISION,          -- degrees
    erroneous BOOLEAN NOT NULL DEFAULT FALSE
@@ -46,7 +126,7 @@ CREATE INDEX ground_speed_pos_id_idx ON ground_speed_course (position_id);
 
 CREATE TABLE IF NOT EXISTS water_speed (
    id SERIAL PRIMARY KEY,
-   position_id INTEGER REFERENCES position (id) ON DELETE CASCADE,
+   position_id INTEGER,
    speed DOUBLE PRECISION NOT NULL,  -- kn
    erroneous BOOLEAN NOT NULL DEFAULT FALSE
 );
@@ -55,25 +135,150 @@ CREATE INDEX water_speed_pos_id_idx ON water_speed (position_id);
 
 CREATE TABLE IF NOT EXISTS depth (
    id SERIAL PRIMARY KEY,
-   position_id INTEGER REFERENCES position (id) ON DELETE CASCADE,
+   position_id INTEGER,
    depth DOUBLE PRECISION NOT NULL,   -- m
    display_range INTEGER NOT NULL DEFAULT 0,
-   erroneous BOOLEAN NOT NULL DEFAULT FALSE
+   erroneous BOOLEAN NOT NULL DEFAULT FALSE,
+   trip_id INTEGER                    -- The trip of the position
 );
 
+-- Databases created before the partitioning.
+DO $$
+BEGIN
+    ALTER TABLE depth ADD COLUMN trip_id INTEGER;
+EXCEPTION WHEN duplicate_column THEN
+    NULL;
+END
+$$;
+
 DROP INDEX IF EXISTS depth_pos_id_idx;
 CREATE INDEX depth_pos_id_idx ON depth (position_id);
 
+-- At coarse zoom levels only a few depths pass the display range
+-- condition. They can be found without touching the other rows.
+DROP INDEX IF EXISTS depth_display_range_idx;
+CREATE INDEX depth_display_range_idx ON depth (display_range, position_id);
+
 CREATE TABLE IF NOT EXISTS wind (
    id SERIAL PRIMARY KEY,
-   position_id INTEGER REFERENCES position (id) ON DELETE CASCADE,
+   position_id INTEGER,
    speed DOUBLE PRECISION NOT NULL,
    angle INTEGER NOT NULL,
    true_apparent SMALLINT NOT NULL  -- true wind 1, apparent wind 0
 );
 
+-- One row per position with the measurements that were recorded
+-- between the position fix and the next one, merged by the loader:
+-- the smallest depth, and the means of the speeds and directions.
+-- The measurements are NULL if there were none. The trip points are
+-- read from this table alone; display_range is a copy of the display
+-- range of the position, kept up to date by update_display_ranges.
+-- Wind speeds are in m/s and the other speeds in knots.
+CREATE TABLE IF NOT EXISTS position_sample (
+   position_id INTEGER PRIMARY KEY,
+   trip_id INTEGER NOT NULL REFERENCES trip (id) ON DELETE CASCADE,
+   pos_time_utc TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+   latitude DOUBLE PRECISION,
+   longitude DOUBLE PRECISION,
+   display_range INTEGER NOT NULL DEFAULT 0,
+   depth DOUBLE PRECISION,
+   water_speed DOUBLE PRECISION,
+   ground_speed DOUBLE PRECISION,
+   course DOUBLE PRECISION,
+   apparent_wind_speed DOUBLE PRECISION,
+   apparent_wind_angle INTEGER,
+   true_wind_speed DOUBLE PRECISION,
+   true_wind_angle INTEGER
+);
+
+DROP INDEX IF EXISTS position_sample_trip_idx;
+CREATE INDEX position_sample_trip_idx ON position_sample (trip_id,
+                                                          display_range);
+
+-- For reading the points of a trip in a time window, and the time of
+-- its last position.
+DROP INDEX IF EXISTS position_sample_time_idx;
+CREATE INDEX position_sample_time_idx ON position_sample (trip_id,
+                                                          pos_time_utc);
+
+-- Same as position_point_idx.
+DROP INDEX IF EXISTS position_sample_point_idx;
+CREATE INDEX position_sample_point_idx ON position_sample
+   USING gist (point(longitude, latitude));
+
+-- The foreign keys to position of the databases created before the
+-- partitioning.
+ALTER TABLE depth DROP CONSTRAINT IF EXISTS depth_position_id_fkey;
+ALTER TABLE position_sample
+   DROP CONSTRAINT IF EXISTS position_sample_position_id_fkey;
+ALTER TABLE wind DROP CONSTRAINT IF EXISTS wind_position_id_fkey;
+ALTER TABLE water_speed
+   DROP CONSTRAINT IF EXISTS water_speed_position_id_fkey;
+ALTER TABLE ground_speed_course
+   DROP CONSTRAINT IF EXISTS ground_speed_course_position_id_fkey;
+
 CREATE TABLE IF NOT EXISTS display_ranges (
    range INTEGER PRIMARY KEY,
    lat_range DOUBLE PRECISION,
    lon_range DOUBLE PRECISION
 );
+
+-- The track of each trip, simplified for each display range and
+-- stored as a Google encoded polyline. Maintained by the loader.
+CREATE TABLE IF NOT EXISTS trip_track (
+   trip_id INTEGER NOT NULL REFERENCES trip (id) ON DELETE CASCADE,
+   display_range INTEGER NOT NULL,
+   point_count INTEGER NOT NULL,
+   polyline TEXT NOT NULL,
+   PRIMARY KEY (trip_id, display_range)
+);
+
+-- The valid depths of all trips aggregated into the latitude/longitude
+-- grid of each display range: the smallest depth, and the sum and the
+-- number of the depths for the mean. The cells are numbered as in
+-- update_display_ranges. Maintained by the loader with depth_grid_add
+-- and depth_grid_refresh.
+CREATE TABLE IF NOT EXISTS depth_grid (
+   display_range INTEGER NOT NULL,
+   cell_lat INTEGER NOT NULL,
+   cell_lon INTEGER NOT NULL,
+   min_depth REAL NOT NULL,
+   depth_sum DOUBLE PRECISION NOT NULL,
+   depth_count INTEGER NOT NULL,
+   PRIMARY KEY (display_range, cell_lat, cell_lon)
+);
+
+-- Uploaded files waiting to be loaded or being loaded. state is
+-- 'queued', 'running', 'done' or 'failed'; phase tells which step of
+-- the loading a running job is in.
+CREATE TABLE IF NOT EXISTS upload_job (
+   id SERIAL PRIMARY KEY,
+   user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+   input_file TEXT NOT NULL,
+   trip_name TEXT NOT NULL DEFAULT '',
+   trip_date DATE,
+   vessel_name TEXT NOT NULL DEFAULT '',
+   state TEXT NOT NULL DEFAULT 'queued',
+   phase TEXT,
+   lines_parsed INTEGER NOT NULL DEFAULT 0,
+   rows_inserted INTEGER NOT NULL DEFAULT 0,
+   trip_id INTEGER REFERENCES trip (id) ON DELETE SET NULL,
+   messages TEXT,
+   created TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+   updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+   -- Incremented each time a worker takes the job. A worker only
+   -- updates the job while the attempt is still its own.
+   attempt INTEGER NOT NULL DEFAULT 0
+);
+
+-- Databases created before the attempts.
+DO $$
+BEGIN
+    ALTER TABLE upload_job ADD COLUMN attempt INTEGER NOT NULL DEFAULT 0;
+EXCEPTION WHEN duplicate_column THEN
+    NULL;
+END
+$$;
+
+DROP INDEX IF EXISTS upload_job_state_idx;
+CREATE INDEX upload_job_state_idx ON upload_job (state, id);
@@ -9,3 +9,12 @@ SELECT calc_display_range(38);
 SELECT calc_display_range(76);
 SELECT calc_display_range(152);
 SELECT calc_display_range(304);
+
+-- The cells of the depth grid depend on the display ranges.
+SELECT depth_grid_rebuild();
+
+-- The API reads the display ranges again when the data generation
+-- changes.
+UPDATE data_generation
+    SET generation = generation + 1,
+        modified = clock_timestamp();
@@ -1,18 +1,60 @@
 
-from flask import Flask, g
+from flask import Flask, g, request
+from flask.ctx import _AppCtxGlobals
 from flask_login import LoginManager
 
+import jinja2
 import logging
 import os
 import sys
 
+from flaska import profiling
+from flaska.db_pool import ConnectionPool
+from flaska.depth_data import db_connect_string
+from flaska.upload_jobs import UploadJobQueue
+
+class AppGlobals(_AppCtxGlobals):
+    """
+    Request globals. The database connection g.db is checked out from
+    the pool only when a view uses it for the first time.
+    """
+    @property
+    def db(self):
+        if "_db" not in self.__dict__:
+            with profiling.timer("checkout"):
+                self._db = db_pool.getconn()
+        return self._db
+
+class ProfiledTemplate(jinja2.Template):
+    """A template class that times rendering as the render stage."""
+    def render(self, *args, **kwargs):
+        with profiling.timer("render"):
+            return jinja2.Template.render(self, *args, **kwargs)
+
 app = Flask(__name__)
+app.app_ctx_globals_class = AppGlobals
 
 # General configuration.
 app.config.from_object('flaska.flk_default_config')
 if 'FLK_CONFIG' in os.environ:
     app.config.from_envvar('FLK_CONFIG')
 
+# Database connections for the requests.
+db_pool = ConnectionPool(db_connect_string(app.config['DB_NAME'],
+                                           app.config['DB_USERNAME'],
+                                           app.config['DB_PASSWORD']),
+                         min_size=app.config['DB_POOL_MIN_SIZE'],
+                         max_size=app.config['DB_POOL_MAX_SIZE'],
+                         max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+                         health_check_idle=\
+                             app.config['DB_POOL_HEALTH_CHECK_IDLE'],
+                         timeout=app.config['DB_POOL_TIMEOUT'],
+                         connection_factory=profiling.ProfiledConnection
+                         if app.config['PROFILING'] else None)
+
+if app.config['PROFILING']:
+    app.jinja_env.template_class = ProfiledTemplate
+
 # Set up the login manager
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -24,21 +66,85 @@ app.logger.addHandler(logging.StreamHandler(stream=sys.stderr))
 import flaska.views
 import flaska.api
 import flaska.login_controller
+
+# Background loading of the uploaded files.
+upload_jobs = UploadJobQueue(db_pool,
+                             db_pool.connect_string,
+                             workers=app.config['UPLOAD_WORKERS'],
+                             poll_interval=app.config['UPLOAD_POLL_INTERVAL'],
+                             stale_after=app.config['UPLOAD_JOB_STALE_AFTER'],
+                             keep_files=app.config['NMEA_FILE_ARCHIVE'],
+                             on_data_changed=flaska.api.data_changed)
+
+# The workers are started in the server process, not when the package
+# is imported: a preforking server imports it before forking, and the
+# command line tools import it too.
+@app.before_first_request
+def start_upload_workers():
+    upload_jobs.start()
+
 import flaska.files
 
-from flaska.depth_data import db_conn, db_disconn
+@app.teardown_request
+def drop_db_conn(exception):
+    db = g.pop("_db", None)
+    if db is not None:
+        db_pool.putconn(db)
 
-# Teardown and setup: connect to DB.
-# Should actually use a db connection pool
-# but this works well enough for now.
-# Also not every call needs the db connection.
+# Request profiling. With streamed responses the teardown runs after
+# the body has been sent, so the histograms cover the whole request;
+# the Server-Timing header only has the part before the first byte.
 
 @app.before_request
-def conn_to_db():
-    g.db = db_conn(app.config['DB_NAME'],
-                   app.config['DB_USERNAME'],
-                   app.config['DB_PASSWORD'])
+def start_profile():
+    if app.config['PROFILING']:
+        g.profile = profiling.Profile()
+        profiling.activate(g.profile)
+
+@app.after_request
+def add_server_timing(response):
+    profile = g.get("profile")
+    if profile is not None:
+        if response.is_sequence:
+            profile.count("bytes", sum(len(chunk)
+                                       for chunk in response.response))
+        elif response.direct_passthrough:
+            # Files are passed to the server as they are, so that it can
+            # send them with wsgi.file_wrapper.
+            profile.count("bytes", response.content_length or 0)
+        else:
+            response.response = CountedBody(response.response, profile)
+        response.headers["Server-Timing"] = profile.server_timing()
+    return response
 
 @app.teardown_request
-def drop_db_conn(exception):
-    db_disconn(g.db)
+def finish_profile(exception):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    profile.finish()
+    profiling.activate(None)
+
+    endpoint = (("endpoint", request.endpoint or "none"), )
+    metrics = profiling.metrics
+    metrics.observe_timings("loca_request_seconds", endpoint,
+                            profile.timings())
+    metrics.observe("loca_request_rows", endpoint,
+                    profile.counts.get("rows", 0), profiling.ROWS_BUCKETS)
+    metrics.observe("loca_response_bytes", endpoint,
+                    profile.counts.get("bytes", 0), profiling.BYTES_BUCKETS)
+
+class CountedBody:
+    """A streamed response body that counts the bytes sent."""
+    def __init__(self, body, profile):
+        self.body = body
+        self.profile = profile
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.profile.count("bytes", len(chunk))
+            yield chunk
+
+    def close(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
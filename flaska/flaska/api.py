@@ -1,40 +1,332 @@
 
+import calendar
+import datetime
+import functools
+import hashlib
 import json
+import re
 
-from flask import g, request, Response, abort
-from flask_login import login_required
+from flask import g, request, Response, abort, stream_with_context
+from flask_login import login_required, current_user
 
 from depth_data import db_conn, db_disconn
 from depth_data import db_depths_fetch, db_triplist_fetch, \
-    db_update_validityflags, db_trip_points_fetch
-from flaska import app
+    db_update_validityflags, db_trip_points_fetch, \
+    db_display_ranges_fetch, db_position_fetch, db_depth_stats_fetch, \
+    db_trip_track_fetch, db_data_generation_fetch, db_trip_version_fetch, \
+    db_depth_grid_fetch, depth_validity_conds
+from upload_jobs import fetch_job
+from tile_cache import TileCache, tile_bounds, tile_m_per_pix, \
+    tile_pixel_size, tile_valid
+from trip_archive import TripArchive
+from flaska import app, db_pool
+
+import columns
+import depth_grid
+import profiling
+
+tile_cache = TileCache(app.config["TILE_CACHE_MAX_BYTES"],
+                       app.config["TILE_CACHE_DIR"])
+
+trip_archive = None
+if app.config["TRIP_ARCHIVE_DIR"]:
+    trip_archive = TripArchive(app.config["TRIP_ARCHIVE_DIR"])
+
+# The largest page of the trip list.
+MAX_TRIP_LIST_LIMIT = 100
+
+# The contents of the display_ranges table and the data generation in
+# which they were read, as (generation, ranges). The table is read
+# again when the generation has changed.
+display_ranges = (None, [])
+
+# Columns of the columnar encoding of the depth and trip point data.
+depth_columns = (("p_id", columns.INT32),
+                 ("t_id", columns.INT32),
+                 ("t_utc", columns.UINT32),
+                 ("lat", columns.FLOAT64),
+                 ("lon", columns.FLOAT64),
+                 ("depth", columns.FLOAT32),
+                 ("d_bad", columns.BITS))
+
+trip_point_columns = (("p_id", columns.INT32),
+                      ("t_utc", columns.UINT32),
+                      ("lat", columns.FLOAT64),
+                      ("lon", columns.FLOAT64),
+                      ("depth", columns.FLOAT32),
+                      ("ws", columns.FLOAT32),
+                      ("gs", columns.FLOAT32),
+                      ("course", columns.FLOAT32))
+
+# Columns of the columnar encoding of the depth grid cells. The
+# depths are in decimeters.
+grid_cell_columns = (("cell_lat", columns.INT32),
+                     ("cell_lon", columns.INT32),
+                     ("min", columns.UINT16),
+                     ("mean", columns.UINT16),
+                     ("count", columns.UINT32))
+
+def data_generation(**view_args):
+    generation = db_data_generation_fetch(g.db)
+    g.data_generation = generation[0]
+    return generation
+
+def request_generation(db):
+    """
+    Return the data generation of this request. It is fetched once per
+    request; the views of the data generation have it already.
+    """
+    generation = getattr(g, "data_generation", None)
+    if generation is None:
+        generation = db_data_generation_fetch(db)[0]
+        g.data_generation = generation
+    return generation
+
+def trip_data_version(trip_id, **view_args):
+    return db_trip_version_fetch(g.db, trip_id)
+
+def conditional(version_fetch, private=False):
+    """
+    Make a view answer conditional GET requests. version_fetch is
+    called with the view arguments and returns the version of the data
+    that the response is made of and the time of its last change, or
+    None if there is none.
+
+    The ETag of the response is derived from the version, the query
+    and the Accept header. If the request has a matching If-None-Match
+    (or, without one, an If-Modified-Since that is not older than the
+    data), a 304 response is returned without calling the view. The
+    version number is left in g.data_version for the view, which keys
+    its cached tiles with it.
+
+    The view reads the data after the version was fetched, so the
+    version is fetched again after the view: the queries of the view
+    have run by then (the cursor of a streamed response is opened in
+    the view). If the version has changed, the data may be of either
+    version, and the response gets no validators.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def conditional_view(**view_args):
+            version = version_fetch(**view_args)
+            if version is None:
+                g.data_version = None
+                return view(**view_args)
+
+            (number, modified) = version
+            g.data_version = number
+            etag = data_etag(number)
+            if not_modified(etag, modified):
+                response = Response(status=304)
+            else:
+                response = app.make_response(view(**view_args))
+                if version_fetch(**view_args) != version:
+                    etag = None
+            if etag is not None:
+                response.set_etag(etag)
+                response.last_modified = int(modified)
+            response.cache_control.no_cache = True
+            if private:
+                response.cache_control.private = True
+            else:
+                response.cache_control.public = True
+            return response
+        return conditional_view
+    return decorator
+
+def data_etag(version):
+    """The ETag of the response to this request for a data version."""
+    query = u"&".join(u"{}={}".format(key, value) for (key, value)
+                      in sorted(request.args.items(multi=True)))
+    digest = hashlib.sha1(u"{} {}?{} {}".format(version,
+                                                request.path,
+                                                query,
+                                                request.headers.get("Accept",
+                                                                    ""))
+                          .encode("utf-8"))
+    return "{}-{}".format(version, digest.hexdigest()[:16])
+
+def not_modified(etag, modified):
+    """
+    Tell whether the response with etag, for data last changed at
+    modified (seconds since the epoch), is not modified. The dates of
+    If-Modified-Since are in whole seconds: data changed later in the
+    same second is newer than the date.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return modified <= calendar.timegm(
+            request.if_modified_since.utctimetuple())
+    return False
 
 @app.route("/api/1/depth_data/")
 @login_required
+@conditional(data_generation, private=True)
 def depth_data():
     coord_range = fetch_coord_range(mandatory=True)
-    depths = db_depths_fetch(g.db,
-                             coord_range,
-                             request.args.get("mPerPix", default=400,
-                                              type=float))
-    return json_response({ "depths": depths })
+    columnar = columns_requested()
+    depths = fetch_depths(coord_range,
+                          request.args.get("mPerPix", default=400,
+                                           type=float),
+                          epoch_time=columnar)
+    return data_response(encode_depths(depths, columnar), columnar)
+
+@app.route("/api/1/depth_data/tile/<int:z>/<int:x>/<int:y>")
+@login_required
+@conditional(data_generation, private=True)
+def depth_data_tile(z, x, y):
+    if not tile_valid(z, x, y):
+        abort(404)
+
+    columnar = columns_requested()
+    m_per_pix = tile_m_per_pix(z, x, y)
+    key = ("depth", z, x, y, g.data_version,
+           get_display_range(g.db, m_per_pix), response_format(columnar))
+    body = tile_cache.get(key)
+    if body is None:
+        depths = fetch_depths(tile_bounds(z, x, y), m_per_pix,
+                              epoch_time=columnar)
+        with profiling.timer("serialize"):
+            body = "".join(encode_depths(depths, columnar))
+        tile_cache.put(key, body)
+    return data_response(body, columnar)
+
+@app.route("/api/1/depth_stats/")
+@login_required
+@conditional(data_generation, private=True)
+def depth_stats():
+    coord_range = fetch_coord_range(mandatory=True)
+    stats = db_depth_stats_fetch(g.db,
+                                 coord_range,
+                                 request.args.get("mPerPix", default=400,
+                                                  type=float),
+                                 depth_validity())
+    return json_response(stats)
+
+@app.route("/api/1/depth_stats/tile/<int:z>/<int:x>/<int:y>")
+@login_required
+@conditional(data_generation, private=True)
+def depth_stats_tile(z, x, y):
+    if not tile_valid(z, x, y):
+        abort(404)
+
+    validity = depth_validity()
+    m_per_pix = tile_m_per_pix(z, x, y)
+    key = ("depth_stats", z, x, y, g.data_version,
+           get_display_range(g.db, m_per_pix), validity)
+    body = tile_cache.get(key)
+    if body is None:
+        stats = db_depth_stats_fetch(g.db, tile_bounds(z, x, y), m_per_pix,
+                                     validity)
+        with profiling.timer("serialize"):
+            body = json.dumps(stats)
+        tile_cache.put(key, body)
+    return Response(body, mimetype="application/json")
+
+@app.route("/api/1/depth_grid/tile/<int:z>/<int:x>/<int:y>")
+@login_required
+@conditional(data_generation, private=True)
+def depth_grid_tile(z, x, y):
+    """
+    The valid depths in a tile from the depth grid: a PNG image of the
+    smallest depths, coloured as the depth markers, or the grid cells
+    in the columnar format.
+    """
+    if not tile_valid(z, x, y):
+        abort(404)
+
+    columnar = columns_requested()
+    grid = depth_grid.tile_grid(get_display_ranges(g.db),
+                                tile_pixel_size(z, x, y))
+    if grid is None:
+        abort(404)
+    key = ("depth_grid", z, x, y, g.data_version, grid["range"],
+           grid["merge"], "columns" if columnar else "png")
+    body = tile_cache.get(key)
+    if body is None:
+        cells = db_depth_grid_fetch(g.db, tile_bounds(z, x, y), grid)
+        with profiling.timer("serialize"):
+            if columnar:
+                body = encode_grid_cells(cells, grid)
+            else:
+                body = depth_grid.render_tile(cells, grid, z, x, y)
+        tile_cache.put(key, body)
+    response = Response(body,
+                        mimetype=columns.MIMETYPE if columnar
+                        else "image/png")
+    response.vary.add("Accept")
+    return response
 
 @app.route("/api/1/trip/<int:trip_id>")
+@conditional(trip_data_version)
 def trip(trip_id):
     coord_range = fetch_coord_range(mandatory=False)
-    trip_points = db_trip_points_fetch(g.db,
-                                       trip_id,
-                                       coord_range,
-                                       request.args.get("mPerPix", default=400,
-                                                        type=float))
-    return json_response( { "trip_id": trip_id,
-                            "points": trip_points } )
+    columnar = columns_requested()
+    trip_points = fetch_trip_points(trip_id,
+                                    coord_range,
+                                    request.args.get("mPerPix", default=400,
+                                                     type=float),
+                                    epoch_time=columnar,
+                                    time_range=fetch_time_range())
+    return data_response(encode_trip_points(trip_id, trip_points, columnar),
+                         columnar)
+
+@app.route("/api/1/trip/<int:trip_id>/tile/<int:z>/<int:x>/<int:y>")
+@conditional(trip_data_version)
+def trip_tile(trip_id, z, x, y):
+    if not tile_valid(z, x, y):
+        abort(404)
+
+    columnar = columns_requested()
+    m_per_pix = tile_m_per_pix(z, x, y)
+    key = (trip_tile_kind(trip_id), z, x, y, g.data_version,
+           get_display_range(g.db, m_per_pix),
+           response_format(columnar))
+    body = tile_cache.get(key)
+    if body is None:
+        trip_points = fetch_trip_points(trip_id,
+                                        tile_bounds(z, x, y),
+                                        m_per_pix,
+                                        epoch_time=columnar)
+        with profiling.timer("serialize"):
+            body = "".join(encode_trip_points(trip_id, trip_points,
+                                              columnar))
+        tile_cache.put(key, body)
+    return data_response(body, columnar)
+
+@app.route("/api/1/trip/<int:trip_id>/track")
+@conditional(trip_data_version)
+def trip_track(trip_id):
+    """
+    The track of a trip as one encoded polyline, simplified for the
+    mPerPix value.
+    """
+    m_per_pix = request.args.get("mPerPix", default=400, type=float)
+    track = db_trip_track_fetch(g.db, trip_id, get_track_range(g.db,
+                                                               m_per_pix))
+    if track is None:
+        abort(404)
+    return json_response(track)
 
 @app.route("/api/1/trip/")
+@conditional(data_generation)
 def list_trips():
     limit = request.args.get("limit", type=int, default=10)
-    triplist = db_triplist_fetch(g.db, limit=limit)
-    return json_response({ "trips": triplist })
+    if not 0 < limit <= MAX_TRIP_LIST_LIMIT:
+        abort(400)
+    triplist = db_triplist_fetch(g.db,
+                                 limit=limit,
+                                 after=trip_list_position(
+                                     request.args.get("after")),
+                                 coord_range=fetch_coord_range())
+
+    # The position of the next page, if there can be one.
+    next_page = None
+    if len(triplist) == limit:
+        next_page = "{trip_date},{t_id}".format(**triplist[-1])
+    return json_response({ "trips": triplist,
+                           "next": next_page })
 
 @app.route("/api/1/measurement/<int:position_id>", methods=["POST"])
 @login_required
@@ -50,14 +342,289 @@ def update_measurement(position_id):
                                    depth_erroneous=depth_erroneous):
         abort(404)
 
+    # The flag change can move the display ranges of the depths
+    # around the position.
+    position = db_position_fetch(g.db, position_id)
+    if position:
+        (lat_margin, lon_margin) = display_range_margin(g.db)
+        invalidate_depth_tiles({"lat0": position["lat"] - lat_margin,
+                                "lat1": position["lat"] + lat_margin,
+                                "lon0": position["lon"] - lon_margin,
+                                "lon1": position["lon"] + lon_margin})
+
     # Success
     return "";
 
+@app.route("/api/1/jobs/<int:job_id>")
+@login_required
+def upload_job(job_id):
+    job = fetch_job(g.db, job_id, current_user.get_email())
+    if job is None:
+        abort(404)
+    return json_response(job)
+
+@app.route("/metrics")
+def metrics():
+    """The histograms of the request profiling, if it is enabled."""
+    if not app.config["PROFILING"]:
+        abort(404)
+    return Response(profiling.metrics.render(),
+                    mimetype="text/plain; version=0.0.4")
+
 def json_response(json_content, status=200):
-    return Response(json.dumps(json_content, ensure_ascii=False),
+    with profiling.timer("serialize"):
+        body = json.dumps(json_content, ensure_ascii=False)
+    return Response(body,
                     status=status,
                     mimetype="application/json")
 
+def columns_requested():
+    """
+    Return True if the client asked for the columnar encoding, either
+    with format=columns or with the Accept header.
+    """
+    if request.args.get("format") == "columns":
+        return True
+    return request.accept_mimetypes.best_match(["application/json",
+                                                columns.MIMETYPE]) \
+        == columns.MIMETYPE
+
+def trip_list_position(value):
+    """
+    Parse the position in the trip list, given as "YYYY-MM-DD,id" in
+    the after parameter, into a tuple.
+    """
+    if value is None:
+        return None
+    rm = re.match("^([0-9]{4}-[0-9]{2}-[0-9]{2}),([0-9]+)$", value)
+    if not rm:
+        abort(400)
+    return (rm.group(1), int(rm.group(2)))
+
+def fetch_time_range():
+    """
+    Pick the time window from the t0 and t1 parameters of the request
+    as a (t0, t1) tuple of UTC datetimes, either of which can be None.
+    Returns None if neither is given.
+    """
+    t0 = request_time(request.args.get("t0"))
+    t1 = request_time(request.args.get("t1"))
+    if t0 is None and t1 is None:
+        return None
+    if t0 is not None and t1 is not None and t0 >= t1:
+        abort(400)
+    return (t0, t1)
+
+def request_time(value):
+    """
+    Parse a time parameter, given either as YYYYMMDDHHMMSS (the format
+    of the t_utc values) or as seconds since the epoch.
+    """
+    if value is None:
+        return None
+    try:
+        if re.match("^[0-9]{14}$", value):
+            return datetime.datetime.strptime(value, "%Y%m%d%H%M%S")
+        if re.match("^[0-9]+$", value):
+            return datetime.datetime.utcfromtimestamp(int(value))
+    except (ValueError, OverflowError):
+        pass
+    abort(400)
+
+def depth_validity():
+    """Return the validity filter of the depth statistics requested."""
+    validity = request.args.get("validity", default="all")
+    if validity not in depth_validity_conds:
+        abort(400)
+    return validity
+
+def response_format(columnar):
+    return "columns" if columnar else "json"
+
+def data_response(body, columnar):
+    """
+    Make a response for depth or trip point data. body is either a
+    string or an iterable over the chunks of the body. Chunks are
+    streamed to the client as they are produced.
+    """
+    if not isinstance(body, str):
+        body = stream_with_context(profiling.timed_iter(body, "serialize"))
+    response = Response(body,
+                        mimetype=columns.MIMETYPE if columnar
+                        else "application/json")
+    response.vary.add("Accept")
+    return response
+
+def fetch_depths(coord_range, m_per_pix, epoch_time=False):
+    """
+    Fetch the depths in coord_range for a meters per pixel value, from
+    the trip archive if there is one, or from the database.
+    """
+    if trip_archive is not None:
+        depths = trip_archive.depths(g.db, coord_range,
+                                     get_display_range(g.db, m_per_pix),
+                                     epoch_time=epoch_time)
+        if depths is not None:
+            return depths
+    return db_depths_fetch(g.db, coord_range, m_per_pix,
+                           epoch_time=epoch_time)
+
+def fetch_trip_points(trip_id, coord_range, m_per_pix, epoch_time=False,
+                      time_range=None):
+    """
+    Fetch the points of a trip in coord_range (all if None) and in
+    time_range (see db_trip_points_fetch) for a meters per pixel value,
+    from the trip archive if there is one, or from the database. The
+    archive is not ordered by time, so the points in a time range are
+    always read from the database.
+    """
+    if trip_archive is not None and time_range is None:
+        version = db_trip_version_fetch(g.db, trip_id)
+        if version is not None:
+            trip_points = trip_archive.trip_points(
+                g.db, trip_id, version[0], coord_range,
+                get_display_range(g.db, m_per_pix), epoch_time=epoch_time)
+            if trip_points is not None:
+                return trip_points
+    return db_trip_points_fetch(g.db, trip_id, coord_range, m_per_pix,
+                                epoch_time=epoch_time,
+                                time_range=time_range)
+
+def encode_depths(depths, columnar):
+    """
+    Encode depth rows. Returns an iterable over the chunks of the
+    response body.
+    """
+    if columnar:
+        return [columns.encode_columns(depths, depth_columns)]
+    return json_stream({}, "depths", depths)
+
+def encode_trip_points(trip_id, trip_points, columnar):
+    """
+    Encode trip point rows. Returns an iterable over the chunks of
+    the response body.
+    """
+    if columnar:
+        return [columns.encode_columns(trip_points, trip_point_columns,
+                                       trip_id=trip_id)]
+    return json_stream({ "trip_id": trip_id }, "points", trip_points)
+
+def encode_grid_cells(cells, grid):
+    """
+    Encode depth grid cells into the columnar format, with the size
+    of the cells in degrees.
+    """
+    rows = ({ "cell_lat": cell["cell_lat"],
+              "cell_lon": cell["cell_lon"],
+              "min": decimeters(cell["min"]),
+              "mean": decimeters(cell["mean"]),
+              "count": cell["count"] } for cell in cells)
+    return columns.encode_columns(rows, grid_cell_columns,
+                                  range=grid["range"],
+                                  lat_size=grid["lat_range"] * grid["merge"],
+                                  lon_size=grid["lon_range"] * grid["merge"])
+
+def decimeters(depth):
+    return min(max(int(round(depth * 10.0)), 0), 65535)
+
+def json_stream(fields, list_name, rows, chunk_size=65536):
+    """
+    Encode a JSON object with the items of fields and the list rows
+    under the key list_name. The rows are encoded one at a time, and
+    the output is yielded in chunks of about chunk_size bytes.
+    """
+    head = json.dumps(fields)[:-1]
+    parts = [head + (", " if fields else "") + json.dumps(list_name) + ": ["]
+    size = 0
+    separator = ""
+
+    for row in rows:
+        part = separator + json.dumps(row)
+        parts.append(part)
+        size += len(part)
+        separator = ", "
+        if size >= chunk_size:
+            yield "".join(parts)
+            parts = []
+            size = 0
+
+    parts.append("]}")
+    yield "".join(parts)
+
+def data_changed(trip_id, areas):
+    """
+    Called when the loader has changed the data of a trip: drop the
+    cached tiles and export the trip into the trip archive. The tiles
+    are keyed by data version, so this only frees the space of the
+    tiles that can no longer be served.
+    """
+    invalidate_tiles(trip_id, areas)
+    if trip_archive is None:
+        return
+    db = db_pool.getconn()
+    try:
+        trip_archive.export(db, trip_id)
+    except Exception:
+        # The files are exported when they are first read.
+        app.logger.exception("Exporting trip {} failed".format(trip_id))
+        db.rollback()
+    finally:
+        db_pool.putconn(db)
+
+def trip_tile_kind(trip_id):
+    return "trip-{}".format(trip_id)
+
+def invalidate_tiles(trip_id, areas):
+    """
+    Drop the cached tiles of a trip, and the cached depth tiles that
+    overlap with areas.
+    """
+    tile_cache.invalidate_kind(trip_tile_kind(trip_id))
+    for area in areas:
+        invalidate_depth_tiles(area)
+
+def invalidate_depth_tiles(area):
+    """Drop the cached depth data, statistics and grid tiles in area."""
+    tile_cache.invalidate_area("depth", area)
+    tile_cache.invalidate_area("depth_stats", area)
+    tile_cache.invalidate_area("depth_grid", area)
+
+def get_display_ranges(db):
+    global display_ranges
+    generation = request_generation(db)
+    (ranges_generation, ranges) = display_ranges
+    if ranges_generation != generation:
+        ranges = db_display_ranges_fetch(db)
+        display_ranges = (generation, ranges)
+    return ranges
+
+def display_range_margin(db):
+    """
+    Return the latitude and longitude distances within which a change
+    of one position can affect the display ranges of other positions:
+    two cells of the largest display range.
+    """
+    ranges = get_display_ranges(db)
+    return (2.0 * max([r[1] for r in ranges] or [0]),
+            2.0 * max([r[2] for r in ranges] or [0]))
+
+def get_display_range(db, m_per_pix):
+    """
+    Return the display range for a meters per pixel value. This does
+    the same as the get_display_range SQL function.
+    """
+    return max([r[0] for r in get_display_ranges(db)
+                if r[0] < m_per_pix] or [0])
+
+def get_track_range(db, m_per_pix):
+    """
+    Return the display range of the simplified track for a meters per
+    pixel value. The tracks are stored only for the display ranges,
+    so the smallest range is used below them.
+    """
+    return get_display_range(db, m_per_pix) or \
+        min([r[0] for r in get_display_ranges(db)] or [0])
+
 def fetch_coord_range(mandatory=False):
     """
     Pick the latitude range from the request.
@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import math
+import os
+import platform
+import pwd
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+
+import nmea_file_loader
+
+from nmea_parser import checksum
+from nmea_file_loader import do_file_loading, update_display_ranges, \
+    bump_data_version, fetch_trip_area, db_conn
+from nmea_batch_import import BatchContext, rate
+from tile_cache import tile_range, tile_xy, tile_m_per_pix, \
+    EQUATOR_M_PER_PIX
+from track import LAT_DEG_TO_METERS
+
+# Benchmarks of loading, display range computation and the data API.
+#
+# Synthetic NMEA logs are loaded into a throwaway PostgreSQL instance
+# created with the scripts in db/, and the API endpoints are requested
+# at a range of zoom levels through the Flask test client, with the
+# tile cache disabled. The results are written as JSON, and two
+# result files can be compared with --compare.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+DB_DIR = os.path.join(REPO_DIR, "db")
+
+DB_NAME = "locadb"
+DB_USER = "loca"
+# The scratch instance trusts local connections; the password is not
+# checked.
+DB_PASSWORD = "benchmark"
+USER_EMAIL = "benchmark@localhost"
+TRIP_DATE = "2013-06-01"
+
+# Where the synthetic trips start, and the first timestamp.
+ORIGIN = (60.15, 24.95)
+START_SECONDS = 6 * 3600
+
+KNOTS_TO_MS = 1852.0 / 3600.0
+
+# Size in pixels of the map view of the area queries.
+VIEW_PIXELS = (1280, 800)
+
+class BenchmarkError(Exception):
+    pass
+
+class ScratchDatabase:
+    """
+    A throwaway PostgreSQL instance in work_dir, listening on port,
+    with the database, schema and an application user set up as the
+    scripts in db/ do. The libpq environment variables are set so that
+    psql and psycopg2 connect to it.
+    """
+    def __init__(self, work_dir, port):
+        self.work_dir = work_dir
+        self.pg_dir = os.path.join(work_dir, "pgdata")
+        self.port = port
+        self.log_file = os.path.join(work_dir, "setup.log")
+        self.started = False
+
+    def run(self, args):
+        with open(self.log_file, "a") as log:
+            if subprocess.call(args, cwd=DB_DIR, stdout=log,
+                               stderr=subprocess.STDOUT) != 0:
+                raise BenchmarkError("{} failed, see {}"
+                                     .format(" ".join(args),
+                                             self.log_file))
+
+    def start(self):
+        self.run(["bash", "create_postgresql_instance.sh", self.pg_dir])
+        with open(os.path.join(self.pg_dir, "postgresql.conf"),
+                  "a") as conf:
+            conf.write("port = {}\n".format(self.port))
+            conf.write("listen_addresses = 'localhost'\n")
+        os.environ["PGHOST"] = "localhost"
+        os.environ["PGPORT"] = str(self.port)
+        self.run(["bash", "postgresql_ctl.sh", self.pg_dir, "start"])
+        self.started = True
+
+        # The superuser of a new instance is the user running initdb.
+        self.run(["psql", "-d", "postgres",
+                  "-U", pwd.getpwuid(os.getuid()).pw_name,
+                  "-f", "sql/setup_db.sql"])
+        # setup_schema.sh continues past errors; so does this.
+        self.run(["bash", "setup_schema.sh"])
+        self.run(["psql", "-d", DB_NAME, "-U", DB_USER, "-c",
+                  "INSERT INTO users (user_email) VALUES ('{}')"
+                  .format(USER_EMAIL)])
+
+    def stop(self):
+        if self.started:
+            self.run(["pg_ctl", "-D", self.pg_dir, "-m", "fast", "-w",
+                      "stop"])
+            self.started = False
+
+def nmea_sentence(sentence):
+    return "${0}*{1:02X}\r\n".format(sentence, checksum(sentence))
+
+def nmea_coord(value, deg_nums):
+    """Format a coordinate as NMEA degrees and minutes."""
+    degrees = int(abs(value))
+    minutes = (abs(value) - degrees) * 60.0
+    return "{0:0{1}d}{2:07.4f}".format(degrees, deg_nums, minutes)
+
+def seabed_depth(lat, lon):
+    """A smooth, made-up depth for a position, in meters."""
+    return 18.0 + 12.0 * math.sin(lat * 400.0) * math.cos(lon * 200.0)
+
+def synthetic_log(output, positions, interval, instrument_rate, seed):
+    """
+    Write a synthetic NMEA log of a boat sailing from ORIGIN. There is
+    one $GPGLL position every interval seconds, and after each one
+    instrument_rate rounds of depth, wind, water speed and course
+    sentences, as instruments report more often than the GPS. Returns
+    the number of lines written.
+    """
+    rnd = random.Random(seed)
+    (lat, lon) = ORIGIN
+    heading = rnd.uniform(0.0, 360.0)
+    speed = rnd.uniform(4.0, 7.0)
+    wind_angle = rnd.uniform(0.0, 360.0)
+    seconds = START_SECONDS
+    lines = 0
+    for i in xrange(positions):
+        ts = "{0:02d}{1:02d}{2:02d}".format(seconds / 3600 % 24,
+                                            seconds / 60 % 60,
+                                            seconds % 60)
+        output.write(nmea_sentence("GPGLL,{0},{1},{2},{3},{4},A,A"
+                                   .format(nmea_coord(lat, 2),
+                                           "N" if lat >= 0 else "S",
+                                           nmea_coord(lon, 3),
+                                           "E" if lon >= 0 else "W",
+                                           ts)))
+        lines += 1
+        for j in xrange(instrument_rate):
+            depth = max(seabed_depth(lat, lon) + rnd.gauss(0.0, 0.3), 0.5)
+            wind_speed = max(rnd.gauss(12.0, 3.0), 0.0)
+            output.write(nmea_sentence("IIDBT,,,{0:.1f},M,,"
+                                       .format(depth)))
+            output.write(nmea_sentence("IIMWV,{0:.0f},R,{1:.1f},N,A"
+                                       .format((wind_angle - heading)
+                                               % 360.0,
+                                               wind_speed)))
+            output.write(nmea_sentence("IIMWV,{0:.0f},T,{1:.1f},N,A"
+                                       .format(wind_angle,
+                                               wind_speed * 0.8)))
+            output.write(nmea_sentence("IIVHW,,,,,{0:.1f},N,{1:.1f},K"
+                                       .format(speed, speed * 1.852)))
+            output.write(nmea_sentence("IIVTG,{0:.2f},T,,M,{1:.2f},N,,,A"
+                                       .format(heading, speed)))
+            lines += 5
+
+        heading = (heading + rnd.gauss(0.0, 3.0)) % 360.0
+        speed = min(max(speed + rnd.gauss(0.0, 0.2), 1.0), 9.0)
+        wind_angle = (wind_angle + rnd.gauss(0.0, 1.0)) % 360.0
+        distance = speed * KNOTS_TO_MS * interval
+        lat += distance * math.cos(math.radians(heading)) / \
+            LAT_DEG_TO_METERS
+        lon += distance * math.sin(math.radians(heading)) / \
+            (LAT_DEG_TO_METERS * math.cos(math.radians(lat)))
+        seconds += interval
+    return lines
+
+def write_logs(log_dir, args):
+    """Write the synthetic logs. Returns their file names."""
+    os.mkdir(log_dir)
+    files = []
+    for i in xrange(args.trips):
+        input_file = os.path.join(log_dir, "trip-{0:03d}.nmea".format(i))
+        with open(input_file, "w") as output:
+            synthetic_log(output, args.positions, args.interval,
+                          args.instrument_rate, args.seed + i)
+        files.append(input_file)
+    return files
+
+def load_trips(db, files):
+    """
+    Load the logs, each into a new trip, and compute the display
+    ranges of each trip after loading it. Returns the timings of the
+    trips.
+    """
+    trips = []
+    for (i, input_file) in enumerate(files):
+        input_info = argparse.Namespace(input_file=input_file,
+                                        trip_id=None,
+                                        append=False,
+                                        user_email=USER_EMAIL,
+                                        trip_name="Benchmark {}"
+                                        .format(i + 1),
+                                        vessel_name="",
+                                        trip_date=TRIP_DATE)
+        context = BatchContext()
+        start = time.time()
+        if not do_file_loading(db, input_info,
+                               context=context,
+                               update_ranges=False):
+            raise BenchmarkError("Loading {} failed: {}"
+                                 .format(input_file,
+                                         context.get_error_msgs()))
+        load_seconds = time.time() - start
+
+        start = time.time()
+        update_display_ranges(db, context.trip_id)
+        bump_data_version(db, context.trip_id)
+        db.commit()
+        ranges_seconds = time.time() - start
+
+        trips.append({"trip_id": context.trip_id,
+                      "lines": context.lines,
+                      "rows": context.rows,
+                      "load_seconds": load_seconds,
+                      "ranges_seconds": ranges_seconds})
+        print("Trip {}: {} lines in {:.2f} s ({:.0f} lines/s), "
+              "display ranges in {:.2f} s"
+              .format(context.trip_id, context.lines, load_seconds,
+                      rate(context.lines, load_seconds), ranges_seconds))
+
+    analyze_cursor = db.cursor()
+    analyze_cursor.execute("ANALYZE")
+    analyze_cursor.close()
+    db.commit()
+    return trips
+
+def load_summary(trips):
+    lines = sum(trip["lines"] for trip in trips)
+    rows = sum(trip["rows"] for trip in trips)
+    seconds = sum(trip["load_seconds"] for trip in trips)
+    return {"lines": lines,
+            "rows": rows,
+            "seconds": seconds,
+            "lines_per_s": rate(lines, seconds),
+            "rows_per_s": rate(rows, seconds)}
+
+def ranges_summary(trips):
+    seconds = [trip["ranges_seconds"] for trip in trips]
+    return {"seconds": sum(seconds),
+            "max_seconds": max(seconds)}
+
+def total_area(db, trip_ids):
+    areas = [area for area in (fetch_trip_area(db, trip_id)
+                               for trip_id in trip_ids)
+             if area]
+    if not areas:
+        raise BenchmarkError("The trips have no positions")
+    return {"lat0": min(area["lat0"] for area in areas),
+            "lat1": max(area["lat1"] for area in areas),
+            "lon0": min(area["lon0"] for area in areas),
+            "lon1": max(area["lon1"] for area in areas)}
+
+def api_client(work_dir):
+    """
+    Set up the application against the scratch database and return a
+    test client. Must be called only once.
+    """
+    config_file = os.path.join(work_dir, "flk_benchmark_config.py")
+    with open(config_file, "w") as config:
+        config.write("DB_NAME = {!r}\n".format(DB_NAME))
+        config.write("DB_USERNAME = {!r}\n".format(DB_USER))
+        config.write("DB_PASSWORD = {!r}\n".format(DB_PASSWORD))
+        config.write("SECRET_KEY = 'benchmark'\n")
+        config.write("LOGIN_DISABLED = True\n")
+        config.write("TILE_CACHE_MAX_BYTES = 0\n")
+        config.write("TILE_CACHE_DIR = None\n")
+        config.write("UPLOAD_WORKERS = 0\n")
+    os.environ["FLK_CONFIG"] = config_file
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    from flaska import app
+    return app.test_client()
+
+def view_area(center, z):
+    """The area of a map view of VIEW_PIXELS at zoom z around center."""
+    m_per_pix = EQUATOR_M_PER_PIX * math.cos(math.radians(center[0])) / \
+        2 ** z
+    half_lat = VIEW_PIXELS[1] * m_per_pix / 2.0 / LAT_DEG_TO_METERS
+    half_lon = VIEW_PIXELS[0] * m_per_pix / 2.0 / \
+        (LAT_DEG_TO_METERS * math.cos(math.radians(center[0])))
+    return {"lat0": center[0] - half_lat,
+            "lat1": center[0] + half_lat,
+            "lon0": center[1] - half_lon,
+            "lon1": center[1] + half_lon}
+
+def api_requests(area, trip_ids, zooms, max_tiles, formats, seed):
+    """
+    Return the requests to time as (endpoint, format, zoom, path)
+    tuples: the tiles over the area at each zoom level, at most
+    max_tiles of them, a map view at the center of the area and the
+    tracks of the trips.
+    """
+    rnd = random.Random(seed)
+    center = ((area["lat0"] + area["lat1"]) / 2.0,
+              (area["lon0"] + area["lon1"]) / 2.0)
+    requests = []
+    for z in zooms:
+        (x0, x1, y0, y1) = tile_range(z, area)
+        tiles = [(x, y)
+                 for x in xrange(x0, x1 + 1)
+                 for y in xrange(y0, y1 + 1)]
+        if len(tiles) > max_tiles:
+            tiles = rnd.sample(tiles, max_tiles)
+        m_per_pix = tile_m_per_pix(z, *tile_xy(z, *center))
+
+        for data_format in formats:
+            query = "?format=columns" if data_format == "columns" else ""
+            for (i, (x, y)) in enumerate(tiles):
+                requests.append(("depth_data/tile", data_format, z,
+                                 "/api/1/depth_data/tile/{}/{}/{}{}"
+                                 .format(z, x, y, query)))
+                requests.append(("trip/tile", data_format, z,
+                                 "/api/1/trip/{}/tile/{}/{}/{}{}"
+                                 .format(trip_ids[i % len(trip_ids)],
+                                         z, x, y, query)))
+            params = dict(view_area(center, z), mPerPix=m_per_pix)
+            if data_format == "columns":
+                params["format"] = "columns"
+            requests.append(("depth_data", data_format, z,
+                             "/api/1/depth_data/?" +
+                             urllib.urlencode(sorted(params.items()))))
+
+        for (x, y) in tiles:
+            requests.append(("depth_stats/tile", "json", z,
+                             "/api/1/depth_stats/tile/{}/{}/{}"
+                             .format(z, x, y)))
+        for trip_id in trip_ids:
+            requests.append(("trip/track", "json", z,
+                             "/api/1/trip/{}/track?mPerPix={}"
+                             .format(trip_id, m_per_pix)))
+    return requests
+
+def time_request(client, path):
+    """Request path. Returns (status, seconds, body size)."""
+    start = time.time()
+    response = client.get(path)
+    size = len(response.get_data())
+    seconds = time.time() - start
+    response.close()
+    return (response.status_code, seconds, size)
+
+def percentile(values, p):
+    """The p'th percentile of sorted values, by the nearest rank."""
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+def time_api(client, requests, rounds):
+    """
+    Make the requests once to warm up the database caches, then
+    rounds times timed. Returns the statistics for each endpoint,
+    format and zoom level.
+    """
+    for (endpoint, data_format, z, path) in requests:
+        time_request(client, path)
+
+    timings = {}
+    for i in xrange(rounds):
+        for (endpoint, data_format, z, path) in requests:
+            timings.setdefault((endpoint, data_format, z), []).append(
+                time_request(client, path))
+
+    stats = []
+    for key in sorted(timings):
+        (endpoint, data_format, z) = key
+        seconds = sorted(t[1] for t in timings[key])
+        sizes = [t[2] for t in timings[key]]
+        stats.append({"endpoint": endpoint,
+                      "format": data_format,
+                      "zoom": z,
+                      "requests": len(timings[key]),
+                      "errors": len([t for t in timings[key]
+                                     if t[0] != 200]),
+                      "p50_ms": percentile(seconds, 50) * 1000.0,
+                      "p99_ms": percentile(seconds, 99) * 1000.0,
+                      "mean_ms": sum(seconds) / len(seconds) * 1000.0,
+                      "mean_bytes": sum(sizes) / len(sizes),
+                      "max_bytes": max(sizes)})
+    return stats
+
+def print_api_stats(stats):
+    print("{:18} {:7} {:>4} {:>6} {:>9} {:>9} {:>10} {:>6}"
+          .format("endpoint", "format", "zoom", "reqs", "p50 ms",
+                  "p99 ms", "mean bytes", "errors"))
+    for s in stats:
+        print("{:18} {:7} {:4d} {:6d} {:9.2f} {:9.2f} {:10d} {:6d}"
+              .format(s["endpoint"], s["format"], s["zoom"],
+                      s["requests"], s["p50_ms"], s["p99_ms"],
+                      s["mean_bytes"], s["errors"]))
+
+def source_revision():
+    try:
+        with open(os.devnull, "w") as null:
+            return subprocess.check_output(["git", "describe", "--always",
+                                            "--dirty"],
+                                           cwd=REPO_DIR,
+                                           stderr=null).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def server_version(db):
+    version_cursor = db.cursor()
+    version_cursor.execute("SHOW server_version")
+    version = version_cursor.fetchone()[0]
+    version_cursor.close()
+    return version
+
+def run_benchmark(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="loca-bench-")
+    scratch = ScratchDatabase(work_dir, args.port)
+    try:
+        print("Setting up PostgreSQL in {} ...".format(work_dir))
+        scratch.start()
+
+        print("Writing {} synthetic logs ...".format(args.trips))
+        files = write_logs(os.path.join(work_dir, "nmea"), args)
+
+        db = db_conn(DB_NAME, DB_USER, DB_PASSWORD)
+        trips = load_trips(db, files)
+        trip_ids = [trip["trip_id"] for trip in trips]
+        area = total_area(db, trip_ids)
+        results = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "revision": source_revision(),
+                   "python": platform.python_version(),
+                   "postgresql": server_version(db),
+                   "parameters": {"trips": args.trips,
+                                  "positions": args.positions,
+                                  "interval": args.interval,
+                                  "instrument_rate": args.instrument_rate,
+                                  "zooms": args.zooms,
+                                  "max_tiles": args.max_tiles,
+                                  "rounds": args.rounds,
+                                  "seed": args.seed,
+                                  "numpy": nmea_file_loader.use_numpy},
+                   "trips": trips,
+                   "load": load_summary(trips),
+                   "display_ranges": ranges_summary(trips)}
+        db.close()
+
+        print("Timing the API ...")
+        requests = api_requests(area, trip_ids, args.zooms,
+                                args.max_tiles, args.formats, args.seed)
+        results["api"] = time_api(api_client(work_dir), requests,
+                                  args.rounds)
+    finally:
+        scratch.stop()
+        if args.keep or args.work_dir:
+            print("The instance and the logs are in {}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("Loading: {lines} lines in {seconds:.2f} s, "
+          "{lines_per_s:.0f} lines/s, {rows_per_s:.0f} rows/s"
+          .format(**results["load"]))
+    print("Display ranges: {seconds:.2f} s in total, "
+          "{max_seconds:.2f} s at most per trip"
+          .format(**results["display_ranges"]))
+    print_api_stats(results["api"])
+    return results
+
+def ratio(old, new):
+    return "{:.2f}x".format(float(new) / old) if old else "-"
+
+def compare(old, new):
+    """Print the results of two runs side by side."""
+    print("{:42} {:>10} {:>10} {:>7}".format("", "old", "new", "new/old"))
+    for (name, section, key) in (("load lines/s", "load", "lines_per_s"),
+                                 ("load rows/s", "load", "rows_per_s"),
+                                 ("display ranges s", "display_ranges",
+                                  "seconds")):
+        (a, b) = (old[section][key], new[section][key])
+        print("{:42} {:10.2f} {:10.2f} {:>7}".format(name, a, b,
+                                                    ratio(a, b)))
+
+    old_api = dict(((s["endpoint"], s["format"], s["zoom"]), s)
+                   for s in old["api"])
+    for s in new["api"]:
+        key = (s["endpoint"], s["format"], s["zoom"])
+        if key not in old_api:
+            continue
+        for stat in ("p50_ms", "p99_ms", "mean_bytes"):
+            (a, b) = (old_api[key][stat], s[stat])
+            print("{:42} {:10.2f} {:10.2f} {:>7}"
+                  .format("{} {} z{} {}".format(s["endpoint"], s["format"],
+                                                s["zoom"], stat),
+                          a, b, ratio(a, b)))
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading, "
+                                     "display range computation and the "
+                                     "data API with synthetic NMEA logs in "
+                                     "a throwaway PostgreSQL instance.")
+    parser.add_argument('-t', '--trips', dest="trips", type=int,
+                        default=4,
+                        help="Number of trips to load")
+    parser.add_argument('-n', '--positions', dest="positions", type=int,
+                        default=20000,
+                        help="Number of positions in each trip")
+    parser.add_argument('-i', '--interval', dest="interval", type=int,
+                        default=2,
+                        help="Seconds between positions")
+    parser.add_argument('-r', '--instrument-rate', dest="instrument_rate",
+                        type=int, default=2,
+                        help="Rounds of instrument sentences after each "
+                        "position")
+    parser.add_argument('-z', '--zooms', dest="zooms", type=int_list,
+                        default=[8, 10, 12, 14, 16],
+                        help="Comma-separated zoom levels of the API "
+                        "requests")
+    parser.add_argument('--max-tiles', dest="max_tiles", type=int,
+                        default=16,
+                        help="Most tiles requested at each zoom level")
+    parser.add_argument('--formats', dest="formats",
+                        type=lambda value: value.split(","),
+                        default=["json", "columns"],
+                        help="Comma-separated data formats to request")
+    parser.add_argument('--rounds', dest="rounds", type=int, default=3,
+                        help="Number of timed rounds of API requests")
+    parser.add_argument('--seed', dest="seed", type=int, default=1,
+                        help="Seed of the synthetic data")
+    parser.add_argument('--per-line', dest="per_line",
+                        action="store_true",
+                        help="Load without the NumPy conversion")
+    parser.add_argument('--port', dest="port", type=int, default=54329,
+                        help="Port of the throwaway PostgreSQL instance")
+    parser.add_argument('--work-dir', dest="work_dir",
+                        help="An empty directory for the PostgreSQL "
+                        "instance and the logs. It is kept. By default a "
+                        "temporary directory is used and removed")
+    parser.add_argument('--keep', dest="keep", action="store_true",
+                        help="Keep the temporary directory")
+    parser.add_argument('-o', '--output', dest="output",
+                        help="File to write the results to as JSON")
+    parser.add_argument('--compare', dest="compare", nargs=2,
+                        metavar=("OLD", "NEW"),
+                        help="Compare two result files instead of "
+                        "running the benchmark")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        sys.exit(0)
+
+    if args.per_line:
+        nmea_file_loader.use_numpy = False
+
+    try:
+        results = run_benchmark(args)
+    except BenchmarkError,ex:
+        sys.stderr.write("{}\n".format(ex))
+        sys.exit(1)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print("Results written to {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import array
+import json
+import struct
+import sys
+
+# Compact columnar encoding for lists of data points.
+#
+# The encoded data consists of:
+#
+# - The magic string "LOCA".
+# - The length of the header as a little-endian uint32.
+# - The header, a JSON object with the keys "count" (number of rows),
+#   "columns" (a list of {"name", "type", "offset", "length"}
+#   objects) and any extra information given by the caller.
+# - Padding to a multiple of 8 bytes.
+# - The column data. Offsets in the header are counted from the start
+#   of the column data, and each column starts at a multiple of 8
+#   bytes so that it can be used as a typed array in the browser.
+#
+# Numbers are little-endian. NULL values are encoded as 0 in integer
+# columns and NaN in floating point columns. A "bits" column is a
+# bitset with the value of row i in bit (i % 8) of byte (i / 8).
+
+MIMETYPE = "application/x-loca-columns"
+
+UINT16 = "uint16"
+INT32 = "int32"
+UINT32 = "uint32"
+FLOAT32 = "float32"
+FLOAT64 = "float64"
+BITS = "bits"
+
+typecodes = { UINT16: "H",
+              INT32: "i",
+              UINT32: "I",
+              FLOAT32: "f",
+              FLOAT64: "d" }
+
+null_values = { UINT16: 0,
+                INT32: 0,
+                UINT32: 0,
+                FLOAT32: float("nan"),
+                FLOAT64: float("nan") }
+
+class ColumnRows:
+    """
+    Rows held as columns: values is a dict of lists of count values by
+    the column name. Iterating gives the rows as dicts; encode_columns
+    encodes the lists without making the rows.
+    """
+    def __init__(self, values, count):
+        self.values = values
+        self.count = count
+
+    def __iter__(self):
+        names = self.values.keys()
+        for i in xrange(self.count):
+            yield dict((name, self.values[name][i]) for name in names)
+
+def encode_columns(rows, columns, **info):
+    """
+    Encode rows (dicts, or ColumnRows) into the columnar format.
+    columns is a list of (name, type) tuples that selects the encoded
+    values.
+    """
+    if isinstance(rows, ColumnRows):
+        return encode_data([column_data(rows.values[name], column_type)
+                            for (name, column_type) in columns],
+                           rows.count, columns, info)
+
+    data = [bytearray() if column_type == BITS
+            else array.array(typecodes[column_type])
+            for (name, column_type) in columns]
+    count = 0
+
+    for row in rows:
+        byte_index = count >> 3
+        bit = 1 << (count & 7)
+        for (i, (name, column_type)) in enumerate(columns):
+            value = row[name]
+            if column_type == BITS:
+                if byte_index == len(data[i]):
+                    data[i].append(0)
+                if value:
+                    data[i][byte_index] |= bit
+            else:
+                data[i].append(null_values[column_type] if value is None
+                               else value)
+        count += 1
+
+    return encode_data(data, count, columns, info)
+
+def column_data(values, column_type):
+    """Return the data of a column from a list of values."""
+    if column_type == BITS:
+        data = bytearray((len(values) + 7) >> 3)
+        for (i, value) in enumerate(values):
+            if value:
+                data[i >> 3] |= 1 << (i & 7)
+        return data
+    null = null_values[column_type]
+    return array.array(typecodes[column_type],
+                       [null if value is None else value
+                        for value in values])
+
+def encode_data(data, count, columns, info):
+    """Encode the data of the columns, with the header."""
+    blocks = []
+    header_columns = []
+    offset = 0
+    for ((name, column_type), values) in zip(columns, data):
+        if column_type == BITS:
+            block = str(values)
+        else:
+            if sys.byteorder != "little":
+                values.byteswap()
+            block = values.tostring()
+        header_columns.append({ "name": name,
+                                "type": column_type,
+                                "offset": offset,
+                                "length": len(block) })
+        blocks.append(block)
+        blocks.append(padding(len(block)))
+        offset += len(block) + len(blocks[-1])
+
+    info.update({ "count": count,
+                  "columns": header_columns })
+    header = json.dumps(info)
+    start = "LOCA" + struct.pack("<I", len(header)) + header
+
+    return start + padding(len(start)) + "".join(blocks)
+
+def decode_header(data):
+    """
+    Decode the header of encoded data (a string or a buffer such as an
+    mmap). Returns the header, with the offsets of the columns counted
+    from the start of data.
+    """
+    if data[0:4] != "LOCA":
+        raise ValueError("Not in the columnar format")
+    (length, ) = struct.unpack("<I", data[4:8])
+    header = json.loads(data[8:8 + length])
+    start = 8 + length
+    start += len(padding(start))
+    for column in header["columns"]:
+        column["offset"] += start
+    return header
+
+def padding(length):
+    return "\0" * (-length % 8)
@@ -0,0 +1,176 @@
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from profiling import timer
+
+# A thread-safe pool of PostgreSQL connections.
+
+class PoolError(Exception):
+    pass
+
+class ConnectionPool:
+    """
+    A pool of database connections shared by the request threads.
+
+    min_size connections are opened when the pool is used for the
+    first time; at most max_size connections are open at any time.
+    A connection that has been idle for more than health_check_idle
+    seconds is tested before it is handed out, and connections older
+    than max_lifetime seconds are closed and replaced. getconn waits
+    at most timeout seconds for a free connection. The connections are
+    opened with connection_factory if it is given.
+    """
+
+    def __init__(self, connect_string,
+                 min_size=1,
+                 max_size=10,
+                 max_lifetime=3600,
+                 health_check_idle=30,
+                 timeout=10,
+                 connection_factory=None):
+        self.connect_string = connect_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.health_check_idle = health_check_idle
+        self.timeout = timeout
+        self.connection_factory = connection_factory
+
+        self.cond = threading.Condition()
+        self.filled = False
+        # Idle connections as (connection, returned at) tuples, the
+        # most recently returned last.
+        self.idle = []
+        # Creation times of all open connections.
+        self.created = {}
+        # Connections being opened at the moment.
+        self.opening = 0
+
+    def getconn(self):
+        if not self.filled:
+            self.fill()
+
+        deadline = time.time() + self.timeout
+        while True:
+            with self.cond:
+                conn = None
+                while conn is None:
+                    if self.idle:
+                        (conn, returned) = self.idle.pop()
+                    elif len(self.created) + self.opening < self.max_size:
+                        self.opening += 1
+                        break
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise PoolError("No free database connections")
+                        self.cond.wait(remaining)
+
+            if conn is None:
+                return self.connect()
+            if self.usable(conn, returned):
+                return conn
+            self.discard(conn)
+
+    def putconn(self, conn):
+        """Return a connection to the pool."""
+        if not self.reset(conn) or self.expired(conn):
+            self.discard(conn)
+            return
+
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def fill(self):
+        """
+        Open connections up to min_size. If a connection cannot be
+        opened, the pool is filled again on the next getconn.
+        """
+        with self.cond:
+            if self.filled:
+                return
+            self.filled = True
+            count = max(self.min_size - len(self.created) - self.opening, 0)
+            self.opening += count
+
+        for i in xrange(count):
+            try:
+                conn = self.connect()
+            except:
+                # connect has given back its own slot, but not the
+                # ones that were not tried yet.
+                with self.cond:
+                    self.opening -= count - i - 1
+                    self.filled = False
+                    self.cond.notify_all()
+                raise
+            self.putconn(conn)
+
+    def connect(self):
+        """Open a new connection for a slot reserved in self.opening."""
+        try:
+            with timer("connect"):
+                conn = psycopg2.connect(
+                    self.connect_string,
+                    connection_factory=self.connection_factory)
+        except:
+            with self.cond:
+                self.opening -= 1
+                self.cond.notify()
+            raise
+
+        with self.cond:
+            self.opening -= 1
+            self.created[conn] = time.time()
+        return conn
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+        with self.cond:
+            self.created.pop(conn, None)
+            self.cond.notify()
+
+    def expired(self, conn):
+        created = self.created.get(conn, 0)
+        return time.time() - created > self.max_lifetime
+
+    def reset(self, conn):
+        """
+        Roll back any transaction left open on conn. Return False if
+        the connection is no longer usable.
+        """
+        if conn.closed:
+            return False
+
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def usable(self, conn, returned):
+        if conn.closed or self.expired(conn):
+            return False
+        if time.time() - returned < self.health_check_idle:
+            return True
+
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
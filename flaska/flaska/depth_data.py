@@ -1,20 +1,100 @@
 
+import itertools
+import math
+
 import psycopg2
 import psycopg2.extras
 
 # This file contains postgresql-specific database code.
 # Web server specific code should not end up in this file.
 
-trip_data_stmt_base = "SELECT " \
+trip_data_columns = \
 "t.id AS t_id, " \
 "t.trip_name AS trip_name, " \
 "to_char(t.trip_date, 'YYYY-MM-DD') AS trip_date, " \
 "t.vessel_name AS vessel_name, " \
-"u.user_email AS user_email " \
+"u.user_email AS user_email "
+
+trip_data_stmt_base = "SELECT " + trip_data_columns + \
 "FROM trip t " \
 "JOIN users u " \
 "ON t.user_id = u.id "
 
+# The trip data with the summary of the positions and depths.
+trip_summary_stmt_base = "SELECT " + trip_data_columns + ", " \
+"s.lat0 AS lat0, " \
+"s.lat1 AS lat1, " \
+"s.lon0 AS lon0, " \
+"s.lon1 AS lon1, " \
+"to_char(s.start_time, 'YYYYMMDDHH24MISS') AS start_time, " \
+"to_char(s.end_time, 'YYYYMMDDHH24MISS') AS end_time, " \
+"s.position_count AS position_count, " \
+"s.depth_count AS depth_count, " \
+"s.min_depth AS min_depth, " \
+"s.max_depth AS max_depth " \
+"FROM trip t " \
+"JOIN users u " \
+"ON t.user_id = u.id " \
+"LEFT JOIN trip_summary s " \
+"ON s.trip_id = t.id "
+
+# Condition for the trips that overlap with a bounding box. This
+# matches the trip_summary_box_idx index. The parameters are lon0,
+# lat0, lon1, lat1.
+trip_in_box_cond = \
+"box(point(s.lon0, s.lat0), point(s.lon1, s.lat1)) && " \
+"box(point(%s, %s), point(%s, %s)) "
+
+# Number of rows that a server-side cursor fetches at a time.
+STREAM_ITERSIZE = 2000
+
+# Names for the server-side cursors.
+stream_cursor_ids = itertools.count()
+
+# Bounding box condition for the position table. This matches the
+# position_point_idx index. The parameters are lon0, lat0, lon1, lat1.
+position_in_box_cond = \
+"point(p.longitude, p.latitude) <@ box(point(%s, %s), point(%s, %s)) "
+
+# Condition that limits the position and depth rows to a list of
+# trips. The position and depth tables are partitioned by trip, and
+# with the trip ids as constants in the query only the partitions of
+# those trips are read. The parameters come from
+# trip_partition_params.
+trip_partition_cond = "p.trip_id = ANY (%s) AND d.trip_id = ANY (%s) "
+
+# The display range is resolved once per query (as an InitPlan)
+# instead of once per row. The parameter is meters per pixel.
+display_range_value = "(SELECT get_display_range(%s)) "
+
+def time_column(epoch_time):
+    """
+    Return the expression for the position timestamp: either a
+    YYYYMMDDHHMISS string or seconds since the epoch.
+    """
+    if epoch_time:
+        return "extract(epoch from p.pos_time_utc)::integer "
+    return "to_char(p.pos_time_utc, 'YYYYMMDDHH24MISS') "
+
+def box_params(coord_range):
+    """Return the bind parameters for position_in_box_cond."""
+    return (coord_range["lon0"], coord_range["lat0"],
+            coord_range["lon1"], coord_range["lat1"])
+
+def trip_partition_params(db, coord_range):
+    """
+    Return the parameters for trip_partition_cond: the ids of the
+    trips whose bounding box overlaps coord_range.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT s.trip_id "
+                "FROM trip_summary s "
+                "WHERE " + trip_in_box_cond,
+                box_params(coord_range))
+    trip_ids = [row[0] for row in cur.fetchall()]
+    cur.close()
+    return (trip_ids, trip_ids)
+
 def db_connect_string(dbname, dbuser, dbpasswd):
     """
     Return the DB connection string.
@@ -30,48 +110,171 @@ def db_disconn(db):
 def db_rd_cursor(db):
     return db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-def db_depths_fetch(db, coord_range, m_per_pix):
+def db_rd_stream(db, query, params):
+    """
+    Run a query with a server-side cursor. Return an iterator over the
+    result rows (as dicts) that fetches them from the server in batches
+    of STREAM_ITERSIZE rows, so that the whole result set never needs
+    to be in memory. The transaction is committed when the iteration
+    ends.
+    """
+    cur = db.cursor(name="stream_{}".format(next(stream_cursor_ids)),
+                    cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.itersize = STREAM_ITERSIZE
+    cur.execute(query, params)
+    return db_stream_rows(db, cur)
+
+def db_stream_rows(db, cur):
+    try:
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
+        db.commit()
+
+def db_depths_fetch(db, coord_range, m_per_pix, epoch_time=False):
     """
-    Fetch depth data from the database.
+    Fetch depth data from the database. Returns an iterator over the
+    rows.
+    """
+    return db_rd_stream(db,
+                        "SELECT "
+                        "p.id as p_id, "
+                        "p.trip_id as t_id," +
+                        time_column(epoch_time) +
+                        "   as t_utc, "
+                        "p.latitude as lat, "
+                        "p.longitude as lon, "
+                        "d.depth as depth, "
+                        "d.erroneous as d_bad "
+                        "FROM position p "
+                        "JOIN depth d "
+                        "ON p.id = d.position_id "
+                        "WHERE " + position_in_box_cond +
+                        "AND " + trip_partition_cond +
+                        "AND d.display_range >= " + display_range_value +
+                        "ORDER BY p.id",
+                        box_params(coord_range) +
+                        trip_partition_params(db, coord_range) +
+                        (m_per_pix, ))
+
+# Conditions for the validity filter of the depth statistics.
+depth_validity_conds = { "all": "",
+                         "valid": "AND NOT d.erroneous ",
+                         "bad": "AND d.erroneous " }
+
+# Percentiles reported in the depth statistics.
+depth_percentiles = (5, 25, 50, 75, 95)
+
+def db_depth_stats_fetch(db, coord_range, m_per_pix, validity="all"):
+    """
+    Compute statistics of the depths that db_depths_fetch would return
+    for the same area, limited to the valid or bad measurements or
+    not (validity). Returns a dict with the number of depths, the
+    minimum and maximum, percentiles (nearest rank), and a histogram
+    with 1 m bins as a list of [upper bound, count] pairs.
+    """
+    depths = "WITH ds AS (" \
+        "SELECT d.depth " \
+        "FROM position p " \
+        "JOIN depth d " \
+        "ON p.id = d.position_id " \
+        "WHERE " + position_in_box_cond + \
+        "AND " + trip_partition_cond + \
+        "AND d.display_range >= " + display_range_value + \
+        depth_validity_conds[validity] + \
+        ") "
+    params = box_params(coord_range) + \
+        trip_partition_params(db, coord_range) + \
+        (m_per_pix, )
+
+    cur = db.cursor()
+    cur.execute(depths +
+                "SELECT n, lo, hi, " +
+                ", ".join("sorted[greatest(1, ceil({} * n / 100.0)"
+                          "::integer)]".format(percentile)
+                          for percentile in depth_percentiles) +
+                " FROM (SELECT count(*) AS n, "
+                "       min(depth) AS lo, "
+                "       max(depth) AS hi, "
+                "       array_agg(depth ORDER BY depth) AS sorted "
+                "      FROM ds) AS s",
+                params)
+    stats = cur.fetchone()
+
+    cur.execute(depths +
+                "SELECT ceil(depth)::integer AS bin, count(*) "
+                "FROM ds "
+                "GROUP BY bin "
+                "ORDER BY bin",
+                params)
+    bins = [list(row) for row in cur.fetchall()]
+    cur.close()
+    db.commit()
+
+    return { "count": stats[0],
+             "min": stats[1],
+             "max": stats[2],
+             "percentiles": dict((str(percentile), value)
+                                 for (percentile, value)
+                                 in zip(depth_percentiles, stats[3:])),
+             "bins": bins }
+
+def db_depth_grid_fetch(db, coord_range, grid):
+    """
+    Fetch the cells of the depth grid in a coordinate range. grid is a
+    dict with the display range of the cells ("range"), their size
+    ("lat_range" and "lon_range") and "merge": the cells are merged
+    into squares of merge x merge cells. Returns the cells with the
+    smallest and the mean depth and the number of depths, deepest
+    first.
     """
     cur = db_rd_cursor(db)
-    cur.execute("SELECT "
-                "p.id as p_id, "
-                "p.trip_id as t_id,"
-                "to_char(p.pos_time_utc, 'YYYYMMDDHH24MISS') "
-                "   as t_utc, "
-                "p.latitude as lat, "
-                "p.longitude as lon, "
-                "d.depth as depth, "
-                "d.erroneous as d_bad "
-                "FROM position p "
-                "JOIN depth d "
-                "ON p.id = d.position_id "
-                "WHERE p.latitude > %s and p.latitude < %s "
-                "AND p.longitude > %s and p.longitude < %s "
-                "AND d.display_range >= get_display_range(%s) "
-                "ORDER BY p.id",
-                (coord_range["lat0"], coord_range["lat1"],
-                 coord_range["lon0"], coord_range["lon1"],
-                 m_per_pix))
-    depths = cur.fetchall()
+    cur.execute("SELECT floor(cell_lat / %s::FLOAT8)::INTEGER AS cell_lat, "
+                "floor(cell_lon / %s::FLOAT8)::INTEGER AS cell_lon, "
+                "MIN(min_depth) AS min, "
+                "SUM(depth_sum) / SUM(depth_count) AS mean, "
+                "SUM(depth_count) AS count "
+                "FROM depth_grid "
+                "WHERE display_range = %s "
+                "AND cell_lat BETWEEN %s AND %s "
+                "AND cell_lon BETWEEN %s AND %s "
+                "GROUP BY 1, 2 "
+                "ORDER BY 3 DESC",
+                (grid["merge"], grid["merge"], grid["range"],
+                 int(math.floor(coord_range["lat0"] / grid["lat_range"])),
+                 int(math.floor(coord_range["lat1"] / grid["lat_range"])),
+                 int(math.floor(coord_range["lon0"] / grid["lon_range"])),
+                 int(math.floor(coord_range["lon1"] / grid["lon_range"]))))
+    cells = cur.fetchall()
     db.commit()
     cur.close()
 
-    return depths
+    return cells
 
-def db_triplist_fetch(db, limit=10):
+def db_triplist_fetch(db, limit=10, after=None, coord_range=None):
     """
-    Fetch a list of all trips from the database.
-
-    Return most recent first.
+    Fetch a page of the list of trips from the database, most recent
+    first. The list is ordered by (trip_date, id); after is the
+    (trip_date, id) of the last trip of the previous page, if any. If
+    coord_range is given, only the trips that have positions in it are
+    listed.
     """
+    conds = []
+    params = ()
+    if coord_range:
+        conds.append(trip_in_box_cond)
+        params += box_params(coord_range)
+    if after:
+        conds.append("(t.trip_date, t.id) < (%s, %s) ")
+        params += after
+
     cur = db_rd_cursor(db)
-    cur.execute(trip_data_stmt_base +
-                "ORDER BY t.trip_date DESC ")
-# \
-#                "LIMIT %s",
-#                (limit, ))
+    cur.execute(trip_summary_stmt_base +
+                ("WHERE " + "AND ".join(conds) if conds else "") +
+                "ORDER BY t.trip_date DESC, t.id DESC "
+                "LIMIT %s",
+                params + (limit, ))
     trips = cur.fetchall()
     db.commit()
     cur.close()
@@ -81,46 +284,74 @@ def db_triplist_fetch(db, limit=10):
 def db_trip_points_fetch(db,
                          trip_id,
                          coord_range,
-                         m_per_pix):
-    bind_tuple = (trip_id,
-                  m_per_pix)
+                         m_per_pix,
+                         epoch_time=False,
+                         time_range=None):
+    """
+    Fetch the points of a trip, with the measurements merged into
+    each position, from the database. Returns an iterator over the
+    rows. time_range is a (t0, t1) tuple of datetimes: only the points
+    from t0 to before t1 are fetched, in time order. Either can be
+    None.
+    """
+    time_range_cond = ""
+    time_params = ()
+    order = ""
+
+    if time_range:
+        (t0, t1) = time_range
+        if t0 is not None:
+            time_range_cond += "AND p.pos_time_utc >= %s "
+            time_params += (t0, )
+        if t1 is not None:
+            time_range_cond += "AND p.pos_time_utc < %s "
+            time_params += (t1, )
+        order = "ORDER BY p.pos_time_utc"
+
+    bind_tuple = (trip_id, ) + time_params + (m_per_pix, )
     coord_range_cond = ""
 
     if coord_range:
-        coord_range_cond = \
-            "p.latitude > %s and p.latitude < %s " \
-            "AND p.longitude > %s and p.longitude < %s AND "
-        bind_tuple = (coord_range["lat0"], coord_range["lat1"],
-                      coord_range["lon0"], coord_range["lon1"],
-                      trip_id,
-                      m_per_pix)
-
-    query = "SELECT p.id AS p_id, " \
-        "to_char(p.pos_time_utc, 'YYYYMMDDHH24MISS') AS t_utc, " \
+        coord_range_cond = position_in_box_cond + "AND "
+        bind_tuple = box_params(coord_range) + bind_tuple
+
+    # The samples are aliased as p so that the position conditions
+    # and columns apply to them.
+    query = "SELECT p.position_id AS p_id, " + \
+        time_column(epoch_time) + "AS t_utc, " \
         "p.latitude AS lat, " \
         "p.longitude AS lon, " \
-        "p.erroneous AS pos_bad, " \
-        "wsp.id AS ws_id, " \
-        "wsp.speed AS ws, " \
-        "gsc.id AS gs_id, " \
-        "gsc.speed AS gs, " \
-        "gsc.course AS course, " \
-        "gsc.erroneous AS gs_bad " \
-        "FROM position p " \
-        "JOIN water_speed wsp ON p.id = wsp.position_id " \
-        "JOIN ground_speed_course gsc ON p.id = gsc.position_id " + \
+        "p.depth AS depth, " \
+        "p.water_speed AS ws, " \
+        "p.ground_speed AS gs, " \
+        "p.course AS course " \
+        "FROM position_sample p " \
         "WHERE " + \
         coord_range_cond + \
-        "p.trip_id = %s " \
-        "AND p.display_range >= get_display_range(%s) "
+        "p.trip_id = %s " + \
+        time_range_cond + \
+        "AND p.display_range >= " + display_range_value + \
+        order
+
+    return db_rd_stream(db, query, bind_tuple)
 
+def db_trip_track_fetch(db, trip_id, display_range):
+    """
+    Fetch the simplified track of a trip for a display range. Returns
+    None if the trip has no track for the range.
+    """
     cur = db_rd_cursor(db)
-    cur.execute(query, bind_tuple)
-    points = cur.fetchall()
+    cur.execute("SELECT trip_id, display_range AS range, "
+                "point_count AS count, polyline "
+                "FROM trip_track "
+                "WHERE trip_id = %s "
+                "AND display_range = %s",
+                (trip_id, display_range))
+    track = cur.fetchone()
     db.commit()
     cur.close()
 
-    return points;
+    return track
 
 def db_trip_info_fetch(db, trip_id):
     """Fetch info for one trip from the database."""
@@ -147,6 +378,9 @@ def db_trip_info_update(db, trip_id, trip_name, trip_date, vessel_name):
                 "WHERE id = %s",
                 (trip_name, trip_date, vessel_name, trip_id))
     result = True if cur.rowcount == 1 else False
+    if result:
+        # The trip list changes.
+        cur.execute("SELECT bump_data_version(%s)", (trip_id, ))
 
     db.commit()
     cur.close()
@@ -163,12 +397,162 @@ def db_update_validityflags(db, position_id, depth_erroneous):
                 (depth_erroneous, position_id))
     if cur.rowcount != 1:
         result = False
+    else:
+        # The flag decides whether the measurement can represent its
+        # area at coarser display ranges, and whether it is in the
+        # depth grid.
+        cur.execute("SELECT update_display_ranges_near(trip_id, "
+                    "                                  ARRAY[id]), "
+                    "       depth_grid_refresh(trip_id, ARRAY[id]), "
+                    "       bump_data_version(trip_id) "
+                    "FROM position "
+                    "WHERE id = %s",
+                    (position_id, ))
 
     db.commit()
     cur.close()
 
     return result
 
+def db_display_ranges_fetch(db):
+    """
+    Fetch the display ranges, smallest first, as a list of
+    (range, lat_range, lon_range) tuples.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT range, lat_range, lon_range "
+                "FROM display_ranges "
+                "ORDER BY range")
+    ranges = cur.fetchall()
+    db.commit()
+    cur.close()
+
+    return ranges
+
+def db_position_fetch(db, position_id):
+    """Fetch the trip id and coordinates of a position."""
+    cur = db_rd_cursor(db)
+    cur.execute("SELECT trip_id, latitude AS lat, longitude AS lon "
+                "FROM position "
+                "WHERE id = %s",
+                (position_id, ))
+    position = cur.fetchone()
+    db.commit()
+    cur.close()
+
+    return position
+
+def db_data_generation_fetch(db):
+    """
+    Return the global data generation and the time of the last change
+    (seconds since the epoch, with the fraction) as a tuple. See
+    db_version_commit for the transaction.
+    """
+    idle = db_idle(db)
+    cur = db.cursor()
+    cur.execute("SELECT generation, "
+                "extract(epoch from modified)::double precision "
+                "FROM data_generation")
+    generation = cur.fetchone()
+    db_version_commit(db, idle)
+    cur.close()
+
+    return generation
+
+def db_trip_version_fetch(db, trip_id):
+    """
+    Return the data version of a trip and the time of its last change
+    (seconds since the epoch, with the fraction) as a tuple, or None if
+    there is no such trip. See db_version_commit for the transaction.
+    """
+    idle = db_idle(db)
+    cur = db.cursor()
+    cur.execute("SELECT data_version, "
+                "extract(epoch from data_modified)::double precision "
+                "FROM trip "
+                "WHERE id = %s",
+                (trip_id, ))
+    version = cur.fetchone()
+    db_version_commit(db, idle)
+    cur.close()
+
+    return version
+
+def db_idle(db):
+    """Tell whether db has no transaction open."""
+    return db.get_transaction_status() == \
+        psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+def db_version_commit(db, idle):
+    """
+    Commit the transaction of a version fetch if the fetch began it
+    (db was idle before). A version is also read after a view has
+    opened the cursor of a streamed response, and committing would
+    close that cursor.
+    """
+    if idle:
+        db.commit()
+
+def db_trip_versions_fetch(db, coord_range):
+    """
+    Return the ids and data versions of the trips whose bounding box
+    overlaps coord_range, as (trip_id, data_version) tuples.
+    """
+    cur = db.cursor()
+    cur.execute("SELECT t.id, t.data_version "
+                "FROM trip_summary s "
+                "JOIN trip t ON t.id = s.trip_id "
+                "WHERE " + trip_in_box_cond +
+                "ORDER BY t.id",
+                box_params(coord_range))
+    versions = cur.fetchall()
+    db.commit()
+    cur.close()
+
+    return versions
+
+def db_trip_archive_fetch(db, trip_id):
+    """
+    Fetch all the data of a trip for the trip archive from one
+    snapshot. Returns the data version of the trip, its points (the
+    position_sample rows) and its depths as lists of tuples ordered by
+    the position id, or None if there is no such trip.
+    """
+    db.commit()
+    cur = db.cursor()
+    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    cur.execute("SELECT data_version FROM trip WHERE id = %s", (trip_id, ))
+    version = cur.fetchone()
+    if version is None:
+        db.commit()
+        cur.close()
+        return None
+
+    cur.execute("SELECT p.position_id, "
+                "extract(epoch from p.pos_time_utc)::integer, "
+                "p.latitude, p.longitude, p.display_range, "
+                "p.depth, p.water_speed, p.ground_speed, p.course "
+                "FROM position_sample p "
+                "WHERE p.trip_id = %s "
+                "ORDER BY p.position_id",
+                (trip_id, ))
+    points = cur.fetchall()
+    cur.execute("SELECT p.id, "
+                "extract(epoch from p.pos_time_utc)::integer, "
+                "p.latitude, p.longitude, d.display_range, "
+                "d.depth, d.erroneous "
+                "FROM position p "
+                "JOIN depth d "
+                "ON p.id = d.position_id AND d.trip_id = %s "
+                "WHERE p.trip_id = %s "
+                "ORDER BY p.id, d.id",
+                (trip_id, trip_id))
+    depths = cur.fetchall()
+    db.commit()
+    cur.close()
+
+    return (version[0], points, depths)
+
 def db_load_user(db, userid):
     cur = db.cursor()
     cur.execute("SELECT user_email, auth_token FROM users WHERE "
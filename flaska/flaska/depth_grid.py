@@ -0,0 +1,168 @@
+import math
+import struct
+import zlib
+
+# Raster tiles of the depth grid.
+#
+# The depth_grid table holds the smallest and the mean of the valid
+# depths in the cells of a latitude/longitude grid for each display
+# range. A tile is drawn from the cells of one range as a palette PNG
+# image: the cells get the colour of their smallest depth on the scale
+# of the depth markers (static/depth_gradient.js). Pixels without
+# depths are transparent.
+
+TILE_SIZE = 256
+
+# The depth scale: depths of up to MAX_DEPTH meters, in steps of one
+# meter. Hues go from red to green up to HEATMAP_SPLIT meters, and
+# then on to blue.
+MAX_DEPTH = 40
+HEATMAP_SPLIT = 10
+
+# The latitude limit of the map tiles.
+MAX_LAT = 85.0511
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+def depth_palette():
+    """
+    Return the colours of the depth scale as (r, g, b) tuples. Index
+    0 is for the pixels without depths, and index i for the depths
+    from i - 1 to i meters.
+    """
+    palette = [(0, 0, 0)]
+    for i in range(MAX_DEPTH):
+        if i < HEATMAP_SPLIT:
+            hue = i * 120.0 / HEATMAP_SPLIT
+        else:
+            hue = 120.0 + i * 120.0 / MAX_DEPTH
+        palette.append(hsv_to_rgb(hue, 100.0, 100.0))
+    return palette
+
+def hsv_to_rgb(h, s, v):
+    """
+    Convert a colour from HSV (h 0 ... 360, s and v 0 ... 100) to an
+    (r, g, b) tuple, with the same arithmetic as static/hsv2rgb.js.
+    """
+    s /= 100.0
+    v /= 100.0
+    h /= 60.0
+    i = int(math.floor(h))
+    f = h - i
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    # The sectors 0 ... 5 of the hue circle; 6 is the same as 5.
+    sectors = ((v, t, p), (q, v, p), (p, v, t),
+               (p, q, v), (t, p, v), (v, p, q))
+    return tuple(int(math.floor(c * 255 + 0.5))
+                 for c in sectors[min(i, 5)])
+
+palette = depth_palette()
+
+def depth_color(depth):
+    """Return the palette index of a depth, as DepthGradient.color."""
+    return min(max(int(math.ceil(depth)), 1), len(palette) - 1)
+
+def tile_grid(display_ranges, pixel_size):
+    """
+    Choose the grid for a tile whose pixels are pixel_size meters: the
+    smallest display range that is at least a pixel. If the pixels are
+    larger than the largest range, its cells are merged into squares
+    of about a pixel. display_ranges is a list of (range, lat_range,
+    lon_range) tuples, smallest first. Returns a dict for
+    db_depth_grid_fetch, or None if there are no display ranges.
+    """
+    if not display_ranges:
+        return None
+    for (display_range, lat_range, lon_range) in display_ranges:
+        if display_range >= pixel_size:
+            merge = 1
+            break
+    else:
+        merge = int(math.ceil(pixel_size / display_range))
+    return {"range": display_range,
+            "lat_range": lat_range,
+            "lon_range": lon_range,
+            "merge": merge}
+
+def render_tile(cells, grid, z, x, y):
+    """Draw the cells of a grid in tile z, x, y as a PNG image."""
+    return encode_png(rasterize(cells, grid, z, x, y))
+
+def rasterize(cells, grid, z, x, y):
+    """
+    Draw cells into a TILE_SIZE x TILE_SIZE image of palette indices,
+    row by row. Every cell covers at least one pixel. The cells come
+    deepest first, so the shallower cells are drawn over the deeper
+    ones where they share pixels.
+    """
+    pixels = bytearray(TILE_SIZE * TILE_SIZE)
+    n = 2 ** z
+    lat_size = grid["lat_range"] * grid["merge"]
+    lon_size = grid["lon_range"] * grid["merge"]
+
+    for cell in cells:
+        (x0, x1) = pixel_span(lon_pixel(cell["cell_lon"] * lon_size, n, x),
+                              lon_pixel((cell["cell_lon"] + 1) * lon_size,
+                                        n, x))
+        (y0, y1) = pixel_span(lat_pixel((cell["cell_lat"] + 1) * lat_size,
+                                        n, y),
+                              lat_pixel(cell["cell_lat"] * lat_size, n, y))
+        if x0 is None or y0 is None:
+            continue
+        run = bytearray([depth_color(cell["min"])]) * (x1 - x0)
+        for row in xrange(y0, y1):
+            start = row * TILE_SIZE
+            pixels[start + x0:start + x1] = run
+    return pixels
+
+def lon_pixel(lon, n, x):
+    """The horizontal pixel position of a longitude in tile x."""
+    return ((lon + 180.0) / 360.0 * n - x) * TILE_SIZE
+
+def lat_pixel(lat, n, y):
+    """The vertical pixel position of a latitude in tile y."""
+    lat = math.radians(max(min(lat, MAX_LAT), -MAX_LAT))
+    return ((1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi)
+            / 2.0 * n - y) * TILE_SIZE
+
+def pixel_span(p0, p1):
+    """
+    Return the pixels first ... last - 1 covered by the positions
+    p0 ... p1 as (first, last), or (None, None) if they are outside of
+    the tile. The pixels whose centers are in the span are covered, or
+    the pixel of p0 if there are none.
+    """
+    first = int(math.floor(p0 + 0.5))
+    last = int(math.floor(p1 + 0.5))
+    if last <= first:
+        first = int(math.floor(p0))
+        last = first + 1
+    first = max(first, 0)
+    last = min(last, TILE_SIZE)
+    if first >= last:
+        return (None, None)
+    return (first, last)
+
+def encode_png(pixels):
+    """
+    Encode a TILE_SIZE x TILE_SIZE image of palette indices as an
+    8-bit palette PNG image. Index 0 is transparent.
+    """
+    rows = [pixels[i:i + TILE_SIZE]
+            for i in xrange(0, len(pixels), TILE_SIZE)]
+    # Each row starts with the filter type, 0 for none.
+    data = "".join("\0" + str(row) for row in rows)
+    return PNG_SIGNATURE + \
+        png_chunk("IHDR", struct.pack(">IIBBBBB", TILE_SIZE, TILE_SIZE,
+                                      8, 3, 0, 0, 0)) + \
+        png_chunk("PLTE", "".join(struct.pack("BBB", *color)
+                                  for color in palette)) + \
+        png_chunk("tRNS", "\0") + \
+        png_chunk("IDAT", zlib.compress(data, 6)) + \
+        png_chunk("IEND", "")
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + \
+        struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
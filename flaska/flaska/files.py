@@ -3,7 +3,8 @@ import hashlib
 import os
 import random
 
-from flask import render_template, redirect, url_for, request, g, abort
+from flask import render_template, redirect, url_for, request, g, abort, \
+    Request
 from flask_login import login_required, current_user
 from flask_wtf import Form
 from flask_wtf.file import FileField, FileRequired
@@ -12,11 +13,51 @@ from wtforms import TextField, validators
 
 from werkzeug.datastructures import FileStorage
 
-from flaska import app
+from flaska import app, upload_jobs
 from flaska.template_data import TemplateVars
-from flaska.nmea_file_loader import do_file_loading, AppContext
+from flaska.nmea_file_loader import AppContext
 from flaska.depth_data import db_trip_info_fetch, db_trip_info_update
 
+class UploadRequest(Request):
+    """
+    Request that writes the files uploaded with the upload form
+    directly into NMEA_FILE_UPLOAD_DIR as they are received, instead
+    of spooling them into a temporary file to be copied from.
+    """
+    def __init__(self, *args, **kwargs):
+        Request.__init__(self, *args, **kwargs)
+        # (file name, file object) of the files written.
+        self.upload_files = []
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if self.endpoint != "upload_form":
+            return Request._get_file_stream(self, total_content_length,
+                                            content_type, filename,
+                                            content_length)
+        upload_dir = app.config["NMEA_FILE_UPLOAD_DIR"]
+        (filename, output_f) = generate_file(upload_dir)
+        if not filename:
+            abort(500)
+        self.upload_files.append((filename, output_f))
+        return output_f
+
+    def upload_file_name(self, file_storage):
+        """Return the name of the file that file_storage was saved to."""
+        for (filename, output_f) in self.upload_files:
+            if output_f is file_storage.stream:
+                output_f.close()
+                return filename
+        return None
+
+    def discard_upload_files(self):
+        for (filename, output_f) in self.upload_files:
+            output_f.close()
+            os.remove(filename)
+        self.upload_files = []
+
+app.request_class = UploadRequest
+
 class TripDataForm(Form):
     trip_name = TextField("Name for the trip",
                           validators=[validators.length(min=4,
@@ -43,6 +84,7 @@ class InputInfo:
                  trip_date,
                  vessel_name):
         self.trip_id = 0
+        self.append = False
         self.user_email = user_email
         self.input_file = input_file
         self.trip_name = trip_name
@@ -77,32 +119,30 @@ def update_trip(trip_id):
 @app.route("/upload/", methods=['GET', 'POST'])
 @login_required
 def upload_form():
-    success_msg = None
+    job_id = None
     app_ctx = AppContext()
     form = FileUploadForm()
 
     if form.validate_on_submit():
-        (filename, output_f) = generate_file(app.config["NMEA_FILE_UPLOAD_DIR"])
+        filename = request.upload_file_name(form.data_file.data)
         if not filename:
             abort(500)
-        form.data_file.data.save(output_f)
-        output_f.close()
-
-        if do_file_loading(g.db,
-                           # TODO, should user user's id directly
-                           # and not e-mail.
-                           InputInfo(user_email=current_user.get_email(),
-                                     input_file=filename,
-                                     trip_name=form.trip_name.data,
-                                     trip_date=form.trip_date.data,
-                                     vessel_name=form.vessel_name.data),
-                           context=app_ctx):
-            success_msg = "File uploaded successfully"
-        else:
-            success_msg = app_ctx.get_log_msgs()
+
+        # The file is loaded in the background; the page follows the
+        # progress of the job.
+        input_info = InputInfo(user_email=current_user.get_email(),
+                               input_file=filename,
+                               trip_name=form.trip_name.data,
+                               trip_date=form.trip_date.data,
+                               vessel_name=form.vessel_name.data)
+        job_id = upload_jobs.submit(g.db, input_info)
+    else:
+        request.discard_upload_files()
 
     return render_template("upload_form.html",
-                           success_msg=success_msg,
+                           job_id=job_id,
+                           job_url=url_for("upload_job", job_id=job_id)
+                           if job_id else None,
                            error_msg=app_ctx.get_error_msgs(),
                            form=form,
                            vars=TemplateVars(app))
@@ -114,8 +154,8 @@ def generate_file(dirname):
     for loop in xrange(1, 10):
         h.update(str(sr.getrandbits(2048)))
         filename = "{}/{}".format(dirname, h.hexdigest())
-        fd = os.open(filename, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0644)
+        fd = os.open(filename, os.O_RDWR|os.O_CREAT|os.O_EXCL, 0644)
         if fd:
-            return (filename, os.fdopen(fd, "w"))
+            return (filename, os.fdopen(fd, "w+b"))
 
     return (None, None)
@@ -3,7 +3,53 @@ DB_NAME = "locadb"
 DB_USERNAME = "PUT_DATABASE_USER_HERE"
 DB_PASSWORD = "PUT_DATABASE_PASSWD HERE"
 
+# Database connection pool. DB_POOL_MIN_SIZE connections are kept open,
+# at most DB_POOL_MAX_SIZE are opened. Connections are replaced after
+# DB_POOL_MAX_LIFETIME seconds, and tested before use if they have been
+# idle for DB_POOL_HEALTH_CHECK_IDLE seconds. A request waits at most
+# DB_POOL_TIMEOUT seconds for a free connection.
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 10
+DB_POOL_MAX_LIFETIME = 3600
+DB_POOL_HEALTH_CHECK_IDLE = 30
+DB_POOL_TIMEOUT = 10
+
+# Uploaded files are written to NMEA_FILE_UPLOAD_DIR as they are
+# received, and loaded from there. They are kept as an archive of the
+# raw data if NMEA_FILE_ARCHIVE is True, and removed after loading
+# otherwise.
 NMEA_FILE_UPLOAD_DIR = None
+NMEA_FILE_ARCHIVE = True
+
+# Uploaded files are loaded by UPLOAD_WORKERS background threads. The
+# workers look for new jobs every UPLOAD_POLL_INTERVAL seconds, and a
+# job that has not been updated in UPLOAD_JOB_STALE_AFTER seconds is
+# taken to be abandoned and is restarted. A running job is updated at
+# least every minute, or every quarter of UPLOAD_JOB_STALE_AFTER. The
+# workers of a server process start when it handles its first request;
+# with UPLOAD_WORKERS = 0 the process leaves the jobs to others.
+UPLOAD_WORKERS = 1
+UPLOAD_POLL_INTERVAL = 5
+UPLOAD_JOB_STALE_AFTER = 3600
+
+# Cache for the depth and trip data tiles. The in-memory cache is
+# limited to TILE_CACHE_MAX_BYTES. If TILE_CACHE_DIR is set, the tiles
+# are also cached on disk in that directory.
+TILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TILE_CACHE_DIR = None
+
+# Read-side archive of the trip data. If TRIP_ARCHIVE_DIR is set, the
+# points and depths of each trip are exported into files in that
+# directory, and the depth and trip data are served from them with
+# memory mapping instead of being read from the database. The files
+# of a trip are exported again when its data changes.
+TRIP_ARCHIVE_DIR = None
+
+# Profiling of the requests. If PROFILING is True, the time spent in
+# the stages of each request (database checkout, queries, fetching,
+# serialization and rendering) is sent in a Server-Timing header and
+# collected into histograms served at /metrics.
+PROFILING = False
 
 SECRET_KEY = None
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import copy
+import glob
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from nmea_file_loader import do_file_loading, update_display_ranges, \
+    bump_data_version, db_conn, AppContext
+from trip_archive import export_trip
+
+# Load many NMEA files into the database in parallel.
+#
+# The files are loaded by a pool of worker processes, each with one
+# database connection. Every file is loaded in its own transaction,
+# as with nmea_file_loader.py. The display ranges of all the new trips
+# are computed in one run after all files have been loaded.
+
+ImportResult = collections.namedtuple("ImportResult",
+                                      ["input_file", "ok", "trip_id",
+                                       "lines", "rows", "seconds",
+                                       "errors"])
+
+class BatchContext(AppContext):
+    """Collects the results of loading one file."""
+    def __init__(self):
+        AppContext.__init__(self)
+        self.trip_id = None
+        self.lines = 0
+        self.rows = 0
+
+    def data_changed(self, trip_id, areas):
+        self.trip_id = trip_id
+
+    def progress(self, phase, lines=None, rows=None):
+        if lines is not None:
+            self.lines = lines
+        if rows is not None:
+            self.rows = rows
+
+# State of a worker process.
+worker_db = None
+worker_args = None
+
+def init_worker(args):
+    global worker_db, worker_args
+    worker_args = args
+    worker_db = db_conn(args.db_name, args.db_user, args.db_passwd)
+
+def import_file(input_file):
+    """Load one file in a worker process."""
+    input_info = copy.copy(worker_args)
+    input_info.input_file = input_file
+    input_info.trip_id = None
+    input_info.append = False
+    input_info.trip_date = worker_args.trip_date or file_trip_date(input_file)
+
+    context = BatchContext()
+    start = time.time()
+    ok = do_file_loading(worker_db, input_info,
+                         context=context,
+                         update_ranges=False)
+    return ImportResult(input_file=input_file,
+                        ok=ok,
+                        trip_id=context.trip_id,
+                        lines=context.lines,
+                        rows=context.rows,
+                        seconds=time.time() - start,
+                        errors=context.get_error_msgs())
+
+def file_trip_date(input_file):
+    """
+    Pick the trip date from a file name with a YYYY-MM-DD or YYYYMMDD
+    date, such as nmea-log.20130601.gz. Return None if there is none.
+    """
+    rm = re.search("([0-9]{4})-?([0-9]{2})-?([0-9]{2})",
+                   os.path.basename(input_file))
+    if not rm:
+        return None
+    return "-".join(rm.groups())
+
+def find_input_files(inputs):
+    """Expand directories and glob patterns into a list of files."""
+    files = []
+    for name in inputs:
+        if os.path.isdir(name):
+            files.extend(sorted(os.path.join(name, f)
+                                for f in os.listdir(name)
+                                if not f.startswith(".") and
+                                os.path.isfile(os.path.join(name, f))))
+        elif glob.has_magic(name):
+            files.extend(sorted(glob.glob(name)))
+        else:
+            files.append(name)
+    return files
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
+
+def report(result):
+    if not result.ok:
+        sys.stderr.write("{}: failed: {}\n".format(result.input_file,
+                                                   result.errors))
+        return
+    print("{}: trip {}, {} sentences, {} rows in {:.1f} s "
+          "({:.0f} sentences/s, {:.0f} rows/s)"
+          .format(result.input_file, result.trip_id,
+                  result.lines, result.rows, result.seconds,
+                  rate(result.lines, result.seconds),
+                  rate(result.rows, result.seconds)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Read many NMEA files "
+                                     "and write them into database.")
+    parser.add_argument('inputs', metavar="input",
+                        nargs="+",
+                        help="Input files, directories or glob patterns")
+    parser.add_argument('-t', '--date', dest="trip_date",
+                        help="The date of the trips. By default the date "
+                        "is taken from the file names")
+    parser.add_argument('-e', '--email', dest="user_email",
+                        help="The e-mail address of the application user",
+                        required=True)
+    parser.add_argument('-n', '--name', dest="trip_name",
+                        help="A name or description for the trips",
+                        default='')
+    parser.add_argument('-s', '--vessel', dest="vessel_name",
+                        help="The name of the vessel",
+                        default='')
+    parser.add_argument('-j', '--jobs', dest="jobs",
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of files loaded in parallel. Each "
+                        "job uses one database connection")
+    parser.add_argument('-d', '--db-name', dest="db_name",
+                        help="Database name")
+    parser.add_argument('-u', '--db-user', dest="db_user",
+                        help="Database user name")
+    parser.add_argument('-p', '--db-passwd', dest="db_passwd",
+                        help="Database password")
+    parser.add_argument('-r', '--archive-dir', dest="archive_dir",
+                        help="Export the trips into the trip archive in "
+                        "this directory (TRIP_ARCHIVE_DIR of the server)")
+    args = parser.parse_args()
+
+    files = find_input_files(args.inputs)
+    if not files:
+        sys.stderr.write("No input files found.\n")
+        sys.exit(1)
+
+    start = time.time()
+    pool = multiprocessing.Pool(max(1, min(args.jobs, len(files))),
+                                init_worker, (args, ))
+    results = []
+    for result in pool.imap_unordered(import_file, files):
+        report(result)
+        results.append(result)
+    pool.close()
+    pool.join()
+    load_seconds = time.time() - start
+
+    loaded = [result for result in results if result.ok]
+    print("Loaded {} of {} files in {:.1f} s. "
+          "Now performing display range modifications ..."
+          .format(len(loaded), len(files), load_seconds))
+
+    ranges_start = time.time()
+    db = db_conn(args.db_name, args.db_user, args.db_passwd)
+    for result in loaded:
+        update_display_ranges(db, result.trip_id)
+        bump_data_version(db, result.trip_id)
+    db.commit()
+    if args.archive_dir:
+        for result in loaded:
+            export_trip(db, args.archive_dir, result.trip_id)
+    db.close()
+    ranges_seconds = time.time() - ranges_start
+
+    lines = sum(result.lines for result in loaded)
+    rows = sum(result.rows for result in loaded)
+    total_seconds = time.time() - start
+    print("Display ranges done in {:.1f} s.".format(ranges_seconds))
+    print("Total: {} sentences, {} rows in {:.1f} s "
+          "({:.0f} sentences/s, {:.0f} rows/s)"
+          .format(lines, rows, total_seconds,
+                  rate(lines, total_seconds),
+                  rate(rows, total_seconds)))
+
+    sys.exit(0 if len(loaded) == len(files) else 1)
+
+if __name__ == "__main__":
+    main()
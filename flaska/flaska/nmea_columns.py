@@ -0,0 +1,443 @@
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from nmea_parser import ParseError, HALF_DAY_SECONDS, checked_blocks, \
+    coord, late_fix, time_of_day
+from profiling import timer
+
+# Column-wise conversion of NMEA data with NumPy.
+#
+# NmeaParser turns each sentence into a record, and the loader merges
+# the records into rows one at a time. ColumnParser does the same for
+# a chunk of lines at a time: the lines are only recognized and split
+# in Python (the checksums are verified as in NmeaParser), and the raw
+# fields are collected into a list for each field. The conversions
+# (DDMM.mmm coordinates to degrees, hemisphere signs, speed units,
+# dates and timestamps) and the merging of the measurements of each
+# position are then done with NumPy array operations on whole columns.
+# The results are the same as those of the per-line code, down to the
+# last bit of the floating point values.
+#
+# NumPy is optional: available is False if it is not installed, and
+# the loader then uses NmeaParser.
+
+available = numpy is not None
+
+# The number of lines in a chunk. A chunk ends at the first position
+# after this many lines, so that the measurements recorded after a
+# position are always in the same chunk as the position.
+CHUNK_LINES = 50000
+
+# Sentence kinds by the start of the sentence, as in sentence_parsers
+# of nmea_parser.
+GLL, DBT, MWV, VHW, VTG = range(5)
+sentence_kinds = { "$GPGLL": GLL,
+                   "$IIDBT": DBT,
+                   "$IIMWV": MWV,
+                   "$IIVHW": VHW,
+                   "$IIVTG": VTG }
+
+class RawChunk:
+    """
+    The split sentences of a chunk of lines, a list for each sentence
+    kind. Each sentence has the index of the position it follows in
+    the chunk, -1 before the first position of the input, and the
+    number of its line for error messages.
+    """
+
+    def __init__(self):
+        self.positions = 0
+        self.sentences = tuple([] for kind in sentence_kinds)
+        self.position_indexes = tuple([] for kind in sentence_kinds)
+        self.lines = tuple([] for kind in sentence_kinds)
+        # A ParseError found while splitting, as (line, error). The
+        # chunk ends at that line.
+        self.error = None
+
+    def columns(self, kind, *fields):
+        """The values of fields of the sentences of kind, as lists."""
+        sentences = self.sentences[kind]
+        return [map(itemgetter(field), sentences) for field in fields]
+
+class PositionChunk:
+    """
+    The positions of a chunk of input and the merged measurements
+    recorded after each of them, as lists: times (timestamps as text),
+    latitudes, longitudes, and values, a list for each measurement
+    column of position_sample in the order of Sample.columns of the
+    loader. Missing measurements are None.
+    """
+
+    def __init__(self, times, latitudes, longitudes, values):
+        self.positions = len(times)
+        self.times = times
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.values = values
+
+class ColumnParser:
+    """
+    Parse lines of NMEA data into PositionChunks. The counters and the
+    errors are the same as those of NmeaParser.
+    """
+
+    def __init__(self, require_checksum=False, chunk_lines=CHUNK_LINES):
+        self.require_checksum = require_checksum
+        self.chunk_lines = chunk_lines
+        self.lines = 0
+        self.sentences = 0
+        self.bad_checksums = 0
+
+    def parse(self, lines, clock):
+        """
+        Yield a PositionChunk for each chunk of lines that has
+        positions. The positions are dated with clock, a TripClock
+        of nmea_parser. The measurements before the first
+        position are dropped. Raises ParseError if a sentence with a
+        valid checksum has invalid content; self.lines is then the
+        number of the failing line.
+        """
+        linenum = self.lines
+        chunk_end = linenum + self.chunk_lines
+        raw = RawChunk()
+        (sentences, indexes, line_numbers) = \
+            (raw.sentences, raw.position_indexes, raw.lines)
+        positions = 0
+        for (block, last) in checked_blocks(lines, sentence_kinds,
+                                            self.require_checksum,
+                                            self.lines):
+            for (linenum, kind, sentence) in block:
+                if kind is None:
+                    self.bad_checksums += 1
+                    continue
+
+                # The checks are those of the parse_* functions of
+                # nmea_parser.
+                fields = sentence.split(",")
+                if kind == GLL:
+                    if len(fields) < 6 or not fields[1] or not fields[3]:
+                        continue
+                    if linenum > chunk_end and positions:
+                        raw.positions = positions
+                        self.lines = linenum - 1
+                        yield self.convert(raw, clock)
+                        chunk_end = linenum + self.chunk_lines
+                        raw = RawChunk()
+                        (sentences, indexes, line_numbers) = \
+                            (raw.sentences, raw.position_indexes, raw.lines)
+                        positions = 0
+                    positions += 1
+                elif kind == DBT:
+                    if len(fields) < 5 or not fields[3] or fields[4] != "M":
+                        continue
+                elif kind == MWV:
+                    if len(fields) < 5 or not fields[1] or not fields[3]:
+                        continue
+                elif kind == VHW:
+                    if len(fields) < 9 or not fields[5]:
+                        continue
+                    if fields[6] != "N":
+                        raw.error = (linenum, ParseError(
+                            "Unknown speed unit {0}".format(fields[6])))
+                        break
+                else:
+                    if len(fields) < 7 or not fields[1] or not fields[5]:
+                        continue
+                    if fields[6] != "N":
+                        raw.error = (linenum, ParseError(
+                            "Unknown speed unit {0}".format(fields[6])))
+                        break
+                sentences[kind].append(fields)
+                indexes[kind].append(positions - 1)
+                line_numbers[kind].append(linenum)
+                self.sentences += 1
+
+            if raw.error:
+                break
+            linenum = last
+
+        raw.positions = positions
+        self.lines = linenum
+        chunk = self.convert(raw, clock)
+        if raw.error:
+            (self.lines, error) = raw.error
+            raise error
+        if chunk is not None:
+            yield chunk
+
+    def convert(self, raw, clock):
+        """
+        Convert a RawChunk into a PositionChunk, or None if it has no
+        positions. Raises the error of the first line that cannot be
+        converted, and sets self.lines to its number.
+        """
+        with timer("convert"):
+            errors = []
+            chunk = convert_chunk(raw, clock, errors)
+        if errors:
+            # The first error of the first failing line, as the
+            # per-line code would raise it.
+            (self.lines, error) = min(errors, key=lambda e: e[0])
+            raise error
+        return chunk
+
+def convert_chunk(raw, clock, errors):
+    """
+    Convert the columns of raw. Conversion errors are appended to
+    errors as (line, error) tuples, in the order in which the per-line
+    code would find them on a line. Returns None if there are errors
+    or no positions.
+    """
+    n = raw.positions
+    (lats, lat_hemispheres, lons, lon_hemispheres, times) = \
+        raw.columns(GLL, 1, 2, 3, 4, 5)
+    (depths, ) = raw.columns(DBT, 3)
+    (wind_angles, wind_references, wind_speeds, wind_units) = \
+        raw.columns(MWV, 1, 2, 3, 4)
+    (water_speeds, ) = raw.columns(VHW, 5)
+    (courses, ground_speeds) = raw.columns(VTG, 1, 5)
+
+    latitudes = to_coords(lats, lat_hemispheres, 2, raw.lines[GLL],
+                          errors)
+    longitudes = to_coords(lons, lon_hemispheres, 3, raw.lines[GLL],
+                           errors)
+    seconds = to_seconds(times, raw.lines[GLL], errors)
+    depths = to_floats(depths, raw.lines[DBT], errors)
+    wind_speeds = to_floats(wind_speeds, raw.lines[MWV], errors)
+    wind_angles = to_ints(wind_angles, raw.lines[MWV], errors)
+    water_speeds = to_floats(water_speeds, raw.lines[VHW], errors)
+    ground_speeds = to_floats(ground_speeds, raw.lines[VTG], errors)
+    courses = to_floats(courses, raw.lines[VTG], errors)
+    if errors or not n:
+        return None
+
+    # The speed units of nmea_parser.wind_speed_units.
+    units = numpy.array(wind_units, dtype=str)
+    wind_speeds = wind_speeds * numpy.where(
+        units == "N", 0.5, numpy.where(units == "K", 1 / 3.6, 1.0))
+    true_winds = numpy.array(wind_references, dtype=str) == "T"
+
+    (depth_positions, depths) = after_first_position(
+        raw.position_indexes[DBT], depths)
+    (water_positions, water_speeds) = after_first_position(
+        raw.position_indexes[VHW], water_speeds)
+    (ground_positions, ground_speeds, courses) = after_first_position(
+        raw.position_indexes[VTG], ground_speeds, courses)
+    (wind_positions, wind_speeds, wind_angles, true_winds) = \
+        after_first_position(raw.position_indexes[MWV], wind_speeds,
+                             wind_angles, true_winds)
+    # The apparent wind of a position is at 2 * position, and the
+    # true wind at 2 * position + 1.
+    wind_keys = 2 * wind_positions + true_winds
+
+    (wind_speed, wind_present) = group_means(wind_keys, wind_speeds, 2 * n)
+    (wind_angle, wind_present) = group_directions(wind_keys, wind_angles,
+                                                  2 * n)
+    wind_angle = round_half_up(wind_angle).astype(numpy.int64) % 360
+    values = [group_min(depth_positions, depths, n),
+              group_means(water_positions, water_speeds, n),
+              group_means(ground_positions, ground_speeds, n),
+              group_directions(ground_positions, courses, n),
+              (wind_speed[0::2], wind_present[0::2]),
+              (wind_angle[0::2], wind_present[0::2]),
+              (wind_speed[1::2], wind_present[1::2]),
+              (wind_angle[1::2], wind_present[1::2])]
+
+    days = position_days(seconds, clock)
+    return PositionChunk(timestamps(times, days, clock),
+                         latitudes.tolist(), longitudes.tolist(),
+                         [nullable(column, present)
+                          for (column, present) in values])
+
+def after_first_position(positions, *columns):
+    """
+    The positions of the measurements as an array, and the columns of
+    their values, without the measurements before the first position
+    of the input. Those can only be at the start.
+    """
+    positions = numpy.array(positions, dtype=numpy.int64)
+    first = numpy.searchsorted(positions, 0)
+    return (positions[first:], ) + tuple(column[first:]
+                                         for column in columns)
+
+def to_floats(values, lines, errors):
+    """Convert a list of strings to an array of floats."""
+    try:
+        return numpy.array(values, dtype=numpy.float64)
+    except ValueError:
+        return python_values(float, values, lines, errors)
+
+def to_ints(values, lines, errors):
+    """Convert a list of strings to floats truncated to integers."""
+    floats = to_floats(values, lines, errors)
+    if floats is None:
+        return None
+    if numpy.isfinite(floats).all():
+        return numpy.trunc(floats)
+    return python_values(lambda value: int(float(value)), values, lines,
+                         errors)
+
+def to_coords(values, hemispheres, deg_nums, lines, errors):
+    """
+    Convert DDMM.xxx values (DDDMM.xxx with deg_nums 3) and their
+    hemispheres to degrees, as nmea_parser.coord does.
+    """
+    if not values:
+        return numpy.zeros(0)
+    text = numpy.array(values, dtype=str)
+    width = text.dtype.itemsize
+    chars = text.view(numpy.uint8).reshape(len(values), width)
+    digits = chars[:, :deg_nums].astype(numpy.int64) - ord("0")
+    if width > deg_nums and (digits >= 0).all() and (digits <= 9).all():
+        minutes = chars[:, deg_nums:].copy() \
+            .view("S{0}".format(width - deg_nums)).ravel()
+        try:
+            minutes = minutes.astype(numpy.float64)
+        except ValueError:
+            minutes = None
+        if minutes is not None:
+            degrees = numpy.zeros(len(values))
+            for i in xrange(deg_nums):
+                degrees = degrees * 10 + digits[:, i]
+            hemispheres = numpy.array(hemispheres, dtype=str)
+            signs = numpy.where((hemispheres == "S") |
+                                (hemispheres == "W"), -1.0, 1.0)
+            return signs * (degrees + minutes / 60.0)
+    # Signs, spaces and other characters that int() would accept.
+    return python_values(coord, zip(values, hemispheres,
+                                    [deg_nums] * len(values)),
+                         lines, errors, unpack=True)
+
+def python_values(convert, values, lines, errors, unpack=False):
+    """
+    Convert values one at a time with convert, for the values that
+    NumPy cannot convert. Appends the first error to errors and
+    returns None if there are invalid values.
+    """
+    results = []
+    for (value, line) in zip(values, lines):
+        try:
+            results.append(convert(*value) if unpack else convert(value))
+        except ParseError, ex:
+            errors.append((line, ex))
+            return None
+        except ValueError, ex:
+            errors.append((line, ParseError(ex)))
+            return None
+        except OverflowError, ex:
+            errors.append((line, ex))
+            return None
+    return numpy.array(results, dtype=numpy.float64)
+
+def to_seconds(times, lines, errors):
+    """
+    Convert hhmmss times to seconds since midnight, as
+    nmea_parser.time_of_day does.
+    """
+    if not times:
+        return numpy.zeros(0, dtype=numpy.int64)
+    text = numpy.array(times, dtype=str)
+    width = text.dtype.itemsize
+    chars = text.view(numpy.uint8).reshape(len(times), width)
+    digits = chars[:, :6].astype(numpy.int64) - ord("0")
+    if width >= 6 and (digits >= 0).all() and (digits <= 9).all():
+        return (digits[:, 0] * 10 + digits[:, 1]) * 3600 + \
+            (digits[:, 2] * 10 + digits[:, 3]) * 60 + \
+            digits[:, 4] * 10 + digits[:, 5]
+    seconds = python_values(time_of_day, times, lines, errors)
+    return None if seconds is None else seconds.astype(numpy.int64)
+
+def position_days(seconds, clock):
+    """
+    Return the days of positions from the start date of clock, as
+    TripClock.next_day gives them one position at a time, and advance
+    clock past the positions.
+    """
+    previous = numpy.empty_like(seconds)
+    previous[1:] = seconds[:-1]
+    previous[0] = seconds[0] if clock.seconds is None else clock.seconds
+    days = clock.day + numpy.cumsum(
+        (previous - seconds > HALF_DAY_SECONDS).astype(numpy.int64) -
+        late_fix(previous, seconds).astype(numpy.int64))
+    clock.day = int(days[-1])
+    clock.seconds = int(seconds[-1])
+    return days
+
+def timestamps(times, days, clock):
+    """
+    Return the timestamps of hhmmss times on days from the start date
+    of clock, as "YYYY-MM-DD hh:mm:ss".
+    """
+    (day_values, day_indexes) = numpy.unique(days, return_inverse=True)
+    prefixes = [clock.date_prefix(day) for day in day_values.tolist()]
+    text = numpy.array(times, dtype=str)
+    width = text.dtype.itemsize
+    chars = text.view(numpy.uint8).reshape(len(times), width)
+    if width < 6 or not chars[:, :6].all() or \
+       len(set(len(prefix) for prefix in prefixes)) > 1:
+        # Times shorter than six characters, or years that are not
+        # four digits.
+        return [prefixes[i] + t[0:2] + ":" + t[2:4] + ":" + t[4:6]
+                for (i, t) in zip(day_indexes.tolist(), times)]
+    p = len(prefixes[0])
+    stamps = numpy.empty((len(times), p + 8), dtype=numpy.uint8)
+    stamps[:, :p] = numpy.array([numpy.frombuffer(prefix, dtype=numpy.uint8)
+                                 for prefix in prefixes])[day_indexes]
+    stamps[:, p:p + 2] = chars[:, 0:2]
+    stamps[:, p + 3:p + 5] = chars[:, 2:4]
+    stamps[:, p + 6:p + 8] = chars[:, 4:6]
+    stamps[:, p + 2] = stamps[:, p + 5] = ord(":")
+    return stamps.view("S{0}".format(p + 8)).ravel().tolist()
+
+def group_min(groups, values, n):
+    """
+    The smallest of the values of each of the groups 0 ... n - 1, and
+    whether the group has values. groups must be sorted.
+    """
+    smallest = numpy.zeros(n)
+    present = numpy.zeros(n, dtype=bool)
+    if len(groups):
+        starts = numpy.flatnonzero(numpy.diff(groups)) + 1
+        starts = numpy.concatenate(([0], starts))
+        smallest[groups[starts]] = numpy.minimum.reduceat(values, starts)
+        present[groups[starts]] = True
+    return (smallest, present)
+
+def group_means(groups, values, n):
+    """
+    The means of the values of each of the groups 0 ... n - 1, and
+    whether the group has values. The values are added up in order,
+    as sum() does.
+    """
+    counts = numpy.bincount(groups, minlength=n)
+    sums = numpy.bincount(groups, weights=values, minlength=n)
+    present = counts > 0
+    return (sums / numpy.maximum(counts, 1), present)
+
+def group_directions(groups, angles, n):
+    """
+    The mean directions of the angles in degrees of the groups, as
+    mean_direction of the loader does.
+    """
+    radians = numpy.radians(angles)
+    sines = numpy.bincount(groups, weights=numpy.sin(radians),
+                           minlength=n)
+    cosines = numpy.bincount(groups, weights=numpy.cos(radians),
+                             minlength=n)
+    present = numpy.bincount(groups, minlength=n) > 0
+    return (numpy.degrees(numpy.arctan2(sines, cosines)) % 360.0, present)
+
+def round_half_up(values):
+    """Round non-negative values as round() of Python 2 does."""
+    whole = numpy.floor(values)
+    return whole + (values - whole >= 0.5)
+
+def nullable(values, present):
+    """values as a list, with None where present is False."""
+    values = values.astype(object)
+    values[~present] = None
+    return values.tolist()
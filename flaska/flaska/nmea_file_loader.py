@@ -1,191 +1,355 @@
 #!/usr/bin/env python
 
 import argparse
-import gzip
-import magic
+import itertools
+import math
 import re
 import sys
 import time
+import zlib
+
+from cStringIO import StringIO
 
 import psycopg2
 import psycopg2.extras
 
-def fl_coord(coordstr, hemisphere, neg_hemisphere, deg_nums=2):
-    if len(coordstr) < deg_nums:
-        return None
+import nmea_columns
 
-    # Translate the DDMM.xxx value to a floating point degree value.
-    value = float(coordstr[0:deg_nums]) + float(coordstr[deg_nums:]) / 60.0
-    if hemisphere == neg_hemisphere:
-        value = -1.0 * value
-    return value
-
-def writeout_coords(db, trip_id, input_info, fields):
-    if len(fields) < 6:
-        return -1
-    # Format the timestamp
-    ts = fields[5]
-    datestamp = "'{0} {1}:{2}:{3}'".format(input_info.trip_date,
-                                           ts[0:2],
-                                           ts[2:4],
-                                           ts[4:6])
-
-
-    # Get coordinate values. Skip if fields are empty (that may happen if
-    # there is no GPS fix yet).
-    if len(fields[1]) == 0 or len(fields[3]) == 0:
-        return -1
-
-    lat = fl_coord(fields[1], fields[2], "S")
-    lon = fl_coord(fields[3], fields[4], "W", deg_nums=3)
-
-    if lat is None or lon is None:
-        raise Exception("Invalid position data")
-
-    position_cursor = db.cursor()
-    position_cursor.execute("INSERT INTO position "
-                            "(pos_time_utc, trip_id, latitude, longitude) "
-                            "VALUES "
-                            "(%s, %s, %s, %s) "
-                            "RETURNING id",
-                            (datestamp, trip_id, lat, lon))
-    pos_id_data = position_cursor.fetchone()
-    position_cursor.close()
-
-    if pos_id_data is None:
-        raise Exception("Inserting position id failed")
-    return pos_id_data[0]
-
-def writeout_depth(db, position_id, input_info, fields):
-    if len(fields) < 5 or position_id < 0:
-        # We need a coordinate value before a depth can be inserted.
-        return
-
-    if len(fields[3]) < 1 or len(fields[4]) < 1:
-        # Empty values. Data can be missing.
-        return
-
-    depth = float(fields[3])
-    unit = fields[4]
-
-    if unit != 'M':
-        return
-
-    depth_cursor = db.cursor()
-    depth_cursor.execute("INSERT INTO depth "
-                         "(position_id, depth) "
-                         "VALUES "
-                         "(%s, %s)",
-                         (position_id, depth))
-    depth_cursor.close()
-
-def writeout_wind(db, position_id, fields):
-    if len(fields) < 5 or position_id < 0:
-        # Coordinates needed before we can insert wind data.
-        return
-
-    if len(fields[1]) == 0 or len(fields[3]) == 0:
-        # No data => no wind.
-        return
-
-    angle = int(fields[1])
-    true_apparent = 1 if 'T' == fields[2] else 0
-    speed = float(fields[3])
-    speed_unit = fields[4]
-
-    if 'N' == speed_unit:     # Knots
-        speed = speed / 2.0   # Convert to m/s
-    elif 'K' == speed_unit:   # km/h, unlikely
-        speed = speed / 3.6
-    # Otherwise the unit should be m/s - but who knows.
-
-    wind_cursor = db.cursor()
-    wind_cursor.execute("INSERT INTO wind "
-                        "(position_id, speed, angle, true_apparent) "
-                        "VALUES "
-                        "(%s, %s, %s, %s)",
-                        (position_id, speed, angle, true_apparent))
-    wind_cursor.close()
-
-def writeout_waterspeed(db, position_id, fields):
-    if len(fields) < 9 or position_id < 0:
-        # Coordinates needed
-        return
-
-    speed = float(fields[5])
-    speed_unit = fields[6]
-
-    if 'N' != speed_unit:
-        raise Exception("Unknown speed unit {0}".format(speed_unit))
-
-    speed_cursor = db.cursor()
-    speed_cursor.execute("INSERT INTO water_speed "
-                         "(position_id, speed) "
-                         "VALUES "
-                         "(%s, %s)",
-                         (position_id, speed))
-    speed_cursor.close()
-
-def writeout_cog_and_sog(db, position_id, fields):
-    if len(fields) < 7 or position_id < 0:
-        # Coordinates needed
-        return
-
-    if len(fields[1]) == 0 or len(fields[5]) == 0:
-        # Course or speed fields empty
-        return
-
-    course = float(fields[1])
-    speed = float(fields[5])
-    speed_unit = fields[6]
-
-    if 'N' != speed_unit:
-        raise Exception("Unknown speed unit {0}".format(speed_unit))
-
-    cogsog_cursor = db.cursor()
-    cogsog_cursor.execute("INSERT INTO ground_speed_course "
-                         "(position_id, speed, course) "
-                         "VALUES "
-                         "(%s, %s, %s)",
-                         (position_id, speed, course))
-    cogsog_cursor.close()
-                # $IIVTG,226.95,T,226.95,M,5.80,N,,,D*69
-                #        deg    T    deg M spd kn
-
-def read_input(db, trip_id, input_info, input):
-    linenum = 0
-    positions_ok = 0
-    position_id = -1
+from nmea_columns import ColumnParser
+from nmea_parser import NmeaParser, TripClock, Position, Depth, Wind, \
+    WaterSpeed, GroundSpeedCourse
+from profiling import Profile, activate, timer
+from track import trip_tracks
+from trip_archive import export_trip
 
-    try:
-        for line in input:
-            linenum += 1
-            fields = line.split(",")
-            if len(fields) < 1:
-                continue
+# Convert the input with NumPy a chunk of lines at a time (nmea_columns)
+# if it is installed. Otherwise, or if this is set to False (the
+# --per-line option), the input is converted one line at a time.
+use_numpy = nmea_columns.available
 
-            if fields[0] == "$GPGLL":  # Lat/lon
-                position_id = writeout_coords(db, trip_id, input_info, fields)
-                if position_id != -1:
-                    positions_ok += 1
-            elif fields[0] == "$IIDBT": # Depth below transducer
-                writeout_depth(db, position_id, input_info, fields)
-            elif fields[0] == "$IIMWV": # Wind speed and angle
-                writeout_wind(db, position_id, fields)
-            elif fields[0] == "$IIVHW": # Water speed and heading
-                writeout_waterspeed(db, position_id, fields)
-            elif fields[0] == "$IIVTG": # Course over ground and ground speed
-                writeout_cog_and_sog(db, position_id, fields)
+def mean(values):
+    if not values:
+        return None
+    return sum(values) / len(values)
+
+def mean_direction(angles):
+    """
+    Return the mean of directions in degrees, in [0, 360), or None if
+    there are none. 350 and 10 degrees average to 0, not 180.
+    """
+    if not angles:
+        return None
+    radians = [math.radians(angle) for angle in angles]
+    mean_angle = math.degrees(math.atan2(sum(map(math.sin, radians)),
+                                         sum(map(math.cos, radians))))
+    return mean_angle % 360.0
+
+def mean_wind_angle(angles):
+    angle = mean_direction(angles)
+    return None if angle is None else int(round(angle)) % 360
+
+class Sample:
+    """
+    The measurements recorded between two position fixes. They are
+    merged into one row of the position_sample table: the smallest
+    depth, and the means of the speeds and directions. Wind is kept
+    separately for the apparent and the true wind.
+    """
+
+    # Columns of position_sample for the values.
+    columns = ("depth", "water_speed", "ground_speed", "course",
+               "apparent_wind_speed", "apparent_wind_angle",
+               "true_wind_speed", "true_wind_angle")
+
+    def __init__(self):
+        self.depth = None
+        self.water_speeds = []
+        self.ground_speeds = []
+        self.courses = []
+        # Speeds and angles of the apparent (0) and true (1) wind.
+        self.wind_speeds = ([], [])
+        self.wind_angles = ([], [])
+
+    def add(self, record):
+        kind = type(record)
+        if kind is Depth:
+            if self.depth is None or record.depth < self.depth:
+                self.depth = record.depth
+        elif kind is Wind:
+            self.wind_speeds[record.true_apparent].append(record.speed)
+            self.wind_angles[record.true_apparent].append(record.angle)
+        elif kind is WaterSpeed:
+            self.water_speeds.append(record.speed)
+        elif kind is GroundSpeedCourse:
+            self.ground_speeds.append(record.speed)
+            self.courses.append(record.course)
+
+    def values(self):
+        """Return the merged values, in the order of columns."""
+        return (self.depth,
+                mean(self.water_speeds),
+                mean(self.ground_speeds),
+                mean_direction(self.courses),
+                mean(self.wind_speeds[0]),
+                mean_wind_angle(self.wind_angles[0]),
+                mean(self.wind_speeds[1]),
+                mean_wind_angle(self.wind_angles[1]))
+
+class BulkWriter:
+    """
+    Buffer data rows in memory and write them to the database in
+    batches with COPY FROM STDIN.
+
+    Position ids are assigned on the client side. They are reserved
+    from position_id_seq in blocks so that the sample rows can refer
+    to their position before anything has been written out.
+
+    The rows are written directly to the partitions of the trip, the
+    tables with the name suffix partition.
+    """
+
+    # Column lists of the tables, in the order of the buffered rows.
+    tables = (("position",
+               ("id", "pos_time_utc", "trip_id", "latitude", "longitude")),
+              ("depth", ("position_id", "trip_id", "depth")),
+              ("position_sample",
+               ("position_id", "pos_time_utc", "trip_id", "latitude",
+                "longitude") + Sample.columns))
+
+    def __init__(self, db, partition, id_block_size=1000, flush_rows=50000):
+        self.db = db
+        self.partition = partition
+        self.id_block_size = id_block_size
+        self.flush_rows = flush_rows
+        self.free_ids = []
+        self.buffers = dict((table, []) for (table, columns) in self.tables)
+        self.buffered_rows = 0
+        self.rows_written = 0
+        self.position_ids = []
+
+    def next_position_id(self):
+        if not self.free_ids:
+            self.reserve_position_ids(self.id_block_size)
+        return self.free_ids.pop()
+
+    def next_position_ids(self, count):
+        """Return the next count position ids, in ascending order."""
+        if count > len(self.free_ids):
+            self.reserve_position_ids(max(self.id_block_size,
+                                          count - len(self.free_ids)))
+        first = len(self.free_ids) - count
+        ids = self.free_ids[first:]
+        del self.free_ids[first:]
+        ids.reverse()
+        return ids
+
+    def reserve_position_ids(self, count):
+        id_cursor = self.db.cursor()
+        id_cursor.execute("SELECT nextval('position_id_seq') "
+                          "FROM generate_series(1, %s)",
+                          (count, ))
+        # Reversed so that pop() hands out the ids in ascending order.
+        # The new ids are larger than the ones still free.
+        reserved = [row[0] for row in id_cursor.fetchall()]
+        reserved.reverse()
+        id_cursor.close()
+
+        if not reserved:
+            raise Exception("Reserving position ids failed")
+        self.free_ids = reserved + self.free_ids
+
+    def add_row(self, table, row):
+        self.buffers[table].append(row)
+        self.buffered_rows += 1
+        if self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def add_rows(self, table, rows):
+        self.buffers[table].extend(rows)
+        self.buffered_rows += len(rows)
+        if self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def position(self, pos_time_utc, trip_id, latitude, longitude):
+        """Write a position. Returns the row of the position."""
+        position_id = self.next_position_id()
+        self.position_ids.append(position_id)
+        row = (position_id, pos_time_utc, trip_id, latitude, longitude)
+        self.add_row("position", row)
+        return row
+
+    def sample(self, position_row, sample):
+        """
+        Write the merged measurements of a position. position_row is
+        the row of the position as given to position().
+        """
+        values = sample.values()
+        self.add_row("position_sample", position_row + values)
+        if values[0] is not None:
+            self.add_row("depth",
+                         (position_row[0], position_row[2], values[0]))
+
+    def chunk(self, trip_id, chunk):
+        """
+        Write the positions of a PositionChunk of ColumnParser and
+        their merged measurements.
+        """
+        ids = self.next_position_ids(chunk.positions)
+        self.position_ids.extend(ids)
+        trip_ids = itertools.repeat(trip_id, chunk.positions)
+        position_rows = zip(ids, chunk.times, trip_ids,
+                            chunk.latitudes, chunk.longitudes)
+        depths = chunk.values[0]
+        self.add_rows("position", position_rows)
+        self.add_rows("position_sample",
+                      [row + values for (row, values)
+                       in itertools.izip(position_rows,
+                                         zip(*chunk.values))])
+        self.add_rows("depth", [(position_id, trip_id, depth)
+                                for (position_id, depth)
+                                in itertools.izip(ids, depths)
+                                if depth is not None])
+
+    def flush(self):
+        """
+        Write out all buffered rows. The position table goes first so
+        that the foreign keys of the measurement tables are satisfied.
+        """
+        copy_cursor = self.db.cursor()
+        for (table, columns) in self.tables:
+            rows = self.buffers[table]
+            if not rows:
+                continue
+            with timer("copy"):
+                copy_cursor.copy_from(copy_data(rows),
+                                      table + self.partition,
+                                      columns=columns)
+            self.rows_written += len(rows)
+            self.buffers[table] = []
+        copy_cursor.close()
+        self.buffered_rows = 0
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def copy_data(rows):
+    """Format rows into a file-like object in the COPY text format."""
+    data = StringIO()
+    for row in rows:
+        data.write("\t".join(copy_value(value) for value in row))
+        data.write("\n")
+    data.seek(0)
+    return data
+
+def read_input(db, trip_id, input_info, input, context=None,
+               partition=None):
+    """
+    Parse NMEA data from input and write it to the database. Return
+    the ids of the positions that were added. The rows go to the
+    tables with the name suffix partition, by default the partitions
+    of the trip.
+    """
+    context = context or TTYContext()
+    writer = BulkWriter(db, partition or trip_partition(db, trip_id))
+    clock = trip_clock(db, trip_id, input_info)
+    if use_numpy:
+        parser = ColumnParser()
+        write_input = write_chunks
+    else:
+        parser = NmeaParser()
+        write_input = write_records
 
+    try:
+        positions_ok = write_input(parser, input, writer, trip_id, clock,
+                                   context)
     except Exception,ex:
         raise Exception("Failure on line {0} of the input file: {1}"
-                        .format(linenum, ex));
+                        .format(parser.lines, ex));
+
+    if parser.bad_checksums:
+        context.log("Skipped {0} lines with invalid checksums"
+                    .format(parser.bad_checksums))
 
     if 0 == positions_ok:
         # No valid positions found: fail so that everything (including
         # the metadata) gets rolled back.
         raise Exception("No valid data rows found")
 
+    writer.flush()
+    context.progress("loaded", parser.lines, writer.rows_written)
+    return writer.position_ids
+
+def trip_clock(db, trip_id, input_info):
+    """
+    Return the TripClock that dates the positions loaded into a trip.
+    Appended positions continue from the last position of the trip,
+    or start on the trip date if that is later.
+    """
+    clock_cursor = db.cursor()
+    clock_cursor.execute("SELECT %s::date", (input_info.trip_date, ))
+    start_date = clock_cursor.fetchone()[0]
+    last_time = None
+    if input_info.append:
+        clock_cursor.execute("SELECT max(pos_time_utc) "
+                             "FROM position_sample "
+                             "WHERE trip_id = %s",
+                             (trip_id, ))
+        last_time = clock_cursor.fetchone()[0]
+        if last_time is not None and last_time.date() < start_date:
+            last_time = None
+    clock_cursor.close()
+    return TripClock(start_date, last_time)
+
+def write_records(parser, input, writer, trip_id, clock, context):
+    """
+    Write the records of an NmeaParser to writer one at a time.
+    Returns the number of positions.
+    """
+    positions_ok = 0
+    # The last position and the measurements recorded after it.
+    position_row = None
+    sample = None
+    rows_reported = 0
+
+    for record in parser.parse(input):
+        if type(record) is Position:
+            if position_row is not None:
+                writer.sample(position_row, sample)
+            position_row = writer.position(clock.timestamp(record),
+                                           trip_id,
+                                           record.lat,
+                                           record.lon)
+            sample = Sample()
+            positions_ok += 1
+        elif sample is not None:
+            # Measurements before the first position are dropped.
+            sample.add(record)
+
+        if writer.rows_written != rows_reported:
+            # Report progress after each batch that was written.
+            rows_reported = writer.rows_written
+            context.progress("loading", parser.lines, rows_reported)
+
+    if position_row is not None:
+        writer.sample(position_row, sample)
+    return positions_ok
+
+def write_chunks(parser, input, writer, trip_id, clock, context):
+    """
+    Write the chunks of a ColumnParser to writer. Returns the number
+    of positions.
+    """
+    positions_ok = 0
+    for chunk in parser.parse(input, clock):
+        writer.chunk(trip_id, chunk)
+        positions_ok += chunk.positions
+        context.progress("loading", parser.lines, writer.rows_written)
+    return positions_ok
+
 def fetch_user_id(db, user_email):
     userid_cursor = db.cursor()
     userid_cursor.execute("SELECT id FROM users WHERE user_email = %s",
@@ -239,17 +403,22 @@ def a_or_b(a, b):
     """Return a if it has a value, b otherwise"""
     return a if a else b
 
-def load_and_update_trip(db, input_info):
+def fetch_trip_info(db, input_info, lock=False):
+    """
+    Fill in the trip metadata that input_info does not give from the
+    trip in the database. With lock, the trip row is locked for the
+    rest of the transaction.
+    """
     trip_cursor = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
     trip_cursor.execute("SELECT "
                         "id, user_id, trip_name, trip_date, vessel_name "
                         "FROM trip "
-                        "WHERE id = %s "
-                        "FOR UPDATE",
+                        "WHERE id = %s" +
+                        (" FOR UPDATE" if lock else ""),
                         (input_info.trip_id, ))
     trip_data_in_db = trip_cursor.fetchone()
+    trip_cursor.close()
     if not trip_data_in_db:
-        trip_cursor.close()
         raise Exception("Trip with id {} not found".format(input_info.trip_id))
 
     input_info.user_id = trip_data_in_db['user_id']
@@ -259,7 +428,10 @@ def load_and_update_trip(db, input_info):
                                   trip_data_in_db.get('trip_date'))
     input_info.vessel_name = a_or_b(input_info.vessel_name,
                                     trip_data_in_db.get('vessel_name'))
-    input_info = augment_args(input_info)
+    return augment_args(input_info)
+
+def update_trip_row(db, input_info):
+    trip_cursor = db.cursor()
     trip_cursor.execute("UPDATE trip "
                         "SET "
                         "trip_name = %s, "
@@ -275,76 +447,426 @@ def load_and_update_trip(db, input_info):
                          input_info.trip_id))
     trip_cursor.close()
 
-    # Delete previous data rows
-    trip_data_del_cursor = db.cursor()
-    trip_data_del_cursor.execute("DELETE FROM position "
-                                 "WHERE trip_id = %s",
-                                 (input_info.trip_id, ))
-    trip_data_del_cursor.close()
-
+def load_and_update_trip(db, input_info):
+    """
+    Prepare for appending data to an existing trip. The trip row is
+    locked until the data has been loaded.
+    """
+    input_info = fetch_trip_info(db, input_info, lock=True)
+    update_trip_row(db, input_info)
     return (input_info, input_info.trip_id, input_info.user_id)
 
-def load_data(context, db, input_info, trip_id):
+def trip_partition(db, trip_id):
+    """
+    Create the partitions for the data of a trip if needed. Returns
+    the name suffix of the partition tables.
+    """
+    partition_cursor = db.cursor()
+    partition_cursor.execute("SELECT trip_partition(%s)", (trip_id, ))
+    partition = partition_cursor.fetchone()[0]
+    partition_cursor.close()
+    return partition
+
+# The tables that are staged in a reload.
+staged_tables = ("position", "depth", "position_sample")
+
+def create_staging_tables(db, trip_id):
+    """
+    Create the unlogged staging tables for reloading a trip. Tables
+    left behind by a reload of the trip that died are replaced.
+    Returns the name suffix of the tables.
+    """
+    staging = "_s{}".format(trip_id)
+    staging_cursor = db.cursor()
+    for table in staged_tables:
+        staging_cursor.execute("DROP TABLE IF EXISTS " + table + staging)
+        staging_cursor.execute("CREATE UNLOGGED TABLE " + table + staging +
+                               " (LIKE " + table + " INCLUDING DEFAULTS)")
+    staging_cursor.close()
+    return staging
+
+def drop_staging_tables(db, staging):
+    staging_cursor = db.cursor()
+    for table in staged_tables:
+        staging_cursor.execute("DROP TABLE IF EXISTS " + table + staging)
+    staging_cursor.close()
+
+def swap_trip_data(db, trip_id, staging):
+    """
+    Replace the data rows of a trip with the rows in the staging
+    tables, and drop the staging tables.
+    """
+    delete_trip_data(db, trip_id)
+    partition = trip_partition(db, trip_id)
+    swap_cursor = db.cursor()
+    for table in staged_tables:
+        swap_cursor.execute("INSERT INTO " + table + partition + " "
+                            "SELECT * FROM " + table + staging)
+    swap_cursor.close()
+    drop_staging_tables(db, staging)
+
+def delete_trip_data(db, trip_id):
+    """
+    Delete the data rows of a trip. The deletes only touch the
+    partitions of the trip.
+    """
+    del_cursor = db.cursor()
+    # The measurements of the trips loaded before position_sample.
+    for table in ("wind", "water_speed", "ground_speed_course"):
+        del_cursor.execute("DELETE FROM " + table + " "
+                           "WHERE position_id IN (SELECT id FROM position "
+                           "                      WHERE trip_id = %s)",
+                           (trip_id, ))
+    for table in ("depth", "position_sample", "position"):
+        del_cursor.execute("DELETE FROM " + table + " "
+                           "WHERE trip_id = %s",
+                           (trip_id, ))
+    del_cursor.close()
+
+def load_data(context, db, input_info, trip_id, partition=None):
     if input_info.input_file == "-":
-        read_input(db, trip_id, input_info, sys.stdin)
+        return read_input(db, trip_id, input_info, input_lines(sys.stdin),
+                          context, partition)
     else:
-        load_data_file(context, db, input_info, trip_id)
-
-def load_data_file(context, db, input_info, trip_id):
-    mimetype = magic.from_file(input_info.input_file, mime=True)
-    fo = gzip.open if mimetype and mimetype == "application/x-gzip" \
-        else open
-    with fo(input_info.input_file) as input:
-        read_input(db, trip_id, input_info, input)
+        return load_data_file(context, db, input_info, trip_id, partition)
+
+def load_data_file(context, db, input_info, trip_id, partition=None):
+    with open(input_info.input_file, "rb") as input:
+        return read_input(db, trip_id, input_info, input_lines(input),
+                          context, partition)
+
+GZIP_MAGIC = "\x1f\x8b"
+
+def input_lines(input):
+    """
+    Iterate over the lines of input, a file object that need not be
+    seekable. gzip compressed data is recognized by its first bytes
+    and decompressed on the fly.
+    """
+    head = input.read(len(GZIP_MAGIC))
+    if head == GZIP_MAGIC:
+        return gzip_lines(input, head)
+    return plain_lines(input, head)
+
+def plain_lines(input, head):
+    for line in (head + input.readline()).splitlines(True):
+        yield line
+    for line in input:
+        yield line
+
+def gzip_lines(input, head, chunk_size=65536):
+    """Decompress gzip data from input, possibly of many members."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ""
+    data = head
+    while data:
+        text = decompressor.decompress(data)
+        while decompressor.unused_data:
+            # The start of the next member.
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            text += decompressor.decompress(data)
+
+        lines = (pending + text).splitlines(True)
+        pending = lines.pop() if lines and lines[-1][-1] != "\n" else ""
+        for line in lines:
+            yield line
+        data = input.read(chunk_size)
+
+    if pending:
+        yield pending
+
+def fetch_trip_area(db, trip_id):
+    """
+    Return the coordinate range of the positions of a trip, or None
+    if the trip has no positions.
+    """
+    area_cursor = db.cursor()
+    area_cursor.execute("SELECT lat0, lat1, lon0, lon1 "
+                        "FROM trip_summary "
+                        "WHERE trip_id = %s",
+                        (trip_id, ))
+    area = area_cursor.fetchone()
+    area_cursor.close()
+
+    if area is None or area[0] is None:
+        return None
+    return {"lat0": area[0],
+            "lat1": area[1],
+            "lon0": area[2],
+            "lon1": area[3]}
+
+def bump_data_version(db, trip_id):
+    """
+    Record that the data of a trip has changed. Must be called in the
+    transaction that makes the change.
+    """
+    version_cursor = db.cursor()
+    version_cursor.execute("SELECT bump_data_version(%s)", (trip_id, ))
+    version_cursor.close()
+
+def depth_grid_add(db, trip_id):
+    """Add the depths of a newly loaded trip to the depth grid."""
+    grid_cursor = db.cursor()
+    grid_cursor.execute("SELECT depth_grid_add(%s)", (trip_id, ))
+    grid_cursor.close()
+
+def depth_grid_refresh(db, trip_id, position_ids=None, without_trip=False):
+    """
+    Recompute the depth grid cells of the positions position_ids of a
+    trip, or of all of its positions. With without_trip, the depths of
+    the trip are left out of the cells.
+    """
+    grid_cursor = db.cursor()
+    grid_cursor.execute("SELECT depth_grid_refresh(%s, %s::INTEGER[], %s)",
+                        (trip_id, position_ids, without_trip))
+    grid_cursor.close()
+
+def update_trip_summary(db, trip_id):
+    summary_cursor = db.cursor()
+    summary_cursor.execute("SELECT update_trip_summary(%s)",
+                           (trip_id, ))
+    summary_cursor.close()
+
+def update_trip_tracks(db, trip_id):
+    store_trip_tracks(db, trip_id, compute_trip_tracks(db, trip_id))
+
+def compute_trip_tracks(db, trip_id, partition=""):
+    """
+    Compute the simplified tracks of a trip for all the display
+    ranges. The positions are taken in the order they were loaded,
+    from the position table with the name suffix partition.
+    """
+    track_cursor = db.cursor()
+    track_cursor.execute("SELECT range FROM display_ranges ORDER BY range")
+    ranges = [row[0] for row in track_cursor.fetchall()]
+    track_cursor.execute("SELECT latitude, longitude "
+                         "FROM position" + partition + " "
+                         "WHERE trip_id = %s "
+                         "AND latitude IS NOT NULL "
+                         "AND longitude IS NOT NULL "
+                         "AND NOT erroneous "
+                         "ORDER BY id",
+                         (trip_id, ))
+    points = track_cursor.fetchall()
+    track_cursor.close()
+    return trip_tracks(points, ranges)
+
+def store_trip_tracks(db, trip_id, tracks):
+    track_cursor = db.cursor()
+    track_cursor.execute("DELETE FROM trip_track WHERE trip_id = %s",
+                         (trip_id, ))
+    track_cursor.executemany("INSERT INTO trip_track "
+                             "(trip_id, display_range, point_count, "
+                             "polyline) "
+                             "VALUES (%s, %s, %s, %s)",
+                             [(trip_id, ) + track for track in tracks])
+    track_cursor.close()
+
+def update_display_ranges(db, trip_id, partition=None):
+    """
+    Compute the display ranges of a trip, in the tables with the name
+    suffix partition or by default in the partitions of the trip.
+    """
+    dr_cursor = db.cursor()
+    dr_cursor.execute("SELECT update_display_ranges(%s, %s)",
+                      (trip_id, partition))
+    dr_cursor.close()
 
-def update_depth_display_ranges(db, trip_id):
+def update_display_ranges_near(db, trip_id, position_ids):
+    """
+    Recompute the display ranges only in the grid cells around
+    position_ids.
+    """
     dr_cursor = db.cursor()
-    dr_cursor.execute("SELECT update_depth_display_ranges(%s)",
-                      (trip_id, ))
-    dr_cursor.execute("SELECT update_position_display_ranges(%s)",
-                      (trip_id, ))
+    dr_cursor.execute("SELECT update_display_ranges_near(%s, %s)",
+                      (trip_id, position_ids))
     dr_cursor.close()
 
 def do_file_loading(db, input_info,
                     context=None,
-                    user_id=None):
+                    user_id=None,
+                    update_ranges=True):
+    """
+    Load a file into a new trip, or reload an existing trip. The data
+    of the trip is committed only if the whole file was loaded.
+
+    If update_ranges is False, the display ranges are not computed;
+    the caller must do that later with update_display_ranges.
+
+    The time of each phase is reported to the context at the end.
+    """
     context = context or TTYContext()
     trip_id = -1
+    changed_areas = []
+
+    if input_info.trip_id and not input_info.append:
+        return do_trip_reload(db, input_info, context)
 
+    profile = Profile()
+    previous_profile = activate(profile)
     try:
-        if input_info.trip_id:
-            context.log("Updating trip information (id {})"
-                        .format(input_info.trip_id))
-            (input_info, trip_id, user_id) = load_and_update_trip(db,
-                                                                  input_info)
-        else:
-            input_info = augment_args(input_info)
-            trip_id = setup_trip(db, input_info, user_id)
+        with timer("setup"):
+            if input_info.trip_id:
+                context.log("Updating trip information (id {})"
+                            .format(input_info.trip_id))
+                changed_areas.append(fetch_trip_area(db,
+                                                     input_info.trip_id))
+                (input_info, trip_id, user_id) = \
+                    load_and_update_trip(db, input_info)
+            else:
+                input_info = augment_args(input_info)
+                trip_id = setup_trip(db, input_info, user_id)
         context.log("Loading data from {} ..."
                     .format(printable_filename(input_info)))
-        load_data(context, db, input_info, trip_id)
-        db.commit()
-        context.log("Loaded. Now performing display range modifications ...")
-        update_depth_display_ranges(db, trip_id)
-        db.commit()
+        with timer("parse"):
+            position_ids = load_data(context, db, input_info, trip_id)
+        with timer("summary"):
+            update_trip_summary(db, trip_id)
+        with timer("tracks"):
+            update_trip_tracks(db, trip_id)
+        with timer("depth_grid"):
+            if input_info.append:
+                depth_grid_refresh(db, trip_id, position_ids)
+            else:
+                depth_grid_add(db, trip_id)
+        bump_data_version(db, trip_id)
+        context.trip_loaded(db, trip_id)
+        with timer("commit"):
+            db.commit()
+        if update_ranges:
+            context.log("Loaded. Now performing display range "
+                        "modifications ...")
+            with timer("display_ranges"):
+                if input_info.append:
+                    update_display_ranges_near(db, trip_id, position_ids)
+                else:
+                    update_display_ranges(db, trip_id)
+            bump_data_version(db, trip_id)
+        changed_areas.append(fetch_trip_area(db, trip_id))
+        with timer("commit"):
+            db.commit()
+        context.data_changed(trip_id,
+                             [area for area in changed_areas if area])
         context.log("Done.")
         return True
     except Exception,ex:
         context.log_err("Loading data failed: {0}".format(ex));
         db.rollback()
         return False
+    finally:
+        profile.finish()
+        activate(previous_profile)
+        context.timings(profile.timings())
+
+def do_trip_reload(db, input_info, context):
+    """
+    Replace the data of an existing trip with the data of a file.
+
+    The file is loaded into unlogged staging tables, and the display
+    ranges and tracks are computed there, in a transaction that does
+    not touch the data of the trip. The trip stays queryable with its
+    old data until a second, short transaction swaps the new rows in.
+    Only that transaction locks the trip row.
+    """
+    trip_id = input_info.trip_id
+    staging = None
+    lock_cursor = db.cursor()
+    # Reloads of the same trip would share the staging tables.
+    lock_cursor.execute("SELECT pg_advisory_lock(hashtext('trip_reload'), "
+                        "                        %s)",
+                        (trip_id, ))
+    db.commit()
+
+    profile = Profile()
+    previous_profile = activate(profile)
+    try:
+        context.log("Reloading trip (id {})".format(trip_id))
+        with timer("setup"):
+            old_area = fetch_trip_area(db, trip_id)
+            input_info = fetch_trip_info(db, input_info)
+            staging = create_staging_tables(db, trip_id)
+        context.log("Loading data from {} ..."
+                    .format(printable_filename(input_info)))
+        with timer("parse"):
+            load_data(context, db, input_info, trip_id, staging)
+        context.log("Loaded. Now performing display range "
+                    "modifications ...")
+        with timer("display_ranges"):
+            update_display_ranges(db, trip_id, staging)
+        with timer("tracks"):
+            tracks = compute_trip_tracks(db, trip_id, staging)
+        with timer("commit"):
+            db.commit()
+
+        context.log("Replacing the data of the trip ...")
+        with timer("swap"):
+            input_info = fetch_trip_info(db, input_info, lock=True)
+            update_trip_row(db, input_info)
+            depth_grid_refresh(db, trip_id, without_trip=True)
+            swap_trip_data(db, trip_id, staging)
+            depth_grid_add(db, trip_id)
+            update_trip_summary(db, trip_id)
+            store_trip_tracks(db, trip_id, tracks)
+            bump_data_version(db, trip_id)
+            context.trip_loaded(db, trip_id)
+            db.commit()
+        staging = None
+
+        context.data_changed(trip_id,
+                             [area for area
+                              in (old_area, fetch_trip_area(db, trip_id))
+                              if area])
+        context.log("Done.")
+        return True
+    except Exception,ex:
+        context.log_err("Loading data failed: {0}".format(ex));
+        db.rollback()
+        if staging:
+            drop_staging_tables(db, staging)
+            db.commit()
+        return False
+    finally:
+        lock_cursor.execute("SELECT pg_advisory_unlock("
+                            "hashtext('trip_reload'), %s)",
+                            (trip_id, ))
+        lock_cursor.close()
+        db.commit()
+        profile.finish()
+        activate(previous_profile)
+        context.timings(profile.timings())
 
 class TTYContext:
+    def __init__(self):
+        self.changed_trips = []
+
     def log(self, msg):
         print(msg)
 
     def log_err(self, msg):
         sys.stderr.write("{}\n".format(msg))
 
+    def data_changed(self, trip_id, areas):
+        self.changed_trips.append(trip_id)
+
+    def trip_loaded(self, db, trip_id):
+        pass
+
+    def progress(self, phase, lines=None, rows=None):
+        pass
+
+    def timings(self, timings):
+        print("Timings: {}".format(", ".join("{} {:.2f} s"
+                                             .format(phase, seconds)
+                                             for (phase, seconds)
+                                             in timings)))
+
 class AppContext:
     def __init__(self):
         self.logmsgs = []
         self.errmsgs = []
+        self.changes = []
+        self.phase_timings = []
 
     def log(self, msg):
         self.logmsgs.append(msg)
@@ -352,6 +874,32 @@ class AppContext:
     def log_err(self, msg):
         self.errmsgs.append(msg)
 
+    def data_changed(self, trip_id, areas):
+        """Record the trip and areas whose data was modified."""
+        self.changes.append((trip_id, areas))
+
+    def trip_loaded(self, db, trip_id):
+        """
+        Called in the transaction that loads the data of a trip, just
+        before it is committed. Changes made through db are committed
+        together with the data.
+        """
+        pass
+
+    def progress(self, phase, lines=None, rows=None):
+        """
+        Report the progress of loading: the phase, the number of input
+        lines read and the number of rows written so far.
+        """
+        pass
+
+    def timings(self, timings):
+        """
+        Record the time spent in each phase of loading, as (phase,
+        seconds) tuples. The last one is the total.
+        """
+        self.phase_timings = timings
+
     def get_error_msgs(self):
         if 0 == len(self.errmsgs):
             return None
@@ -376,6 +924,10 @@ def main():
     parser.add_argument('-i', '--trip_id', dest="trip_id",
                         type=int,
                         help="Trip id for reloading data")
+    parser.add_argument('-a', '--append', dest="append",
+                        action="store_true",
+                        help="Append the data to the trip given with "
+                        "--trip_id instead of replacing it")
     parser.add_argument('-e', '--email', dest="user_email",
                         help="The e-mail address of the application user",
                         required=True)
@@ -391,13 +943,29 @@ def main():
                         help="Database user name")
     parser.add_argument('-p', '--db-passwd', dest="db_passwd",
                         help="Database password")
+    parser.add_argument('-r', '--archive-dir', dest="archive_dir",
+                        help="Export the trip into the trip archive in "
+                        "this directory (TRIP_ARCHIVE_DIR of the server)")
+    parser.add_argument('--per-line', dest="per_line",
+                        action="store_true",
+                        help="Convert the data one line at a time even "
+                        "if NumPy is installed")
     input_info = parser.parse_args()
+    if input_info.per_line:
+        global use_numpy
+        use_numpy = False
+    if input_info.append and not input_info.trip_id:
+        parser.error("--append requires --trip_id")
     db = db_conn(input_info.db_name, input_info.db_user, input_info.db_passwd)
     if db is None:
         sys.stderr.write("Connecting to database failed.\n")
         sys.exit(1)
 
-    result = do_file_loading(db, input_info)
+    context = TTYContext()
+    result = do_file_loading(db, input_info, context=context)
+    if result and input_info.archive_dir:
+        for trip_id in context.changed_trips:
+            export_trip(db, input_info.archive_dir, trip_id)
 
     db.close()
     sys.exit(0 if True == result else 1)
@@ -0,0 +1,323 @@
+import collections
+import datetime
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Parser for the NMEA 0183 sentences that the loader uses.
+#
+# Sentences are recognized by their first six characters ("$GPGLL")
+# before anything else is done with the line, so that the sentence
+# types that are not used cost only a dict lookup. Checksums ("*hh"
+# at the end of the sentence) are verified when they are present,
+# for a block of recognized sentences at a time: with NumPy the
+# checksums of a block are computed with one array operation, which
+# is several times faster than computing them one sentence at a time.
+# Each recognized sentence is turned into one of the record types
+# below. The time of a position is the time of day as "hh:mm:ss", and
+# seconds the same as seconds since midnight; TripClock gives it a
+# date.
+
+Position = collections.namedtuple("Position",
+                                  ["time", "lat", "lon", "seconds"])
+Depth = collections.namedtuple("Depth", ["depth"])
+Wind = collections.namedtuple("Wind", ["speed", "angle", "true_apparent"])
+WaterSpeed = collections.namedtuple("WaterSpeed", ["speed"])
+GroundSpeedCourse = collections.namedtuple("GroundSpeedCourse",
+                                           ["speed", "course"])
+
+# Records are created with tuple.__new__, which skips the argument
+# handling of the namedtuple constructors.
+new_record = tuple.__new__
+
+class ParseError(Exception):
+    pass
+
+# Signs of the hemispheres.
+hemisphere_signs = { "N": 1.0, "S": -1.0, "E": 1.0, "W": -1.0 }
+
+# Wind speed units, as factors to m/s. Values with other units are
+# taken to be in m/s already.
+wind_speed_units = { "N": 0.5,        # Knots (approximately)
+                     "K": 1 / 3.6 }   # km/h, unlikely
+
+def coord(value, hemisphere, deg_nums):
+    """Translate a DDMM.xxx value to a floating point degree value."""
+    if len(value) < deg_nums:
+        raise ParseError("Invalid position data")
+    try:
+        return hemisphere_signs.get(hemisphere, 1.0) * \
+            (int(value[:deg_nums]) + float(value[deg_nums:]) / 60.0)
+    except ValueError:
+        raise ParseError("Invalid position data")
+
+def time_of_day(ts):
+    """Translate an hhmmss value to seconds since midnight."""
+    # Six digits, as nearly always, with one conversion.
+    if ts[0:6].isdigit() and len(ts) >= 6:
+        hhmmss = int(ts[0:6])
+        return hhmmss / 10000 * 3600 + hhmmss / 100 % 100 * 60 + \
+            hhmmss % 100
+    try:
+        return int(ts[0:2]) * 3600 + int(ts[2:4]) * 60 + int(ts[4:6])
+    except ValueError:
+        raise ParseError("Invalid position time")
+
+def parse_gll(fields):
+    # $GPGLL,6009.0403,N,02457.9985,E,101112,A,A
+    #        lat       N lon        E hhmmss
+    if len(fields) < 6:
+        return None
+
+    # Skip if fields are empty (that may happen if there is no GPS fix
+    # yet).
+    if not fields[1] or not fields[3]:
+        return None
+
+    ts = fields[5]
+    return new_record(Position,
+                      (ts[0:2] + ":" + ts[2:4] + ":" + ts[4:6],
+                       coord(fields[1], fields[2], 2),
+                       coord(fields[3], fields[4], 3),
+                       time_of_day(ts)))
+
+def parse_dbt(fields):
+    # $IIDBT,,,12.3,M,,
+    #          depth M
+    if len(fields) < 5 or not fields[3] or fields[4] != "M":
+        # Missing data or not in meters.
+        return None
+    return new_record(Depth, (float(fields[3]), ))
+
+def parse_mwv(fields):
+    # $IIMWV,120,R,10.0,N,A
+    #        angle R/T speed unit
+    if len(fields) < 5 or not fields[1] or not fields[3]:
+        # No data => no wind.
+        return None
+
+    speed = float(fields[3]) * wind_speed_units.get(fields[4], 1.0)
+    return new_record(Wind, (speed,
+                             int(float(fields[1])),
+                             1 if fields[2] == "T" else 0))
+
+def parse_vhw(fields):
+    # $IIVHW,,,,,5.0,N,9.2,K
+    #            kn    km/h
+    if len(fields) < 9 or not fields[5]:
+        return None
+    if fields[6] != "N":
+        raise ParseError("Unknown speed unit {0}".format(fields[6]))
+    return new_record(WaterSpeed, (float(fields[5]), ))
+
+def parse_vtg(fields):
+    # $IIVTG,226.95,T,226.95,M,5.80,N,,,D
+    #        deg    T deg    M spd  kn
+    if len(fields) < 7 or not fields[1] or not fields[5]:
+        # Course or speed fields empty
+        return None
+    if fields[6] != "N":
+        raise ParseError("Unknown speed unit {0}".format(fields[6]))
+    return new_record(GroundSpeedCourse,
+                      (float(fields[5]), float(fields[1])))
+
+# Seconds in a day. A position whose time of day is more than half a
+# day earlier than that of the previous position is on the next day.
+DAY_SECONDS = 24 * 3600
+HALF_DAY_SECONDS = DAY_SECONDS / 2
+
+# A position that comes after one of the first LATE_FIX_SECONDS of a
+# day, and is in the last LATE_FIX_SECONDS of a day, is a late fix
+# from before midnight.
+LATE_FIX_SECONDS = 600
+
+class TripClock:
+    """
+    Give dates to the times of day of the positions of a trip, in the
+    order of the positions. The first position is on start_date, or
+    continues from last_time, the time of the last position loaded
+    before. A day is added each time the time of day goes back by more
+    than half a day from the previous position, as it does at
+    midnight. A late fix from before midnight that comes just after
+    midnight goes on the day before.
+    """
+
+    def __init__(self, start_date, last_time=None):
+        self.start_date = start_date
+        # The day of the previous position from start_date, and its
+        # time of day.
+        self.day = 0
+        self.seconds = None
+        if last_time is not None:
+            self.day = (last_time.date() - start_date).days
+            self.seconds = last_time.hour * 3600 + \
+                last_time.minute * 60 + last_time.second
+        self.prefixes = {}
+
+    def next_day(self, seconds):
+        """Return the day of the next position from start_date."""
+        if self.seconds is not None:
+            if self.seconds - seconds > HALF_DAY_SECONDS:
+                self.day += 1
+            elif late_fix(self.seconds, seconds):
+                self.day -= 1
+        self.seconds = seconds
+        return self.day
+
+    def date_prefix(self, day):
+        """Return the date of a day from start_date as "YYYY-MM-DD "."""
+        prefix = self.prefixes.get(day)
+        if prefix is None:
+            prefix = "{0} ".format(self.start_date +
+                                   datetime.timedelta(days=day))
+            self.prefixes[day] = prefix
+        return prefix
+
+    def timestamp(self, position):
+        """Return the timestamp of the next Position."""
+        return self.date_prefix(self.next_day(position.seconds)) + \
+            position.time
+
+def late_fix(previous, seconds):
+    """
+    Tell whether a position at seconds after one at previous is a
+    late fix from before midnight. Also works on NumPy arrays.
+    """
+    return (previous < LATE_FIX_SECONDS) & \
+        (seconds >= DAY_SECONDS - LATE_FIX_SECONDS)
+
+# Parsers by the start of the sentence: $, talker id and sentence type.
+sentence_parsers = { "$GPGLL": parse_gll,   # Lat/lon
+                     "$IIDBT": parse_dbt,   # Depth below transducer
+                     "$IIMWV": parse_mwv,   # Wind speed and angle
+                     "$IIVHW": parse_vhw,   # Water speed and heading
+                     "$IIVTG": parse_vtg }  # Course and speed over ground
+
+# Unpackers of 64-bit words by the word count. NMEA sentences are at
+# most 82 characters long, but longer lines are handled as well.
+word_structs = [struct.Struct("<{0}Q".format(n)) for n in xrange(16)]
+
+# Checksum values by their two-digit hexadecimal representation.
+hex_values = dict(("{0:02X}".format(value), value) for value in xrange(256))
+hex_values.update(("{0:02x}".format(value), value) for value in xrange(256))
+
+def checksum(sentence):
+    """
+    Return the NMEA checksum (XOR of the bytes) of the part between $
+    and *. The bytes are XORed 8 at a time and then folded together,
+    which is much faster than going through them one by one.
+    """
+    sentence += "\0" * (-len(sentence) % 8)
+    words = len(sentence) >> 3
+    unpacker = word_structs[words] if words < len(word_structs) \
+        else struct.Struct("<{0}Q".format(words))
+    value = 0
+    for word in unpacker.unpack(sentence):
+        value ^= word
+    value ^= value >> 32
+    value ^= value >> 16
+    value ^= value >> 8
+    return value & 0xff
+
+def block_checksums(sentences):
+    """
+    Return the checksums of a non-empty list of sentences (the parts
+    between $ and *, which are never empty) with NumPy.
+    """
+    data = numpy.frombuffer("".join(sentences), dtype=numpy.uint8)
+    lengths = numpy.fromiter(map(len, sentences), dtype=numpy.int64,
+                             count=len(sentences))
+    starts = numpy.cumsum(lengths) - lengths
+    return numpy.bitwise_xor.reduceat(data, starts).tolist()
+
+# The number of recognized sentences whose checksums are verified at
+# a time.
+BLOCK_SENTENCES = 1000
+
+def checked_blocks(lines, kinds, require_checksum, linenum=0):
+    """
+    Recognize the lines whose first six characters are keys of kinds
+    and verify their checksums, a block of sentences at a time. Yields
+    a list of (line number, kind, sentence) for each block and the
+    number of the last line read for it. The sentence is the line
+    without the checksum and the line end, and kind is None if the
+    checksum is wrong, or missing and require_checksum is set. The
+    line numbers continue from linenum.
+    """
+    found = []
+    for line in lines:
+        linenum += 1
+        kind = kinds.get(line[0:6])
+        if kind is not None:
+            found.append((linenum, kind, line))
+            if len(found) == BLOCK_SENTENCES:
+                yield (check_sentences(found, require_checksum), linenum)
+                found = []
+    yield (check_sentences(found, require_checksum), linenum)
+
+def check_sentences(found, require_checksum):
+    """
+    Verify the checksums of a block of checked_blocks. Without NumPy
+    they are computed one sentence at a time.
+    """
+    values = None
+    if numpy is not None and found:
+        values = block_checksums([line[1:line.rfind("*")]
+                                  for (linenum, kind, line) in found])
+    sentences = []
+    for (i, (linenum, kind, line)) in enumerate(found):
+        star = line.rfind("*")
+        if star >= 0:
+            value = checksum(line[1:star]) if values is None else values[i]
+            if value == hex_values.get(line[star + 1:star + 3]):
+                line = line[:star]
+            else:
+                kind = None
+        elif require_checksum:
+            kind = None
+        else:
+            line = line.rstrip()
+        sentences.append((linenum, kind, line))
+    return sentences
+
+class NmeaParser:
+    """
+    Parse lines of NMEA data into records.
+
+    The parser counts the lines it has seen (lines), the recognized
+    sentences (sentences), and the lines that were dropped because
+    their checksum did not match (bad_checksums). Lines without a
+    checksum are accepted unless require_checksum is set.
+    """
+
+    def __init__(self, require_checksum=False):
+        self.require_checksum = require_checksum
+        self.lines = 0
+        self.sentences = 0
+        self.bad_checksums = 0
+
+    def parse(self, lines):
+        """
+        Yield a record for each recognized sentence in lines. Raises
+        ParseError if a sentence with a valid checksum has invalid
+        content; self.lines is then the number of the failing line.
+        """
+        for (sentences, last) in checked_blocks(lines, sentence_parsers,
+                                                self.require_checksum,
+                                                self.lines):
+            for (linenum, parser, sentence) in sentences:
+                if parser is None:
+                    self.bad_checksums += 1
+                    continue
+                self.lines = linenum
+                try:
+                    record = parser(sentence.split(","))
+                except ValueError, ex:
+                    raise ParseError(ex)
+                if record is not None:
+                    self.sentences += 1
+                    yield record
+            self.lines = last
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import gzip
+import random
+import time
+
+import nmea_columns
+
+from nmea_columns import ColumnParser
+from nmea_file_loader import Sample
+from nmea_parser import NmeaParser, TripClock, Position, checksum
+
+# Microbenchmark of NMEA parsing: the NmeaParser module against the
+# split-and-compare parsing that the loader used before it, and the
+# conversion of the loader one line at a time (NmeaParser and Sample)
+# against the NumPy conversion of nmea_columns. None of them writes
+# anything to the database; only the parsing is timed.
+
+TRIP_DATE = datetime.date(2013, 6, 1)
+
+def fl_coord(coordstr, hemisphere, neg_hemisphere, deg_nums=2):
+    if len(coordstr) < deg_nums:
+        return None
+    value = float(coordstr[0:deg_nums]) + float(coordstr[deg_nums:]) / 60.0
+    if hemisphere == neg_hemisphere:
+        value = -1.0 * value
+    return value
+
+def split_coords(fields):
+    if len(fields) < 6 or len(fields[1]) == 0 or len(fields[3]) == 0:
+        return None
+    ts = fields[5]
+    datestamp = "{0} {1}:{2}:{3}".format(TRIP_DATE, ts[0:2], ts[2:4],
+                                         ts[4:6])
+    return (datestamp,
+            fl_coord(fields[1], fields[2], "S"),
+            fl_coord(fields[3], fields[4], "W", deg_nums=3))
+
+def split_depth(fields):
+    if len(fields) < 5 or len(fields[3]) < 1 or fields[4] != 'M':
+        return None
+    return (float(fields[3]), )
+
+def split_wind(fields):
+    if len(fields) < 5 or len(fields[1]) == 0 or len(fields[3]) == 0:
+        return None
+    speed = float(fields[3])
+    if 'N' == fields[4]:
+        speed = speed / 2.0
+    elif 'K' == fields[4]:
+        speed = speed / 3.6
+    return (speed, int(fields[1]), 1 if 'T' == fields[2] else 0)
+
+def split_waterspeed(fields):
+    if len(fields) < 9:
+        return None
+    return (float(fields[5]), )
+
+def split_cog_and_sog(fields):
+    if len(fields) < 7 or len(fields[1]) == 0 or len(fields[5]) == 0:
+        return None
+    return (float(fields[5]), float(fields[1]))
+
+def split_parse(lines):
+    """
+    The parsing of the loader before nmea_parser: every line is split
+    and the sentence type is found by comparing the first field.
+    Returns the number of rows that would have been written.
+    """
+    rows = 0
+    for line in lines:
+        fields = line.split(",")
+        if fields[0] == "$GPGLL":
+            row = split_coords(fields)
+        elif fields[0] == "$IIDBT":
+            row = split_depth(fields)
+        elif fields[0] == "$IIMWV":
+            row = split_wind(fields)
+        elif fields[0] == "$IIVHW":
+            row = split_waterspeed(fields)
+        elif fields[0] == "$IIVTG":
+            row = split_cog_and_sog(fields)
+        else:
+            continue
+        if row is not None:
+            rows += 1
+    return rows
+
+def parser_parse(lines):
+    """Parse with NmeaParser, as read_input of the loader does."""
+    date_prefix = "{0} ".format(TRIP_DATE)
+    rows = 0
+    for record in NmeaParser().parse(lines):
+        if type(record) is Position:
+            datestamp = date_prefix + record.time
+        rows += 1
+    return rows
+
+def records_parse(lines):
+    """
+    Parse with NmeaParser and merge the measurements of each position,
+    as read_input of the loader does without NumPy. Returns the number
+    of positions.
+    """
+    clock = TripClock(TRIP_DATE)
+    positions = 0
+    sample = None
+    for record in NmeaParser().parse(lines):
+        if type(record) is Position:
+            if sample is not None:
+                values = sample.values()
+            datestamp = clock.timestamp(record)
+            sample = Sample()
+            positions += 1
+        elif sample is not None:
+            sample.add(record)
+    if sample is not None:
+        values = sample.values()
+    return positions
+
+def columns_parse(lines):
+    """Parse and merge with ColumnParser. Returns the positions."""
+    parser = ColumnParser()
+    return sum(chunk.positions
+               for chunk in parser.parse(lines, TripClock(TRIP_DATE)))
+
+def with_checksum(sentence):
+    return "${0}*{1:02X}\r\n".format(sentence, checksum(sentence))
+
+def synthetic_lines(count, seed=1):
+    """
+    Generate count lines of NMEA data in the sentence mix of a typical
+    log: one position per second and the measurements between them,
+    and the sentences that the loader does not use, such as the
+    satellite information of the GPS.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    seconds = 0
+    while len(lines) < count:
+        seconds += 1
+        ts = "{0:02d}{1:02d}{2:02d}".format(seconds / 3600 % 24,
+                                            seconds / 60 % 60,
+                                            seconds % 60)
+        lat = 6009.0 + rnd.random()
+        lon = 2457.0 + rnd.random()
+        lines.append(with_checksum("GPGLL,{0:.4f},N,0{1:.4f},E,{2},A,A"
+                                   .format(lat, lon, ts)))
+        lines.append(with_checksum("IIDBT,,,{0:.1f},M,,"
+                                   .format(rnd.uniform(2, 40))))
+        lines.append(with_checksum("IIMWV,{0},R,{1:.1f},N,A"
+                                   .format(rnd.randint(0, 359),
+                                           rnd.uniform(0, 20))))
+        lines.append(with_checksum("IIVHW,,,,,{0:.1f},N,,K"
+                                   .format(rnd.uniform(0, 8))))
+        lines.append(with_checksum("IIVTG,{0:.2f},T,,M,{1:.2f},N,,,A"
+                                   .format(rnd.uniform(0, 359),
+                                           rnd.uniform(0, 8))))
+        lines.append(with_checksum("IIHDG,{0:.1f},,,,"
+                                   .format(rnd.uniform(0, 359))))
+        lines.append(with_checksum("IIMTW,{0:.1f},C"
+                                   .format(rnd.uniform(5, 20))))
+        lines.append(with_checksum("GPRMC,{0},A,{1:.4f},N,0{2:.4f},E,"
+                                   "5.8,226.9,010613,,,A"
+                                   .format(ts, lat, lon)))
+        lines.append(with_checksum("GPGSA,A,3,04,05,,09,12,,,24,,,,,"
+                                   "2.5,1.3,2.1"))
+        for i in xrange(3):
+            lines.append(with_checksum("GPGSV,3,{0},11,03,03,111,00,"
+                                       "04,15,270,00,06,01,010,00,"
+                                       "13,06,292,00".format(i + 1)))
+    return lines[:count]
+
+def read_lines(input_file):
+    fo = gzip.open if input_file.endswith(".gz") else open
+    with fo(input_file) as input:
+        return input.readlines()
+
+def best_time(function, lines, rounds):
+    best = None
+    for i in xrange(rounds):
+        start = time.time()
+        records = function(lines)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (records, best)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the speed of "
+                                     "the NMEA parsing implementations.")
+    parser.add_argument('-i', '--input', dest="input_file",
+                        help="An NMEA file to parse. By default synthetic "
+                        "data is used")
+    parser.add_argument('-l', '--lines', dest="lines", type=int,
+                        default=500000,
+                        help="Number of synthetic lines")
+    parser.add_argument('-r', '--rounds', dest="rounds", type=int,
+                        default=3,
+                        help="Number of timed rounds; the best is reported")
+    args = parser.parse_args()
+
+    lines = read_lines(args.input_file) if args.input_file \
+        else synthetic_lines(args.lines)
+
+    variants = [("split", split_parse),
+                ("nmea_parser", parser_parse),
+                ("records", records_parse)]
+    if nmea_columns.available:
+        variants.append(("columns", columns_parse))
+    results = {}
+    for (name, function) in variants:
+        (records, seconds) = best_time(function, lines, args.rounds)
+        results[name] = seconds
+        print("{0:12} {1} lines, {2} records in {3:.3f} s: {4:.0f} lines/s"
+              .format(name, len(lines), records, seconds,
+                      len(lines) / seconds))
+    print("Speedup of nmea_parser over split: {0:.2f}x"
+          .format(results["split"] / results["nmea_parser"]))
+    if nmea_columns.available:
+        print("Speedup of columns over records: {0:.2f}x"
+              .format(results["records"] / results["columns"]))
+    else:
+        print("NumPy is not installed; columns was not timed")
+
+if __name__ == "__main__":
+    main()
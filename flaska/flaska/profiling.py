@@ -0,0 +1,274 @@
+import bisect
+import threading
+import time
+
+from collections import OrderedDict
+
+import psycopg2
+import psycopg2.extensions
+
+# Opt-in profiling of requests and loader runs.
+#
+# A Profile collects the time spent in the stages of one request or
+# loader run (database checkout, execute, fetch, serialize, render,
+# ...) and counters such as the number of rows fetched. The profile of
+# the current thread is set with activate(); timer(stage) measures a
+# stage in it, and does nothing if there is no active profile. Stage
+# times are exclusive: the time of a stage nested in another one is
+# not counted in the outer stage.
+#
+# Completed profiles are aggregated into histograms in a Metrics
+# registry, which is rendered in the Prometheus text format.
+
+# Histogram buckets for durations in seconds, row counts and sizes in
+# bytes.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+class StageTimer:
+    def __init__(self, profile, stage):
+        self.profile = profile
+        self.stage = stage
+
+    def __enter__(self):
+        self.profile.start(self.stage)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.stop()
+
+class NullTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+null_timer = NullTimer()
+
+class Profile:
+    """The stage times and counters of one request or loader run."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.durations = OrderedDict()
+        self.counts = OrderedDict()
+        # Running stages as [stage, start time, time in nested stages].
+        self.stack = []
+
+    def start(self, stage):
+        self.stack.append([stage, time.time(), 0.0])
+
+    def stop(self):
+        (stage, start, nested) = self.stack.pop()
+        elapsed = time.time() - start
+        self.durations[stage] = self.durations.get(stage, 0.0) + \
+            elapsed - nested
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.time()
+
+    def total(self):
+        return (self.finished or time.time()) - self.started
+
+    def timings(self):
+        """The stage times and the total as (stage, seconds) tuples."""
+        return self.durations.items() + [("total", self.total())]
+
+    def server_timing(self):
+        """The timings and counters as a Server-Timing header value."""
+        metrics = ["{};dur={:.2f}".format(stage, seconds * 1000.0)
+                   for (stage, seconds) in self.timings()]
+        metrics.extend("{};desc={}".format(name, value)
+                       for (name, value) in self.counts.items())
+        return ", ".join(metrics)
+
+local = threading.local()
+
+def current():
+    """The active profile of this thread, or None."""
+    return getattr(local, "profile", None)
+
+def activate(profile):
+    """Make profile the active one. Returns the previous one."""
+    previous = current()
+    local.profile = profile
+    return previous
+
+def timer(stage):
+    profile = current()
+    if profile is None:
+        return null_timer
+    return profile.timer(stage)
+
+def count(name, value):
+    profile = current()
+    if profile is not None:
+        profile.count(name, value)
+
+def timed_iter(iterable, stage):
+    """Iterate over iterable, timing each step as stage."""
+    iterator = iter(iterable)
+    while True:
+        with timer(stage):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+class ProfiledCursor(object):
+    """
+    Mixin for cursor classes that records the time of execute and of
+    the fetches, and the number of rows fetched, in the active profile.
+    """
+    def execute(self, query, vars=None):
+        with timer("execute"):
+            return super(ProfiledCursor, self).execute(query, vars)
+
+    def callproc(self, procname, vars=None):
+        with timer("execute"):
+            return super(ProfiledCursor, self).callproc(procname, vars)
+
+    def copy_from(self, *args, **kwargs):
+        with timer("copy"):
+            return super(ProfiledCursor, self).copy_from(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        with timer("copy"):
+            return super(ProfiledCursor, self).copy_expert(*args, **kwargs)
+
+    def fetchone(self):
+        with timer("fetch"):
+            row = super(ProfiledCursor, self).fetchone()
+        count("rows", 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        with timer("fetch"):
+            if size is None:
+                rows = super(ProfiledCursor, self).fetchmany()
+            else:
+                rows = super(ProfiledCursor, self).fetchmany(size)
+        count("rows", len(rows))
+        return rows
+
+    def fetchall(self):
+        with timer("fetch"):
+            rows = super(ProfiledCursor, self).fetchall()
+        count("rows", len(rows))
+        return rows
+
+    def __iter__(self):
+        rows = 0
+        try:
+            for row in timed_iter(super(ProfiledCursor, self).__iter__(),
+                                  "fetch"):
+                rows += 1
+                yield row
+        finally:
+            count("rows", rows)
+
+# Profiled subclasses of the cursor classes, by the cursor class.
+profiled_cursor_classes = {}
+
+def profiled_cursor_class(cursor_class):
+    if cursor_class not in profiled_cursor_classes:
+        profiled_cursor_classes[cursor_class] = \
+            type("Profiled" + cursor_class.__name__,
+                 (ProfiledCursor, cursor_class), {})
+    return profiled_cursor_classes[cursor_class]
+
+class ProfiledConnection(psycopg2.extensions.connection):
+    """
+    A connection whose cursors are profiled, for the connection_factory
+    argument of psycopg2.connect.
+    """
+    def cursor(self, *args, **kwargs):
+        cursor_class = kwargs.get("cursor_factory") or \
+            self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = profiled_cursor_class(cursor_class)
+        return psycopg2.extensions.connection.cursor(self, *args, **kwargs)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Observations by the bucket; the last one is +Inf.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Metrics:
+    """
+    A thread-safe registry of histograms. Each histogram is identified
+    by a metric name and a tuple of (label, value) pairs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Histograms by the metric name and the labels.
+        self.histograms = OrderedDict()
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def observe_timings(self, name, labels, timings):
+        """Observe (stage, seconds) tuples, labelled by the stage."""
+        for (stage, seconds) in timings:
+            self.observe(name, tuple(labels) + (("stage", stage), ),
+                         seconds, SECONDS_BUCKETS)
+
+    def render(self):
+        """The histograms in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            typed = set()
+            for ((name, labels), histogram) in sorted(
+                    self.histograms.items()):
+                if name not in typed:
+                    lines.append("# TYPE {} histogram".format(name))
+                    typed.add(name)
+                cumulative = 0
+                bounds = [repr(float(b)) for b in histogram.buckets]
+                for (bound, observed) in zip(bounds + ["+Inf"],
+                                             histogram.counts):
+                    cumulative += observed
+                    lines.append("{}_bucket{} {}"
+                                 .format(name,
+                                         label_set(labels + (("le", bound),
+                                                             )),
+                                         cumulative))
+                lines.append("{}_sum{} {!r}".format(name, label_set(labels),
+                                                   histogram.sum))
+                lines.append("{}_count{} {}".format(name, label_set(labels),
+                                                   cumulative))
+        return "\n".join(lines) + "\n"
+
+def label_set(labels):
+    return "{" + ",".join('{}="{}"'.format(label, escape_label(value))
+                          for (label, value) in labels) + "}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+# The metrics of this process.
+metrics = Metrics()
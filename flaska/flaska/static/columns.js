@@ -0,0 +1,99 @@
+/**
+ * Decoder for the columnar data format of the API (format=columns).
+ * See columns.py for the layout.
+ */
+define(function() {
+    'use strict';
+
+    var columns = {};
+
+    var arrayTypes = {
+        uint16: Uint16Array,
+        int32: Int32Array,
+        uint32: Uint32Array,
+        float32: Float32Array,
+        float64: Float64Array,
+        bits: Uint8Array
+    };
+
+    /**
+     * Decode an ArrayBuffer. Returns the header object, with the
+     * column data as typed arrays in the "data" property, keyed by
+     * column name.
+     */
+    columns.decode = function(buffer) {
+        var headerLength = new DataView(buffer).getUint32(4, true);
+        var headerBytes = new Uint8Array(buffer, 8, headerLength);
+        var headerStr = "";
+        for (var i = 0; i < headerBytes.length; ++i) {
+            headerStr += String.fromCharCode(headerBytes[i]);
+        }
+
+        var header = JSON.parse(headerStr);
+        var dataStart = 8 + headerLength;
+        dataStart += (8 - dataStart % 8) % 8;
+
+        header.data = {};
+        $.each(header.columns, function(i, column) {
+            var ArrayType = arrayTypes[column.type];
+            header.data[column.name] =
+                new ArrayType(buffer,
+                              dataStart + column.offset,
+                              column.length / ArrayType.BYTES_PER_ELEMENT);
+        });
+
+        return header;
+    };
+
+    /**
+     * Return the value of row i from a bits column.
+     */
+    columns.bit = function(bits, i) {
+        return (bits[i >> 3] & (1 << (i & 7))) != 0;
+    };
+
+    /**
+     * Round a float32 value to the precision of the source data so
+     * that it is shown as, say, 12.3 and not 12.300000190734863.
+     */
+    columns.round = function(value) {
+        return Math.round(value * 1000) / 1000;
+    };
+
+    /**
+     * Format seconds since the epoch as a "yyyymmddhhmiss" string,
+     * the timestamp format of the JSON data.
+     */
+    columns.timestamp = function(epochSeconds) {
+        var d = new Date(epochSeconds * 1000);
+        var pad = function(n) {
+            return (n < 10 ? "0" : "") + n;
+        };
+
+        return d.getUTCFullYear() +
+            pad(d.getUTCMonth() + 1) +
+            pad(d.getUTCDate()) +
+            pad(d.getUTCHours()) +
+            pad(d.getUTCMinutes()) +
+            pad(d.getUTCSeconds());
+    };
+
+    /**
+     * Load columnar data from path and call callback with the
+     * decoded data.
+     */
+    columns.load = function(path, callback) {
+        var request = new XMLHttpRequest();
+        request.open("GET", path + (path.indexOf("?") < 0 ? "?" : "&") +
+                     "format=columns");
+        request.responseType = "arraybuffer";
+        request.onload = function() {
+            if (request.status == 200) {
+                callback(columns.decode(request.response));
+            }
+        };
+        request.send();
+    };
+
+    return columns;
+});
@@ -9,7 +9,8 @@ define(function() {
             totalWidth: 430,
             visible: true
         };
-        var depths = [];
+        var bins = [];
+        var minDepth = 0;
         var maxDepth = 0;
         var depthGradient = gradient;
 
@@ -17,33 +18,31 @@ define(function() {
         var margin = {top: 10, right: 20, bottom: 25, left: 10};
         var height = 440 - margin.top - margin.bottom;
 
-        // Constants. Copy-pasta, to be removed.
-        var allMeasurements = 0;
-        var validMeasurements = 1;
-        var badMeasurements = 2;
-
         function actualWidth() {
             return that.totalWidth - margin.left - margin.right;
         }
 
-        that.setDepths = function(depthMeasurements, measurementsToShow) {
-            measurementsToShow = measurementsToShow || allMeasurements;
+        // Show the depth statistics from /api/1/depth_stats/. The
+        // histograms of tileStats (a list of statistics) are added
+        // together.
+        that.setStats = function(tileStats) {
+            var counts = {};
 
-            depths = [];
+            bins = [];
+            minDepth = 0;
             maxDepth = 0;
 
-            for (var dm in depthMeasurements) {
-                if (depthMeasurements.hasOwnProperty(dm)) {
-                    var depth = Math.ceil(depthMeasurements[dm].point.depth);
-
-                    if (allMeasurements == measurementsToShow ||
-                        (badMeasurements == measurementsToShow &&
-                         depthMeasurements[dm].point.d_bad) ||
-                        (validMeasurements == measurementsToShow &&
-                         !depthMeasurements[dm].point.d_bad)) {
-                        addDepthMeasurement(depth);
-                    }
-                }
+            $.each(tileStats, function(i, stats) {
+                $.each(stats.bins, function(j, bin) {
+                    counts[bin[0]] = (counts[bin[0]] || 0) + bin[1];
+                    minDepth = Math.min(minDepth, bin[0] - 1);
+                    maxDepth = Math.max(maxDepth, bin[0]);
+                });
+            });
+
+            // The bins are 1 m wide, and keyed by their upper bound.
+            for (var depth = minDepth + 1; depth <= maxDepth; ++depth) {
+                bins.push({ x: depth - 1, dx: 1, y: counts[depth] || 0 });
             }
 
             that.showHistogram();
@@ -66,23 +65,19 @@ define(function() {
             $(graphElement).css({"width": (actualWidth() + margin.left + margin.right) + "px" })
         }
 
-        var addDepthMeasurement = function(depth) {
-            depths.push(depth);
-            maxDepth = Math.max(maxDepth, depth);
-        }
-
         var createHistogram = function() {
             // Formatters for counts and depths
             var formatCount = d3.format(".0f");
             var formatDepth = d3.format(".0f");
 
             var x = d3.scale.linear()
-                .domain([0, maxDepth])
+                .domain([minDepth, maxDepth])
                 .range([0, actualWidth()]);
 
-            // Generate a histogram using uniformly-spaced bins.
-            var data = d3.layout.histogram()
-                .bins(x.ticks(Math.floor(maxDepth / 2)))(depths);
+            var data = bins;
+            if (data.length == 0) {
+                return;
+            }
 
             var y = d3.scale.linear()
                 .domain([0, d3.max(data, function(d) { return d.y; })])
@@ -109,7 +104,7 @@ define(function() {
 
             bar.append("rect")
                 .attr("x", 1)
-                .attr("width", x(data[0].dx) - 1)
+                .attr("width", x(minDepth + data[0].dx) - 1)
                 .attr("height", function(d) { return height - y(d.y); })
                 .attr("fill", function(d) { return depthGradient.color(d.x); });
 
@@ -117,7 +112,7 @@ define(function() {
                 .attr("class", "label")
                 .attr("dy", ".75em")
                 .attr("y", 6)
-                .attr("x", x(data[0].dx) / 2)
+                .attr("x", x(minDepth + data[0].dx) / 2)
                 .attr("text-anchor", "middle")
                 .attr("writing-mode", "tb")
                 .text(function(d) { return formatCount(d.y); });
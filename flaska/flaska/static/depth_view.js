@@ -1,8 +1,8 @@
 /**
  * A map that shows depth measurements.
  */
-define(["map_view", "depth_gradient", "depth_histogram"],
-       function(MapView, DepthGradient, DepthHistogram) {
+define(["map_view", "depth_gradient", "depth_histogram", "columns"],
+       function(MapView, DepthGradient, DepthHistogram, columns) {
     'use strict';
 
     function DepthView() {
@@ -20,12 +20,41 @@ define(["map_view", "depth_gradient", "depth_histogram"],
         // all measurements.
         var measurementDisplayStatus = validMeasurements;
 
+        // The validity filters of /api/1/depth_stats/ by
+        // measurementDisplayStatus.
+        var statsValidity = ["all", "valid", "bad"];
+
+        // Incremented for each new set of statistics to load, so that
+        // late responses of the earlier sets can be ignored.
+        var statsGeneration = 0;
+
         // The gradient colors to use
         var gradient = new DepthGradient();
         var histogram = new DepthHistogram(gradient, "#graph");
 
         var validDepthCheckboxName = "validDepthCheckBox";
 
+        // Below this zoom level the valid depths are shown as raster
+        // tiles of the depth grid instead of markers.
+        var rasterZoom = 14;
+
+        var gridOverlay = new google.maps.ImageMapType({
+            getTileUrl: function(coord, zoom) {
+                var n = 1 << zoom;
+                if (coord.y < 0 || coord.y >= n) {
+                    return null;
+                }
+                // The map repeats to the east and west.
+                var x = ((coord.x % n) + n) % n;
+                return "/api/1/depth_grid/tile/" + zoom + "/" + x + "/" +
+                    coord.y;
+            },
+            tileSize: new google.maps.Size(256, 256),
+            maxZoom: rasterZoom - 1,
+            name: "Depth grid"
+        });
+        var gridVisible = false;
+
         // Start of the public or overridden methods of the base.
 
         // Sets up an event lister for each marker so that clicking brings
@@ -94,31 +123,97 @@ define(["map_view", "depth_gradient", "depth_histogram"],
         // Load the depth data. This is the main function herein. This
         // function gets called whenever the map is zoomed or panned.
         that.update = function(oldZoom, newZoom) {
-            if (that.zoomBoundaryCrossed(oldZoom, newZoom)) {
+            var grid = gridShown(newZoom);
+
+            setGridVisible(grid);
+            if (grid || that.zoomBoundaryCrossed(oldZoom, newZoom)) {
                 that.dropAllPoints(depthMarkers);
             }
             else {
                 that.dropPointsOutsideBounds(depthMarkers);
             }
 
-            var path = "/api/1/depth_data/" +
-                that.getMapParams();
+            if (!grid) {
+                $.each(that.visibleTiles(), function(i, tile) {
+                    loadTile(tile, newZoom);
+                });
+            }
+            loadStats();
+        };
+
+        // Whether the depths are shown from the depth grid at a zoom
+        // level. The grid only has the valid depths.
+        var gridShown = function(zoom) {
+            return zoom < rasterZoom &&
+                measurementDisplayStatus == validMeasurements;
+        };
 
-            $.getJSON(path, function(depthData) {
-                $.each(depthData.depths, function(i, point) {
-                    if (depthMarkers.hasOwnProperty(point.p_id)) {
+        var setGridVisible = function(visible) {
+            if (visible == gridVisible) {
+                return;
+            }
+            if (visible) {
+                that.map.overlayMapTypes.push(gridOverlay);
+            }
+            else {
+                that.map.overlayMapTypes.clear();
+            }
+            gridVisible = visible;
+        };
+
+        var loadTile = function(tile, zoom) {
+            var path = "/api/1/depth_data/tile/" + that.tilePath(tile);
+
+            columns.load(path, function(depthData) {
+                var d = depthData.data;
+
+                if (gridShown(that.map.getZoom())) {
+                    // A late response from before the zoom change.
+                    return;
+                }
+
+                for (var i = 0; i < depthData.count; ++i) {
+                    if (depthMarkers.hasOwnProperty(d.p_id[i])) {
                         // Skip the ones that we have already.
-                        return;
+                        continue;
                     }
 
+                    var point = { p_id: d.p_id[i],
+                                  t_id: d.t_id[i],
+                                  t_utc: columns.timestamp(d.t_utc[i]),
+                                  lat: d.lat[i],
+                                  lon: d.lon[i],
+                                  depth: columns.round(d.depth[i]),
+                                  d_bad: columns.bit(d.d_bad, i) };
                     var color = gradient.color(point.depth);
-                    var marker = that.makeMarker(point, color, newZoom);
+                    var marker = that.makeMarker(point, color, zoom);
                     setToMap(marker);
 
                     depthMarkers[point.p_id] = marker;
-                });
+                }
+            });
+        };
 
-                histogram.setDepths(depthMarkers, measurementDisplayStatus);
+        // Load the depth statistics of the visible tiles for the
+        // histogram.
+        var loadStats = function() {
+            var tiles = that.visibleTiles();
+            var tileStats = [];
+            var generation = ++statsGeneration;
+            var validity = statsValidity[measurementDisplayStatus];
+
+            $.each(tiles, function(i, tile) {
+                $.getJSON("/api/1/depth_stats/tile/" + that.tilePath(tile),
+                          { validity: validity },
+                          function(stats) {
+                              if (generation != statsGeneration) {
+                                  return;
+                              }
+                              tileStats.push(stats);
+                              if (tileStats.length == tiles.length) {
+                                  histogram.setStats(tileStats);
+                              }
+                          });
             });
         };
 
@@ -159,17 +254,25 @@ define(["map_view", "depth_gradient", "depth_histogram"],
                     setToMap(marker);
                 }
             }
-            histogram.setDepths(depthMarkers, measurementDisplayStatus);
+            loadStats();
         }
 
         var setupControlPanel = function() {
             $.get("/snippets/depth_view/control_panel/", function(data) {
                 $("#controls").html(data);
                 $(".measurement_selector_radio").click(function() {
+                    var zoom = that.map.getZoom();
+                    var grid = gridShown(zoom);
+
                     measurementDisplayStatus =
                         $('.measurement_selector_radio:checked').val();
-                    reFilterMeasurements();
-
+                    if (gridShown(zoom) != grid) {
+                        // Switch between the grid and the markers.
+                        that.update(zoom, zoom);
+                    }
+                    else {
+                        reFilterMeasurements();
+                    }
                 });
                 setupHistogramActiveBinding();
             });
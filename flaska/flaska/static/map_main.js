@@ -13,7 +13,7 @@ function loadMap() {
         "v=3.10&" +
         "key=" + mapsKey +
         "&sensor=false" +
-        "&libraries=visualization" +
+        "&libraries=visualization,geometry" +
         "&callback=viewLoader";
 
     document.body.appendChild(script);
@@ -245,6 +245,41 @@ define(function() {
                 "&mPerPix=" + mPerPix;
         };
 
+        // Returns the map tiles that cover the current view as
+        // { z: zoom, x: x, y: y } objects. The tiles follow the
+        // same numbering as the tiles of Google Maps.
+        that.visibleTiles = function() {
+            var bounds = that.map.getBounds();
+            var z = that.map.getZoom();
+            var sw = tileXY(z, bounds.getSouthWest());
+            var ne = tileXY(z, bounds.getNorthEast());
+            var tiles = [];
+
+            for (var x = sw.x; x <= ne.x; ++x) {
+                for (var y = ne.y; y <= sw.y; ++y) {
+                    tiles.push({ z: z, x: x, y: y });
+                }
+            }
+            return tiles;
+        };
+
+        // Utility for creating the URL path of a tile.
+        that.tilePath = function(tile) {
+            return tile.z + "/" + tile.x + "/" + tile.y;
+        };
+
+        var tileXY = function(z, latLng) {
+            var n = Math.pow(2, z);
+            var lat = latLng.lat() * Math.PI / 180.0;
+            var x = Math.floor((latLng.lng() + 180.0) / 360.0 * n);
+            var y = Math.floor((1.0 - Math.log(Math.tan(lat) +
+                                               1.0 / Math.cos(lat)) /
+                                Math.PI) / 2.0 * n);
+
+            return { x: Math.min(Math.max(x, 0), n - 1),
+                     y: Math.min(Math.max(y, 0), n - 1) };
+        };
+
         google.maps.event.addListener(that.map, 'bounds_changed', function() {
             if (!that.dragging) {
                 viewChanged();
@@ -1,7 +1,7 @@
 /**
  * A view of the trips.
  */
-define(["map_view"], function(MapView) {
+define(["map_view", "columns"], function(MapView, columns) {
     'use strict';
 
     function TripView() {
@@ -13,6 +13,13 @@ define(["map_view"], function(MapView) {
         // Trips currently selected.
         var tripsInView = {};
 
+        // Simplified track lines of the selected trips, by trip id.
+        var tracks = {};
+
+        // Below this zoom level the trips are drawn as track lines
+        // instead of markers.
+        var trackZoom = 15;
+
         // Re-implemented from the base class.
         that.update = function(oldZoom, newZoom) {
             if (that.zoomBoundaryCrossed(oldZoom, newZoom)) {
@@ -25,16 +32,39 @@ define(["map_view"], function(MapView) {
             for (var tripId in tripsInView) {
                 if (tripsInView.hasOwnProperty(tripId) &&
                     tripsInView[tripId] === true) {
-                    downloadAndShow(tripId, newZoom);
+                    showTrip(tripId, newZoom);
                 }
             }
+
+            loadTrips();
         }
 
-        // Fetch the list of trips from the server and show it.
-        var loadTrips = function() {
-            $.getJSON("/api/1/trip/", function(tripData) {
-                $("#controls").html("<p>Trips:</p> " +
-                                    '<form id="latestTripsForm"></form>');
+        // Number of trips fetched at a time.
+        var tripPageSize = 20;
+
+        // Incremented for each new trip list, so that late responses
+        // for the earlier lists can be ignored.
+        var tripListGeneration = 0;
+
+        // Fetch the list of the trips in the map view from the server
+        // and show it. If after is given, the next page of the list
+        // is appended to the list.
+        var loadTrips = function(after) {
+            var generation = after ? tripListGeneration
+                : ++tripListGeneration;
+            var path = "/api/1/trip/" + that.getMapParams() +
+                "&limit=" + tripPageSize +
+                (after ? "&after=" + encodeURIComponent(after) : "");
+
+            $.getJSON(path, function(tripData) {
+                if (generation != tripListGeneration) {
+                    return;
+                }
+                if (!after) {
+                    $("#controls").html("<p>Trips in view:</p> " +
+                                        '<form id="latestTripsForm"></form>');
+                }
+                $("#moreTrips").remove();
                 $.each(tripData.trips, function(i, trip) {
                     var tripId = that.encode(trip.t_id);
                     var checkboxId = "tripEnabled" + tripId;
@@ -47,10 +77,19 @@ define(["map_view"], function(MapView) {
                         "</div>";
                     $("#latestTripsForm").append(tripString);
                     $("#" + checkboxId)
+                        .prop("checked", tripsInView[tripId] === true)
                         .click(tripDisplayCallback);
                     $("#" + editId)
                         .click(tripEditCallback);
                 });
+                if (tripData.next) {
+                    $("#latestTripsForm").append(
+                        '<a href="#" id="moreTrips">More trips</a>');
+                    $("#moreTrips").click(function(ev) {
+                        ev.preventDefault();
+                        loadTrips(tripData.next);
+                    });
+                }
             });
         }
 
@@ -81,7 +120,7 @@ define(["map_view"], function(MapView) {
             var tripId = ev.currentTarget.value;
             if (this.checked) {
                 tripsInView[tripId] = true;
-                that.update();
+                showTrip(tripId, that.map.getZoom());
             }
             else {
                 dropTrip(tripId);
@@ -102,28 +141,107 @@ define(["map_view"], function(MapView) {
             var editForm = "";
         }
 
-        var downloadAndShow = function(tripId, zoom) {
+        // Show a trip as a track line or as markers, depending on the
+        // zoom level.
+        var showTrip = function(tripId, zoom) {
+            if (zoom < trackZoom) {
+                dropTripPoints(tripId);
+                downloadTrack(tripId);
+            }
+            else {
+                dropTrack(tripId);
+                downloadAndShow(tripId, zoom);
+            }
+        };
+
+        // Fetch the track of a trip simplified for the current view,
+        // unless the track on the map is already the right one.
+        var downloadTrack = function(tripId) {
             var path = "/api/1/trip/" +
                 that.encode(tripId) +
+                "/track" +
                 that.getMapParams();
 
-            $.getJSON(path, function(tripData) {
-                $.each(tripData.points, function(i, point) {
-                    if (points.hasOwnProperty(point.p_id)) {
+            $.getJSON(path, function(track) {
+                if (tripsInView[tripId] !== true ||
+                    that.map.getZoom() >= trackZoom) {
+                    return;
+                }
+                if (tracks.hasOwnProperty(tripId) &&
+                    tracks[tripId].range === track.range) {
+                    return;
+                }
+
+                dropTrack(tripId);
+                var line = new google.maps.Polyline({
+                    path: google.maps.geometry.encoding.decodePath(
+                        track.polyline),
+                    strokeColor: "#ff0000",
+                    strokeOpacity: 0.8,
+                    strokeWeight: 2
+                });
+                line.setMap(that.map);
+                tracks[tripId] = { range: track.range, line: line };
+            });
+        };
+
+        var dropTrack = function(tripId) {
+            if (tracks.hasOwnProperty(tripId)) {
+                tracks[tripId].line.setMap(null);
+                delete tracks[tripId];
+            }
+        };
+
+        var downloadAndShow = function(tripId, zoom) {
+            $.each(that.visibleTiles(), function(i, tile) {
+                downloadTile(tripId, tile, zoom);
+            });
+        };
+
+        // Measurement columns of the trip points.
+        var measurementNames = ["depth", "ws", "gs", "course"];
+
+        var downloadTile = function(tripId, tile, zoom) {
+            var path = "/api/1/trip/" +
+                that.encode(tripId) +
+                "/tile/" +
+                that.tilePath(tile);
+
+            columns.load(path, function(tripData) {
+                var d = tripData.data;
+
+                for (var i = 0; i < tripData.count; ++i) {
+                    if (points.hasOwnProperty(d.p_id[i])) {
                         // Skip the ones that we have already.
-                        return;
+                        continue;
                     }
 
-                    point.tripId = tripId;
+                    var point = { p_id: d.p_id[i],
+                                  t_utc: columns.timestamp(d.t_utc[i]),
+                                  lat: d.lat[i],
+                                  lon: d.lon[i],
+                                  tripId: tripId };
+                    // Measurements that were not recorded for the
+                    // position are NaN and left out.
+                    $.each(measurementNames, function(j, name) {
+                        if (!isNaN(d[name][i])) {
+                            point[name] = columns.round(d[name][i]);
+                        }
+                    });
                     var marker = that.makeMarker(point, "#ff0000", zoom);
                     showOnMap(marker);
                     points[point.p_id] = marker;
-                });
+                }
             });
         };
 
         var dropTrip = function(tripId) {
             tripsInView[tripId] = false;
+            dropTrack(tripId);
+            dropTripPoints(tripId);
+        };
+
+        var dropTripPoints = function(tripId) {
             for (var posId in points) {
                 if (points.hasOwnProperty(posId)) {
                     var point = points[posId];
@@ -146,8 +264,6 @@ define(["map_view"], function(MapView) {
             }
         };
 
-        loadTrips();
-
         return that;
     }
     var tv = new TripView();
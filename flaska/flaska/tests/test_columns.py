@@ -0,0 +1,93 @@
+import array
+import math
+import sys
+import unittest
+
+import columns
+from columns import ColumnRows, decode_header, encode_columns
+
+def decode(data):
+    """Decode all the columns of encoded data as lists by the name."""
+    header = decode_header(data)
+    values = {}
+    for column in header["columns"]:
+        block = data[column["offset"]:column["offset"] + column["length"]]
+        if column["type"] == columns.BITS:
+            values[column["name"]] = [
+                bool(ord(block[i >> 3]) & (1 << (i & 7)))
+                for i in xrange(header["count"])]
+        else:
+            column_values = array.array(
+                columns.typecodes[column["type"]], block)
+            if sys.byteorder != "little":
+                column_values.byteswap()
+            values[column["name"]] = column_values.tolist()
+    return (header, values)
+
+sample_columns = (("id", columns.INT32),
+                  ("t", columns.UINT32),
+                  ("range", columns.UINT16),
+                  ("lat", columns.FLOAT64),
+                  ("depth", columns.FLOAT32),
+                  ("bad", columns.BITS))
+
+def sample_rows(count):
+    return [{ "id": i - 5,
+              "t": 1370000000 + i,
+              "range": i * 10,
+              "lat": 60.0 + i / 1000.0 if i % 7 else None,
+              "depth": i / 4.0 if i % 5 else None,
+              "bad": i % 3 == 0,
+              "unused": "x" }
+            for i in xrange(count)]
+
+def nan_as_none(values):
+    return [None if math.isnan(value) else value for value in values]
+
+class ColumnsTest(unittest.TestCase):
+    def test_round_trip(self):
+        for count in (0, 1, 7, 8, 9, 100):
+            rows = sample_rows(count)
+            (header, values) = decode(encode_columns(rows, sample_columns,
+                                                     trip=12))
+            self.assertEqual(header["count"], count)
+            self.assertEqual(header["trip"], 12)
+            self.assertEqual([column["name"]
+                              for column in header["columns"]],
+                             [name for (name, column_type)
+                              in sample_columns])
+            for name in ("id", "t", "range", "bad"):
+                self.assertEqual(values[name], [row[name] for row in rows])
+            # NULLs are NaN in floating point columns.
+            for name in ("lat", "depth"):
+                self.assertEqual(nan_as_none(values[name]),
+                                 [row[name] for row in rows])
+
+    def test_alignment(self):
+        data = encode_columns(sample_rows(13), sample_columns)
+        header = decode_header(data)
+        for column in header["columns"]:
+            self.assertEqual(column["offset"] % 8, 0)
+        self.assertEqual(len(data) % 8, 0)
+
+    def test_column_rows(self):
+        # ColumnRows are encoded as the same rows would be.
+        for count in (0, 5, 64):
+            rows = sample_rows(count)
+            values = dict((name, [row[name] for row in rows])
+                          for (name, column_type) in sample_columns)
+            column_rows = ColumnRows(values, count)
+            self.assertEqual(encode_columns(column_rows, sample_columns),
+                             encode_columns(rows, sample_columns))
+            self.assertEqual([dict((name, row[name]) for name in values)
+                              for row in rows], list(column_rows))
+
+    def test_buffer(self):
+        data = encode_columns(sample_rows(10), sample_columns)
+        self.assertEqual(decode_header(buffer(data)), decode_header(data))
+
+    def test_not_columns(self):
+        self.assertRaises(ValueError, decode_header, "[1, 2, 3]")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+import threading
+import time
+import unittest
+
+import psycopg2
+import psycopg2.extensions
+
+import db_pool
+from db_pool import ConnectionPool, PoolError
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query):
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+class PoolTest(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+        # The number of the next connects that fail.
+        self.failures = 0
+        self.connect = psycopg2.connect
+        db_pool.psycopg2.connect = self.fake_connect
+
+    def tearDown(self):
+        db_pool.psycopg2.connect = self.connect
+
+    def fake_connect(self, connect_string, connection_factory=None):
+        if self.failures:
+            self.failures -= 1
+            raise psycopg2.OperationalError("could not connect")
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    def open_count(self, pool):
+        return len(pool.created) + pool.opening
+
+    def test_checkout(self):
+        pool = ConnectionPool("dbname=test", min_size=2, max_size=3)
+        conn = pool.getconn()
+        self.assertEqual(len(self.connections), 2)
+        self.assertIn(conn, self.connections)
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        other = pool.getconn()
+        self.assertIsNot(other, conn)
+        third = pool.getconn()
+        self.assertEqual(len(self.connections), 3)
+        for c in (conn, other, third):
+            pool.putconn(c)
+        self.assertEqual(len(pool.idle), 3)
+        self.assertFalse(any(c.closed for c in self.connections))
+
+    def test_rollback(self):
+        pool = ConnectionPool("dbname=test")
+        conn = pool.getconn()
+        conn.status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+        pool.putconn(conn)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertIs(pool.getconn(), conn)
+
+        conn.status = psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+        pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.open_count(pool), 0)
+
+    def test_timeout(self):
+        pool = ConnectionPool("dbname=test", max_size=2, timeout=0.05)
+        conns = [pool.getconn(), pool.getconn()]
+        start = time.time()
+        self.assertRaises(PoolError, pool.getconn)
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(len(self.connections), 2)
+
+        # A waiting getconn gets the connection that is returned.
+        timer = threading.Timer(0.05, pool.putconn, (conns[1], ))
+        timer.start()
+        pool.timeout = 5
+        self.assertIs(pool.getconn(), conns[1])
+        timer.join()
+
+        # So it does when a connection is closed.
+        timer = threading.Timer(0.05, pool.discard, (conns[0], ))
+        timer.start()
+        conn = pool.getconn()
+        timer.join()
+        self.assertEqual(len(self.connections), 3)
+        self.assertIs(conn, self.connections[2])
+
+    def test_lifetime(self):
+        pool = ConnectionPool("dbname=test", max_lifetime=60)
+        conn = pool.getconn()
+        pool.created[conn] -= 100
+        pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.idle, [])
+
+        conn = pool.getconn()
+        pool.putconn(conn)
+        pool.created[conn] -= 100
+        other = pool.getconn()
+        self.assertTrue(conn.closed)
+        self.assertIsNot(other, conn)
+        self.assertEqual(self.open_count(pool), 1)
+
+    def test_health_check(self):
+        pool = ConnectionPool("dbname=test", health_check_idle=30)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        # Broken, but used recently: not checked.
+        conn.broken = True
+        self.assertIs(pool.getconn(), conn)
+        pool.putconn(conn)
+        pool.idle = [(conn, time.time() - 60)]
+        other = pool.getconn()
+        self.assertIsNot(other, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.open_count(pool), 1)
+
+        pool.putconn(other)
+        pool.idle = [(other, time.time() - 60)]
+        self.assertIs(pool.getconn(), other)
+        self.assertEqual(other.rollbacks, 1)
+
+    def test_fill_failure(self):
+        pool = ConnectionPool("dbname=test", min_size=3, max_size=3,
+                              timeout=0.05)
+        self.failures = 1
+        self.assertRaises(psycopg2.OperationalError, pool.getconn)
+        self.assertEqual(self.open_count(pool), 0)
+        self.assertFalse(pool.filled)
+
+        # The second connection fails: the first one stays in the pool.
+        pool = ConnectionPool("dbname=test", min_size=3, max_size=3,
+                              timeout=0.05)
+        real_connect = pool.connect
+        calls = []
+        def connect():
+            calls.append(None)
+            if len(calls) == 2:
+                self.failures = 1
+            return real_connect()
+        pool.connect = connect
+        self.assertRaises(psycopg2.OperationalError, pool.getconn)
+        self.assertEqual((pool.opening, len(pool.created), len(pool.idle)),
+                         (0, 1, 1))
+
+        # The next getconn fills the pool.
+        conns = [pool.getconn() for i in xrange(3)]
+        self.assertTrue(pool.filled)
+        self.assertEqual(len(self.connections), 3)
+        self.assertRaises(PoolError, pool.getconn)
+
+    def test_connect_failure(self):
+        pool = ConnectionPool("dbname=test", min_size=0, max_size=1,
+                              timeout=0.05)
+        self.failures = 1
+        self.assertRaises(psycopg2.OperationalError, pool.getconn)
+        self.assertEqual(self.open_count(pool), 0)
+        self.assertIs(pool.getconn(), self.connections[0])
+
+if __name__ == "__main__":
+    unittest.main()
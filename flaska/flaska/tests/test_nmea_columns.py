@@ -0,0 +1,162 @@
+import datetime
+import random
+import unittest
+
+import nmea_columns
+from nmea_columns import ColumnParser, numpy, position_days
+from nmea_file_loader import Sample
+from nmea_parser import NmeaParser, ParseError, Position, TripClock
+
+def with_checksum(sentence):
+    value = 0
+    for c in sentence[1:]:
+        value ^= ord(c)
+    return "{0}*{1:02X}\r\n".format(sentence, value)
+
+def nmea_lines(count, seed=1):
+    """Lines of all the sentence kinds, over midnight."""
+    rand = random.Random(seed)
+    lines = ["$IIDBT,,,4.5,M,,\r\n"]
+    seconds = 86400 - count / 16
+    for i in xrange(count):
+        choice = rand.randrange(8)
+        if choice == 0:
+            seconds += 1
+            t = seconds % 86400
+            line = "$GPGLL,{0:02d}{1:07.4f},{2},{3:03d}{4:07.4f},{5}," \
+                "{6:02d}{7:02d}{8:02d},A,A".format(
+                    rand.randrange(90), rand.uniform(0, 60),
+                    rand.choice("NS"),
+                    rand.randrange(180), rand.uniform(0, 60),
+                    rand.choice("EW"),
+                    t / 3600, t / 60 % 60, t % 60)
+        elif choice == 1:
+            line = "$IIDBT,,,{0:.1f},{1},,".format(rand.uniform(0, 50),
+                                                   rand.choice("MMMf"))
+        elif choice == 2:
+            line = "$IIMWV,{0},{1},{2:.1f},{3},A".format(
+                rand.randrange(360), rand.choice("RT"),
+                rand.uniform(0, 20), rand.choice("NKM"))
+        elif choice == 3:
+            line = "$IIVHW,,,,,{0:.1f},N,,K".format(rand.uniform(0, 9))
+        elif choice == 4:
+            line = "$IIVTG,{0:.2f},T,,M,{1:.2f},N,,,D".format(
+                rand.uniform(0, 360), rand.uniform(0, 9))
+        elif choice == 5:
+            line = "$GPGSV,3,1,11,03,03,111,00"
+        elif choice == 6:
+            line = "$GPGLL,,,,,000000,V,N"
+        else:
+            line = "$IIMWV,,R,,N,A"
+        if rand.randrange(20) == 0:
+            line += "*00\r\n"
+        elif rand.randrange(10) == 0:
+            line += "\r\n"
+        else:
+            line = with_checksum(line)
+        lines.append(line)
+    return lines
+
+def per_line_rows(lines, clock):
+    """The rows of the positions as the per-line loader makes them."""
+    parser = NmeaParser()
+    rows = []
+    for record in parser.parse(lines):
+        if type(record) is Position:
+            sample = Sample()
+            rows.append((clock.timestamp(record), record.lat, record.lon,
+                         sample))
+        elif rows:
+            sample.add(record)
+    return ([(time, lat, lon, sample.values())
+             for (time, lat, lon, sample) in rows], parser)
+
+def column_rows(lines, clock, chunk_lines):
+    parser = ColumnParser(chunk_lines=chunk_lines)
+    rows = []
+    for chunk in parser.parse(lines, clock):
+        rows.extend((chunk.times[i], chunk.latitudes[i],
+                     chunk.longitudes[i],
+                     tuple(values[i] for values in chunk.values))
+                    for i in xrange(chunk.positions))
+    return (rows, parser)
+
+def parse_error(parser, *args):
+    try:
+        list(parser.parse(*args))
+    except ParseError, ex:
+        return (str(ex), parser.lines)
+
+@unittest.skipUnless(nmea_columns.available, "NumPy is not installed")
+class ColumnParserTest(unittest.TestCase):
+    def test_same_as_per_line(self):
+        lines = nmea_lines(5000)
+        start = datetime.date(2013, 6, 1)
+        (expected, reference) = per_line_rows(lines, TripClock(start))
+        self.assertTrue(len(expected) > 500)
+        for chunk_lines in (1, 7, 1000, len(lines) + 1):
+            (rows, parser) = column_rows(lines, TripClock(start),
+                                         chunk_lines)
+            self.assertEqual(rows, expected)
+            self.assertEqual((parser.lines, parser.sentences,
+                              parser.bad_checksums),
+                             (reference.lines, reference.sentences,
+                              reference.bad_checksums))
+
+    def test_continued_clock(self):
+        lines = nmea_lines(2000, seed=2)
+        last_time = datetime.datetime(2013, 6, 2, 23, 59, 0)
+        (expected, reference) = per_line_rows(
+            lines, TripClock(datetime.date(2013, 6, 1), last_time))
+        (rows, parser) = column_rows(
+            lines, TripClock(datetime.date(2013, 6, 1), last_time), 100)
+        self.assertEqual(rows, expected)
+
+    def test_no_positions(self):
+        (rows, parser) = column_rows(["$IIDBT,,,4.5,M,,\r\n"] * 3,
+                                     TripClock(datetime.date(2013, 6, 1)),
+                                     1)
+        self.assertEqual(rows, [])
+        self.assertEqual((parser.lines, parser.sentences), (3, 3))
+
+    def test_errors(self):
+        good = nmea_lines(300, seed=3)
+        for bad in ("$IIVHW,,,,,5.0,K,9.2,K",
+                    "$IIVTG,226.95,T,,M,5.80,K,,,D",
+                    "$IIDBT,,,1x,M,,",
+                    "$IIMWV,1x0,R,10.0,N,A",
+                    "$GPGLL,6009.0403,N,02457.99x5,E,101112,A,A",
+                    "$GPGLL,6009.0403,N,02457.9985,E,10:11:12,A,A"):
+            lines = good[:200] + [with_checksum(bad)] + good[200:]
+            expected = parse_error(NmeaParser(), lines)
+            self.assertEqual(expected[1], 201)
+            for chunk_lines in (10, 1000):
+                clock = TripClock(datetime.date(2013, 6, 1))
+                self.assertEqual(parse_error(ColumnParser(
+                    chunk_lines=chunk_lines), lines, clock), expected)
+
+@unittest.skipUnless(nmea_columns.available, "NumPy is not installed")
+class PositionDaysTest(unittest.TestCase):
+    def test_same_as_clock(self):
+        rand = random.Random(4)
+        # Times around midnight, with late fixes and steps back.
+        times = [rand.choice((rand.randrange(86400),
+                              rand.randrange(85500, 86400),
+                              rand.randrange(0, 900)))
+                 for i in xrange(3000)]
+        start = datetime.date(2013, 6, 1)
+        for last_time in (None, datetime.datetime(2013, 6, 3, 0, 1)):
+            clock = TripClock(start, last_time)
+            expected = [clock.next_day(seconds) for seconds in times]
+            clock = TripClock(start, last_time)
+            days = []
+            for i in xrange(0, len(times), 250):
+                days.extend(position_days(
+                    numpy.array(times[i:i + 250], dtype=numpy.int64),
+                    clock).tolist())
+            self.assertEqual(days, expected)
+            self.assertEqual((clock.day, clock.seconds),
+                             (expected[-1], times[-1]))
+
+if __name__ == "__main__":
+    unittest.main()
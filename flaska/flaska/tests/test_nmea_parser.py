@@ -0,0 +1,217 @@
+import datetime
+import unittest
+
+import nmea_parser
+from nmea_parser import NmeaParser, ParseError, Position, Depth, Wind, \
+    WaterSpeed, GroundSpeedCourse, TripClock, checksum, time_of_day, \
+    DAY_SECONDS, LATE_FIX_SECONDS
+
+def reference_checksum(sentence):
+    value = 0
+    for c in sentence:
+        value ^= ord(c)
+    return value
+
+def with_checksum(sentence):
+    return "{0}*{1:02X}\r\n".format(sentence,
+                                    reference_checksum(sentence[1:]))
+
+def parse(lines, require_checksum=False):
+    parser = NmeaParser(require_checksum)
+    return (list(parser.parse(lines)), parser)
+
+GLL = "$GPGLL,6009.0403,N,02457.9985,E,101112,A,A"
+DBT = "$IIDBT,,,12.3,M,,"
+
+class ChecksumTest(unittest.TestCase):
+    def test_checksum(self):
+        for length in xrange(1, 140):
+            sentence = "".join(chr(32 + (i * 7 + length) % 95)
+                               for i in xrange(length))
+            self.assertEqual(checksum(sentence),
+                             reference_checksum(sentence))
+
+    def test_hex_values(self):
+        self.assertEqual(nmea_parser.hex_values["5E"], 0x5e)
+        self.assertEqual(nmea_parser.hex_values["5e"], 0x5e)
+        self.assertEqual(nmea_parser.hex_values["00"], 0)
+        self.assertNotIn("5", nmea_parser.hex_values)
+
+    def test_check_sentences(self):
+        found = [(1, "a", with_checksum(GLL)),
+                 (2, "b", GLL + "*00\r\n"),
+                 (3, "c", DBT + "\r\n")]
+        self.assertEqual(nmea_parser.check_sentences(found, False),
+                         [(1, "a", GLL), (2, None, GLL + "*00\r\n"),
+                          (3, "c", DBT)])
+        self.assertEqual(nmea_parser.check_sentences(found, True)[2],
+                         (3, None, DBT + "\r\n"))
+        self.assertEqual(nmea_parser.check_sentences([], True), [])
+
+    def test_check_sentences_without_numpy(self):
+        found = [(i, "a", with_checksum(GLL[:i + 8]) if i % 2
+                  else GLL[:i + 8] + "*00")
+                 for i in xrange(30)]
+        numpy = nmea_parser.numpy
+        nmea_parser.numpy = None
+        try:
+            expected = nmea_parser.check_sentences(found, True)
+        finally:
+            nmea_parser.numpy = numpy
+        self.assertEqual(nmea_parser.check_sentences(found, True), expected)
+        self.assertEqual([kind for (linenum, kind, line) in expected],
+                         ["a" if i % 2 else None for i in xrange(30)])
+
+    def test_blocks(self):
+        # Two of every three lines are recognized.
+        count = nmea_parser.BLOCK_SENTENCES * 3 + 9
+        lines = [with_checksum(GLL) if i % 3 else "$GPGSV,1,1*00\r\n"
+                 for i in xrange(count)]
+        blocks = list(nmea_parser.checked_blocks(
+            lines, nmea_parser.sentence_parsers, False, 5))
+        self.assertEqual([len(block) for (block, last) in blocks],
+                         [nmea_parser.BLOCK_SENTENCES,
+                          nmea_parser.BLOCK_SENTENCES, 6])
+        self.assertEqual(blocks[-1][1], count + 5)
+        linenums = [linenum for (block, last) in blocks
+                    for (linenum, kind, sentence) in block]
+        self.assertEqual(linenums, [i + 6 for i in xrange(count) if i % 3])
+
+class DispatchTest(unittest.TestCase):
+    def test_records(self):
+        (records, parser) = parse([
+            with_checksum(GLL),
+            with_checksum(DBT),
+            with_checksum("$IIMWV,120,R,10.0,N,A"),
+            with_checksum("$IIVHW,,,,,5.0,N,9.2,K"),
+            with_checksum("$IIVTG,226.95,T,226.95,M,5.80,N,,,D")])
+        self.assertEqual(records, [
+            Position("10:11:12", 60 + 9.0403 / 60, 24 + 57.9985 / 60,
+                     36672),
+            Depth(12.3),
+            Wind(5.0, 120, 0),
+            WaterSpeed(5.0),
+            GroundSpeedCourse(5.8, 226.95)])
+        self.assertEqual((parser.lines, parser.sentences,
+                          parser.bad_checksums), (5, 5, 0))
+
+    def test_hemispheres(self):
+        (records, parser) = parse(["$GPGLL,6000.0,S,02430.0,W,000001,A"])
+        self.assertEqual((records[0].lat, records[0].lon), (-60.0, -24.5))
+
+    def test_unknown_sentences(self):
+        # Unknown sentences are skipped whatever their checksum.
+        (records, parser) = parse(["$GPGSV,3,1,11*00\r\n",
+                                   "garbage\r\n",
+                                   with_checksum(DBT)])
+        self.assertEqual(records, [Depth(12.3)])
+        self.assertEqual((parser.lines, parser.sentences,
+                          parser.bad_checksums), (3, 1, 0))
+
+    def test_bad_checksum(self):
+        (records, parser) = parse([GLL + "*00\r\n", with_checksum(DBT),
+                                   DBT + "*5\r\n"])
+        self.assertEqual(records, [Depth(12.3)])
+        self.assertEqual((parser.sentences, parser.bad_checksums), (1, 2))
+
+    def test_lowercase_checksum(self):
+        line = with_checksum(DBT)
+        (records, parser) = parse([line[:-4] + line[-4:].lower()])
+        self.assertEqual(records, [Depth(12.3)])
+
+    def test_missing_checksum(self):
+        lines = [GLL + "\r\n", DBT]
+        (records, parser) = parse(lines)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(parser.bad_checksums, 0)
+
+        (records, parser) = parse(lines, require_checksum=True)
+        self.assertEqual(records, [])
+        self.assertEqual(parser.bad_checksums, 2)
+
+    def test_empty_data(self):
+        (records, parser) = parse(["$GPGLL,,,,,101112,V,N",
+                                   "$IIDBT,,,12.3,f,,",
+                                   "$IIMWV,,R,,N,A"])
+        self.assertEqual(records, [])
+        self.assertEqual((parser.lines, parser.sentences), (3, 0))
+
+    def test_parse_error_line(self):
+        parser = NmeaParser()
+        lines = [with_checksum(DBT), "\r\n", with_checksum("$IIDBT,,,x,M,,")]
+        with self.assertRaises(ParseError):
+            list(parser.parse(lines))
+        self.assertEqual(parser.lines, 3)
+
+        parser = NmeaParser()
+        with self.assertRaises(ParseError):
+            list(parser.parse(["$IIVHW,,,,,5.0,K,9.2,K"]))
+
+    def test_continued_lines(self):
+        parser = NmeaParser()
+        list(parser.parse([DBT, DBT]))
+        list(parser.parse(["", DBT]))
+        self.assertEqual((parser.lines, parser.sentences), (4, 3))
+
+class TimeOfDayTest(unittest.TestCase):
+    def test_time_of_day(self):
+        self.assertEqual(time_of_day("000000"), 0)
+        self.assertEqual(time_of_day("235959"), 86399)
+        self.assertEqual(time_of_day("101112.00"), 36672)
+        self.assertEqual(time_of_day("1011120"), 36672)
+        self.assertRaises(ParseError, time_of_day, "1011")
+        self.assertRaises(ParseError, time_of_day, "")
+        self.assertRaises(ParseError, time_of_day, "10:11:12")
+
+def days(clock, times):
+    return [clock.next_day(seconds) for seconds in times]
+
+class TripClockTest(unittest.TestCase):
+    start = datetime.date(2013, 6, 1)
+
+    def test_rollover(self):
+        clock = TripClock(self.start)
+        self.assertEqual(days(clock, [36000, 86399, 0, 43200, 86000, 100]),
+                         [0, 0, 1, 1, 1, 2])
+
+    def test_small_steps_back(self):
+        # Going back by at most half a day is not a new day.
+        clock = TripClock(self.start)
+        self.assertEqual(days(clock, [50000, 10000, 43200, 0]),
+                         [0, 0, 0, 0])
+
+    def test_late_fix(self):
+        clock = TripClock(self.start)
+        self.assertEqual(days(clock, [86390, 5, 86398, 10, 20]),
+                         [0, 1, 0, 1, 1])
+
+    def test_late_fix_window(self):
+        last = DAY_SECONDS - LATE_FIX_SECONDS
+        clock = TripClock(self.start)
+        self.assertEqual(days(clock, [86000, LATE_FIX_SECONDS - 1, last]),
+                         [0, 1, 0])
+        clock = TripClock(self.start)
+        self.assertEqual(days(clock, [86000, LATE_FIX_SECONDS, last]),
+                         [0, 1, 1])
+        clock = TripClock(self.start)
+        self.assertEqual(days(clock, [86000, 0, last - 1]), [0, 1, 1])
+
+    def test_continue(self):
+        clock = TripClock(self.start, datetime.datetime(2013, 6, 2, 23, 50))
+        self.assertEqual(days(clock, [86000, 60]), [1, 2])
+        clock = TripClock(self.start, datetime.datetime(2013, 6, 2, 0, 5))
+        self.assertEqual(days(clock, [86390, 400]), [0, 1])
+
+    def test_timestamp(self):
+        clock = TripClock(self.start)
+        self.assertEqual(
+            [clock.timestamp(Position(t, 0.0, 0.0,
+                                      time_of_day(t.replace(":", ""))))
+             for t in ("23:59:59", "00:00:01", "23:59:59", "12:00:00")],
+            ["2013-06-01 23:59:59", "2013-06-02 00:00:01",
+             "2013-06-01 23:59:59", "2013-06-01 12:00:00"])
+        self.assertEqual(clock.date_prefix(31), "2013-07-02 ")
+        self.assertEqual(clock.date_prefix(-1), "2013-05-31 ")
+
+if __name__ == "__main__":
+    unittest.main()
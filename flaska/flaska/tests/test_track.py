@@ -0,0 +1,64 @@
+import random
+import unittest
+
+from track import encode_polyline, encode_value, significances, \
+    simplify, trip_tracks
+
+class PolylineTest(unittest.TestCase):
+    def test_google_example(self):
+        # The example of the encoded polyline format documentation.
+        self.assertEqual(encode_polyline([(38.5, -120.2),
+                                          (40.7, -120.95),
+                                          (43.252, -126.453)]),
+                         "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+
+    def test_values(self):
+        self.assertEqual(encode_value(0), "?")
+        self.assertEqual(encode_value(-1), "@")
+        self.assertEqual(encode_value(1), "A")
+        self.assertEqual(encode_value(-17998321), "`~oia@")
+
+    def test_empty(self):
+        self.assertEqual(encode_polyline([]), "")
+
+class SimplifyTest(unittest.TestCase):
+    def test_straight_line(self):
+        points = [(60.0 + i * 0.001, 25.0) for i in xrange(10)]
+        significance = significances(points, 1.0)
+        self.assertEqual(significance[0], float("inf"))
+        self.assertEqual(significance[-1], float("inf"))
+        self.assertEqual(significance[1:-1], [0.0] * 8)
+        self.assertEqual(simplify(points, significance, 1.0),
+                         [points[0], points[-1]])
+
+    def test_corner(self):
+        # About 111 m off the line from the first to the last point.
+        points = [(60.0, 25.0), (60.001, 25.01), (60.0, 25.02)]
+        significance = significances(points, 1.0)
+        self.assertTrue(100.0 < significance[1] < 120.0)
+        self.assertEqual(simplify(points, significance, 10.0), points)
+        self.assertEqual(simplify(points, significance, 1000.0),
+                         [points[0], points[2]])
+
+    def test_nested(self):
+        # A point is never more significant than the one that split
+        # the segment it is on, so coarser tracks are subsets.
+        rand = random.Random(1)
+        points = [(60.0 + rand.uniform(0, 0.1), 25.0 + i * 0.001)
+                  for i in xrange(300)]
+        ranges = [10, 100, 1000, 10000]
+        tracks = trip_tracks(points, ranges)
+        self.assertEqual([track[0] for track in tracks], ranges)
+        significance = significances(points, min(ranges))
+        previous = None
+        for (display_range, count, polyline) in tracks:
+            simplified = simplify(points, significance, display_range)
+            self.assertEqual(count, len(simplified))
+            self.assertEqual(polyline, encode_polyline(simplified))
+            if previous is not None:
+                self.assertTrue(set(simplified) <= set(previous))
+            previous = simplified
+        self.assertEqual(trip_tracks(points, []), [])
+
+if __name__ == "__main__":
+    unittest.main()
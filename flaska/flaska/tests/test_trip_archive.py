@@ -0,0 +1,133 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import trip_archive
+from trip_archive import ArchiveFile, KEY_BITS, KEY_MAX, key_ranges, \
+    point_columns, position_key, quantize, spread, write_file
+
+def morton(x, y):
+    """Interleave the bits of x and y, x in the even bits."""
+    key = 0
+    for bit in xrange(KEY_BITS):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+def in_ranges(key, ranges):
+    return any(start <= key < end for (start, end) in ranges)
+
+class KeyTest(unittest.TestCase):
+    def test_spread(self):
+        for value in (0, 1, 2, 3, 0x1234, 0xabcd, KEY_MAX):
+            self.assertEqual(spread(value), morton(value, 0))
+
+    def test_quantize(self):
+        self.assertEqual(quantize(10.0, 10.0, 20.0), 0)
+        self.assertEqual(quantize(20.0, 10.0, 20.0), KEY_MAX)
+        self.assertEqual(quantize(15.0, 10.0, 20.0), KEY_MAX / 2)
+        self.assertEqual(quantize(5.0, 10.0, 20.0), 0)
+        self.assertEqual(quantize(25.0, 10.0, 20.0), KEY_MAX)
+        self.assertEqual(quantize(10.0, 10.0, 10.0), 0)
+
+    def test_position_key(self):
+        bounds = {"lat0": 60.0, "lat1": 61.0, "lon0": 24.0, "lon1": 26.0}
+        self.assertEqual(position_key(60.0, 24.0, bounds), 0)
+        self.assertEqual(position_key(61.0, 26.0, bounds),
+                         (1 << (2 * KEY_BITS)) - 1)
+        self.assertEqual(position_key(60.25, 25.5, bounds),
+                         morton(quantize(25.5, 24.0, 26.0),
+                                quantize(60.25, 60.0, 61.0)))
+        self.assertEqual(position_key(None, 25.0, bounds), 0)
+        self.assertEqual(position_key(60.5, 25.0, None), 0)
+
+class KeyRangesTest(unittest.TestCase):
+    def check_ranges(self, ranges, max_ranges):
+        self.assertTrue(0 < len(ranges) <= max_ranges)
+        for (start, end) in ranges:
+            self.assertTrue(start < end)
+        for (a, b) in zip(ranges, ranges[1:]):
+            # Sorted, and adjacent ranges are merged.
+            self.assertTrue(a[1] < b[0])
+
+    def test_exact(self):
+        # With enough ranges, they cover exactly the keys in the box.
+        rand = random.Random(1)
+        for i in xrange(50):
+            x0 = rand.randrange(KEY_MAX - 20)
+            y0 = rand.randrange(KEY_MAX - 20)
+            x1 = x0 + rand.randrange(20)
+            y1 = y0 + rand.randrange(20)
+            ranges = key_ranges(x0, x1, y0, y1, max_ranges=10000)
+            self.check_ranges(ranges, 10000)
+            keys = set(morton(x, y) for x in xrange(x0, x1 + 1)
+                       for y in xrange(y0, y1 + 1))
+            self.assertEqual(sum(end - start for (start, end) in ranges),
+                             len(keys))
+            self.assertTrue(all(in_ranges(key, ranges) for key in keys))
+
+    def test_limited(self):
+        # With few ranges, they still cover all of the box.
+        rand = random.Random(2)
+        for max_ranges in (1, 4, trip_archive.MAX_KEY_RANGES):
+            for i in xrange(50):
+                (x0, x1) = sorted(rand.randrange(KEY_MAX + 1)
+                                  for j in xrange(2))
+                (y0, y1) = sorted(rand.randrange(KEY_MAX + 1)
+                                  for j in xrange(2))
+                ranges = key_ranges(x0, x1, y0, y1, max_ranges)
+                self.check_ranges(ranges, max_ranges)
+                for j in xrange(100):
+                    key = morton(rand.randint(x0, x1), rand.randint(y0, y1))
+                    self.assertTrue(in_ranges(key, ranges))
+                for (x, y) in ((x0, y0), (x0, y1), (x1, y0), (x1, y1)):
+                    self.assertTrue(in_ranges(morton(x, y), ranges))
+
+    def test_whole_space(self):
+        self.assertEqual(key_ranges(0, KEY_MAX, 0, KEY_MAX),
+                         [(0, 1 << (2 * KEY_BITS))])
+        self.assertEqual(key_ranges(5, 5, 7, 7),
+                         [(morton(5, 7), morton(5, 7) + 1)])
+
+class ArchiveFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_select(self):
+        rand = random.Random(3)
+        rows = [(i, 1000 + i, rand.uniform(60.0, 60.5),
+                 rand.uniform(24.0, 25.0), rand.choice((10, 100, 1000)),
+                 rand.uniform(1.0, 20.0), None, None, None)
+                for i in xrange(2000)]
+        rows.append((2000, 3000, None, None, 10, None, None, None, None))
+        path = os.path.join(self.dir, "v1.points")
+        write_file(path, rows, point_columns, trip_archive.row_bounds(rows))
+        archive_file = ArchiveFile(path)
+        self.assertEqual(archive_file.count, len(rows))
+
+        for i in xrange(20):
+            (lat0, lat1) = sorted(rand.uniform(59.9, 60.6)
+                                  for j in xrange(2))
+            (lon0, lon1) = sorted(rand.uniform(23.9, 25.1)
+                                  for j in xrange(2))
+            coord_range = {"lat0": lat0, "lat1": lat1,
+                           "lon0": lon0, "lon1": lon1}
+            selected = archive_file.select(coord_range, 100,
+                                           ("p_id", "depth"))
+            expected = sorted((row[0], row[5]) for row in rows
+                              if row[4] >= 100 and row[2] is not None and
+                              lat0 <= row[2] <= lat1 and
+                              lon0 <= row[3] <= lon1)
+            self.assertEqual(sorted(zip(selected["p_id"],
+                                        selected["depth"])), expected)
+
+        selected = archive_file.select(None, 0, ("p_id", ))
+        self.assertEqual(sorted(selected["p_id"]), range(len(rows)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import errno
+import math
+import os
+import shutil
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+# Map tiles and a cache for the data served per tile.
+#
+# Tiles follow the web map convention (the same one that Google Maps
+# uses): at zoom level z the world is split into 2^z x 2^z tiles,
+# x grows to the east and y to the south.
+
+# Meters per pixel at the equator at zoom level 0 with 256 pixel tiles.
+EQUATOR_M_PER_PIX = 156543.03392
+
+# Deepest zoom level considered when invalidating cached tiles.
+MAX_ZOOM = 22
+
+def tile_bounds(z, x, y):
+    """
+    Return the coordinate range of a tile as a dict with the keys
+    lat0, lat1, lon0 and lon1.
+    """
+    n = 2.0 ** z
+    return {"lat0": tile_lat(y + 1, n),
+            "lat1": tile_lat(y, n),
+            "lon0": x / n * 360.0 - 180.0,
+            "lon1": (x + 1) / n * 360.0 - 180.0}
+
+def tile_lat(y, n):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+def tile_xy(z, lat, lon):
+    """Return the x and y of the tile at zoom z containing lat, lon."""
+    n = 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(math.radians(lat)) +
+                            1.0 / math.cos(math.radians(lat))) / math.pi)
+            / 2.0 * n)
+    return (min(max(x, 0), n - 1), min(max(y, 0), n - 1))
+
+def tile_range(z, area):
+    """
+    Return the x and y ranges (inclusive) of the tiles at zoom z that
+    overlap with area.
+    """
+    (x0, y1) = tile_xy(z, area["lat0"], area["lon0"])
+    (x1, y0) = tile_xy(z, area["lat1"], area["lon1"])
+    return (x0, x1, y0, y1)
+
+def tile_valid(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+def tile_pixel_size(z, x, y):
+    """
+    Return the size of a pixel of a tile in meters, measured at the
+    center of the tile.
+    """
+    bounds = tile_bounds(z, x, y)
+    lat = (bounds["lat0"] + bounds["lat1"]) / 2.0
+    return EQUATOR_M_PER_PIX * math.cos(math.radians(lat)) / 2 ** z
+
+def tile_m_per_pix(z, x, y):
+    """
+    Return the meters per pixel value for a tile, measured at the
+    center of the tile.
+    """
+    m_per_pix = tile_pixel_size(z, x, y)
+
+    # The depth markers do not shrink when zooming out. Thin out the
+    # data at small zoom levels, as the map views used to do.
+    if z < 14:
+        m_per_pix = m_per_pix * 2.0
+    return m_per_pix
+
+class TileCache:
+    """
+    A cache for serialized tile data.
+
+    The entries are kept in memory in least-recently-used order, and
+    evicted when their total size goes over max_bytes. If cache_dir
+    is set, the entries are also stored on disk so that they survive
+    restarts and can be shared between server processes.
+
+    Keys are tuples (kind, z, x, y, ...). kind names the data set
+    (for example "depth" or "trip-12"); the rest of the key may
+    contain other parameters such as the display range. The entries
+    are never stale as long as the keys include the version of the
+    data; invalidating them only frees space.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+                return value
+
+        value = self.disk_get(key)
+        if value is not None:
+            self.memory_put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory_put(key, value)
+        self.disk_put(key, value)
+
+    def memory_put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            old_value = self.entries.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate_kind(self, kind):
+        """Drop all entries of one kind."""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == kind]:
+                self.size -= len(self.entries.pop(key))
+        self.disk_remove(self.kind_path(kind))
+
+    def invalidate_area(self, kind, area):
+        """Drop the entries of one kind whose tile overlaps with area."""
+        ranges = [tile_range(z, area) for z in range(MAX_ZOOM + 1)]
+
+        def overlaps(key):
+            (x0, x1, y0, y1) = ranges[key[1]]
+            return x0 <= key[2] <= x1 and y0 <= key[3] <= y1
+
+        with self.lock:
+            for key in [k for k in self.entries
+                        if k[0] == kind and overlaps(k)]:
+                self.size -= len(self.entries.pop(key))
+
+        if not self.cache_dir:
+            return
+        for (z, (x0, x1, y0, y1)) in enumerate(ranges):
+            zoom_path = os.path.join(self.kind_path(kind), str(z))
+            for x in self.disk_listdir(zoom_path):
+                if x0 <= x <= x1:
+                    x_path = os.path.join(zoom_path, str(x))
+                    for y in self.disk_listdir(x_path):
+                        if y0 <= y <= y1:
+                            self.disk_remove(os.path.join(x_path, str(y)))
+
+    def kind_path(self, kind):
+        return os.path.join(self.cache_dir or "", str(kind))
+
+    def key_path(self, key):
+        (kind, z, x, y) = key[0:4]
+        filename = "_".join(str(part) for part in key[4:]) or "tile"
+        return os.path.join(self.kind_path(kind), str(z), str(x), str(y),
+                            filename)
+
+    def disk_get(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.key_path(key), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def disk_put(self, key, value):
+        if not self.cache_dir:
+            return
+        path = self.key_path(key)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                return
+        # Write to a temporary file first so that readers never see
+        # a partial entry.
+        (fd, tmp_path) = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        os.rename(tmp_path, path)
+
+    def disk_listdir(self, path):
+        try:
+            return [int(name) for name in os.listdir(path) if name.isdigit()]
+        except OSError:
+            return []
+
+    def disk_remove(self, path):
+        if self.cache_dir:
+            shutil.rmtree(path, ignore_errors=True)
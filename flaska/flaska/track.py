@@ -0,0 +1,122 @@
+import math
+
+# Simplified track lines of the trips.
+#
+# The positions of a trip are simplified with the Douglas-Peucker
+# algorithm once for each display range, with the range (in meters)
+# as the tolerance, and stored as Google encoded polylines. A track
+# at a coarse display range has only the points needed to draw the
+# trip at that scale.
+
+# Meters per degree of latitude, as in calc_display_range.
+LAT_DEG_TO_METERS = 111317.0
+
+# Precision of the encoded polylines: 5 decimals, about 1 m.
+POLYLINE_FACTOR = 1e5
+
+def segment_distance(x, y, x0, y0, x1, y1):
+    """Distance of the point (x, y) from the segment (x0, y0)-(x1, y1)."""
+    dx = x1 - x0
+    dy = y1 - y0
+    length2 = dx * dx + dy * dy
+    if length2 > 0.0:
+        t = ((x - x0) * dx + (y - y0) * dy) / length2
+        if t >= 1.0:
+            (x0, y0) = (x1, y1)
+        elif t > 0.0:
+            x0 += t * dx
+            y0 += t * dy
+    return math.hypot(x - x0, y - y0)
+
+def significances(points, min_tolerance):
+    """
+    Run the Douglas-Peucker algorithm on points, a list of (lat, lon)
+    tuples, and return for each point the largest tolerance (in
+    meters) at which it is kept. The end points are always kept.
+
+    Simplifying with tolerance t keeps the points whose significance
+    is greater than t, so one run gives the simplifications for all
+    tolerances. Segments whose points are all within min_tolerance
+    are not split further.
+    """
+    count = len(points)
+    result = [0.0] * count
+    if count == 0:
+        return result
+    result[0] = result[-1] = float("inf")
+
+    # Local plane coordinates in meters. The longitude scale of the
+    # middle latitude of the trip is good enough for one trip.
+    lats = [lat for (lat, lon) in points]
+    lon_scale = math.cos(math.radians((min(lats) + max(lats)) / 2.0))
+    ys = [lat * LAT_DEG_TO_METERS for (lat, lon) in points]
+    xs = [lon * LAT_DEG_TO_METERS * lon_scale for (lat, lon) in points]
+
+    # Segments to split, with the significance of the point that
+    # split them: a point cannot be more significant than the points
+    # that were needed before it.
+    stack = [(0, count - 1, float("inf"))]
+    while stack:
+        (first, last, limit) = stack.pop()
+        (x0, y0, x1, y1) = (xs[first], ys[first], xs[last], ys[last])
+        farthest = None
+        max_distance = min_tolerance
+        for i in xrange(first + 1, last):
+            distance = segment_distance(xs[i], ys[i], x0, y0, x1, y1)
+            if distance > max_distance:
+                farthest = i
+                max_distance = distance
+        if farthest is None:
+            continue
+
+        significance = min(max_distance, limit)
+        result[farthest] = significance
+        stack.append((first, farthest, significance))
+        stack.append((farthest, last, significance))
+
+    return result
+
+def simplify(points, significance, tolerance):
+    """Return the points whose significance is above tolerance."""
+    return [point for (point, s) in zip(points, significance)
+            if s > tolerance]
+
+def encode_polyline(points):
+    """
+    Encode a list of (lat, lon) tuples in the Google encoded polyline
+    format.
+    """
+    chunks = []
+    prev_lat = 0
+    prev_lon = 0
+    for (lat, lon) in points:
+        lat = int(round(lat * POLYLINE_FACTOR))
+        lon = int(round(lon * POLYLINE_FACTOR))
+        chunks.append(encode_value(lat - prev_lat))
+        chunks.append(encode_value(lon - prev_lon))
+        (prev_lat, prev_lon) = (lat, lon)
+    return "".join(chunks)
+
+def encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chars = []
+    while value >= 0x20:
+        chars.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chars.append(chr(value + 63))
+    return "".join(chars)
+
+def trip_tracks(points, ranges):
+    """
+    Simplify the track points for each of the display ranges. Returns
+    a list of (range, point count, encoded polyline) tuples.
+    """
+    if not ranges:
+        return []
+    significance = significances(points, min(ranges))
+    tracks = []
+    for display_range in ranges:
+        simplified = simplify(points, significance, display_range)
+        tracks.append((display_range, len(simplified),
+                       encode_polyline(simplified)))
+    return tracks
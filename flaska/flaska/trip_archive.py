@@ -0,0 +1,409 @@
+import array
+import bisect
+import errno
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+from depth_data import db_trip_archive_fetch, db_trip_versions_fetch
+
+import columns
+
+# Read-side store of the trip data in memory-mapped files.
+#
+# The points and the depths of each trip are exported from the
+# database into files in the columnar format of columns.py, named by
+# the trip id and its data version:
+#
+#   <archive_dir>/<trip_id>/v<version>.points
+#   <archive_dir>/<trip_id>/v<version>.depths
+#
+# The rows of a file are sorted by a Z-order (Morton) key of their
+# position, quantized within the bounding box of the trip, so that the
+# rows in an area are in a few runs of the file. An area query finds
+# the runs by binary search on the key column of the mapped file, and
+# reads only those parts of the other columns.
+#
+# The database stays the source of truth. A file is only used for the
+# data version it was made from: when the trip changes, new files are
+# exported on first use (or by the loader) and the old ones removed.
+
+# Bits of the quantized longitude and latitude in the keys.
+KEY_BITS = 16
+KEY_MAX = (1 << KEY_BITS) - 1
+
+# An area is split into at most about this many key ranges.
+MAX_KEY_RANGES = 32
+
+KINDS = ("points", "depths")
+
+# The columns of the files. The rows from db_trip_archive_fetch have
+# the values of the columns after the key.
+point_columns = (("key", columns.UINT32),
+                 ("p_id", columns.INT32),
+                 ("t", columns.UINT32),
+                 ("lat", columns.FLOAT64),
+                 ("lon", columns.FLOAT64),
+                 ("range", columns.INT32),
+                 ("depth", columns.FLOAT64),
+                 ("ws", columns.FLOAT64),
+                 ("gs", columns.FLOAT64),
+                 ("course", columns.FLOAT64))
+
+depth_columns = (("key", columns.UINT32),
+                 ("p_id", columns.INT32),
+                 ("t", columns.UINT32),
+                 ("lat", columns.FLOAT64),
+                 ("lon", columns.FLOAT64),
+                 ("range", columns.INT32),
+                 ("depth", columns.FLOAT64),
+                 ("d_bad", columns.BITS))
+
+# The columns of the API rows read from the files.
+point_names = ("p_id", "t", "lat", "lon", "depth", "ws", "gs", "course")
+depth_names = ("p_id", "t", "lat", "lon", "depth", "d_bad")
+
+# Columns whose NaN values are NULLs.
+nullable_names = ("lat", "lon", "depth", "ws", "gs", "course")
+
+def archive_path(archive_dir, trip_id, version, kind):
+    return os.path.join(archive_dir, str(trip_id),
+                        "v{}.{}".format(version, kind))
+
+def export_trip(db, archive_dir, trip_id):
+    """
+    Export the data of a trip from the database into the archive, and
+    remove the files of its earlier versions. Returns the exported
+    data version, or None if there is no such trip.
+    """
+    data = db_trip_archive_fetch(db, trip_id)
+    if data is None:
+        return None
+    (version, points, depths) = data
+
+    trip_dir = os.path.join(archive_dir, str(trip_id))
+    try:
+        os.makedirs(trip_dir)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+    bounds = row_bounds(points + depths)
+    write_file(archive_path(archive_dir, trip_id, version, "points"),
+               points, point_columns, bounds)
+    write_file(archive_path(archive_dir, trip_id, version, "depths"),
+               depths, depth_columns, bounds)
+
+    for name in os.listdir(trip_dir):
+        rm = re.match("^v([0-9]+)\\.", name)
+        if rm and int(rm.group(1)) != version:
+            try:
+                os.remove(os.path.join(trip_dir, name))
+            except OSError:
+                pass
+    return version
+
+def row_bounds(rows):
+    """
+    Return the bounding box of rows that have the latitude and the
+    longitude as the third and fourth value, or None if no row has a
+    position.
+    """
+    lats = [row[2] for row in rows if row[2] is not None]
+    lons = [row[3] for row in rows if row[3] is not None]
+    if not lats or not lons:
+        return None
+    return {"lat0": min(lats), "lat1": max(lats),
+            "lon0": min(lons), "lon1": max(lons)}
+
+def write_file(path, rows, file_columns, bounds):
+    """Write rows sorted by their key into an archive file."""
+    keyed = sorted((position_key(row[2], row[3], bounds), ) + tuple(row)
+                   for row in rows)
+    names = [name for (name, column_type) in file_columns]
+    values = dict(zip(names, zip(*keyed) or [()] * len(names)))
+    data = columns.encode_columns(columns.ColumnRows(values, len(keyed)),
+                                  file_columns, bounds=bounds)
+
+    # Readers never see a partial file.
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+def quantize(value, low, high):
+    """Map value in low ... high to 0 ... KEY_MAX."""
+    if high <= low:
+        return 0
+    return min(max(int((value - low) / (high - low) * KEY_MAX), 0),
+               KEY_MAX)
+
+def spread(value):
+    """Spread the bits of a KEY_BITS number to the even bits."""
+    value = (value | (value << 8)) & 0x00ff00ff
+    value = (value | (value << 4)) & 0x0f0f0f0f
+    value = (value | (value << 2)) & 0x33333333
+    value = (value | (value << 1)) & 0x55555555
+    return value
+
+def position_key(lat, lon, bounds):
+    if lat is None or lon is None or bounds is None:
+        return 0
+    return spread(quantize(lon, bounds["lon0"], bounds["lon1"])) | \
+        (spread(quantize(lat, bounds["lat0"], bounds["lat1"])) << 1)
+
+def key_ranges(x0, x1, y0, y1, max_ranges=MAX_KEY_RANGES):
+    """
+    Return sorted ranges of keys (start, end), end exclusive, that
+    cover the quantized longitudes x0 ... x1 and latitudes y0 ... y1.
+    The key space is split as a quadtree as long as the ranges stay
+    under max_ranges; the ranges can then cover more than the area.
+    """
+    ranges = []
+    # Quadtree nodes as (x, y, level): the node covers 2^level x
+    # 2^level positions from x, y.
+    nodes = [(0, 0, KEY_BITS)]
+    while nodes:
+        split = []
+        for (x, y, level) in nodes:
+            size = 1 << level
+            if x > x1 or x + size <= x0 or y > y1 or y + size <= y0:
+                continue
+            if level == 0 or (x0 <= x and x + size - 1 <= x1 and
+                              y0 <= y and y + size - 1 <= y1):
+                ranges.append(node_range(x, y, level))
+            else:
+                split.append((x, y, level))
+        if len(ranges) + 4 * len(split) > max_ranges:
+            ranges.extend(node_range(x, y, level)
+                          for (x, y, level) in split)
+            break
+        nodes = [(x + dx, y + dy, level - 1)
+                 for (x, y, level) in split
+                 for dy in (0, 1 << (level - 1))
+                 for dx in (0, 1 << (level - 1))]
+
+    merged = []
+    for (start, end) in sorted(ranges):
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def node_range(x, y, level):
+    start = spread(x) | (spread(y) << 1)
+    return (start, start + (1 << (2 * level)))
+
+class KeyColumn:
+    """The key column of a mapped file as a sequence, for bisect."""
+    def __init__(self, data, offset, count):
+        self.data = data
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from("<I", self.data, self.offset + 4 * i)[0]
+
+class ArchiveFile:
+    """A mapped archive file."""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = columns.decode_header(self.data)
+        self.count = self.header["count"]
+        self.bounds = self.header["bounds"]
+        self.columns = dict((column["name"], column)
+                            for column in self.header["columns"])
+        self.keys = KeyColumn(self.data, self.columns["key"]["offset"],
+                              self.count)
+
+    def values(self, name, start, end):
+        """Return the values of a column in the rows start ... end - 1."""
+        column = self.columns[name]
+        offset = column["offset"]
+        if column["type"] == columns.BITS:
+            bits = bytearray(self.data[offset + (start >> 3):
+                                       offset + ((end + 7) >> 3)])
+            first = start >> 3
+            return [bool(bits[(i >> 3) - first] & (1 << (i & 7)))
+                    for i in xrange(start, end)]
+        values = array.array(columns.typecodes[column["type"]])
+        values.fromstring(self.data[offset + start * values.itemsize:
+                                    offset + end * values.itemsize])
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    def runs(self, coord_range):
+        """
+        Return the runs of rows (start, end), end exclusive, that
+        contain the rows in coord_range, and maybe others.
+        """
+        if coord_range is None:
+            return [(0, self.count)]
+        bounds = self.bounds
+        if bounds is None or \
+                coord_range["lat0"] > bounds["lat1"] or \
+                coord_range["lat1"] < bounds["lat0"] or \
+                coord_range["lon0"] > bounds["lon1"] or \
+                coord_range["lon1"] < bounds["lon0"]:
+            return []
+
+        runs = []
+        for (key0, key1) in key_ranges(
+                quantize(coord_range["lon0"], bounds["lon0"], bounds["lon1"]),
+                quantize(coord_range["lon1"], bounds["lon0"], bounds["lon1"]),
+                quantize(coord_range["lat0"], bounds["lat0"], bounds["lat1"]),
+                quantize(coord_range["lat1"], bounds["lat0"],
+                         bounds["lat1"])):
+            start = bisect.bisect_left(self.keys, key0)
+            end = bisect.bisect_left(self.keys, key1, start)
+            if start < end:
+                runs.append((start, end))
+        return runs
+
+    def select(self, coord_range, display_range, names):
+        """
+        Return the values of the columns names in the rows that are in
+        coord_range (all of them if None) and have a display range of
+        at least display_range, as a dict of lists by the name.
+        """
+        selected = dict((name, []) for name in names)
+        for (start, end) in self.runs(coord_range):
+            ranges = self.values("range", start, end)
+            if coord_range is None:
+                picked = [i for i in xrange(end - start)
+                          if ranges[i] >= display_range]
+            else:
+                lat0 = coord_range["lat0"]
+                lat1 = coord_range["lat1"]
+                lon0 = coord_range["lon0"]
+                lon1 = coord_range["lon1"]
+                lats = self.values("lat", start, end)
+                lons = self.values("lon", start, end)
+                picked = [i for i in xrange(end - start)
+                          if ranges[i] >= display_range and
+                          lat0 <= lats[i] <= lat1 and
+                          lon0 <= lons[i] <= lon1]
+            if not picked:
+                continue
+            for name in names:
+                values = self.values(name, start, end)
+                selected[name].extend(values[i] for i in picked)
+        return selected
+
+class TripArchive:
+    """
+    The trip archive in archive_dir. At most max_open files are kept
+    mapped; the others are mapped again when they are needed.
+    """
+
+    def __init__(self, archive_dir, max_open=256):
+        self.archive_dir = archive_dir
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.export_lock = threading.Lock()
+        self.files = OrderedDict()
+
+    def export(self, db, trip_id):
+        """Export the current data of a trip."""
+        with self.export_lock:
+            return export_trip(db, self.archive_dir, trip_id)
+
+    def get(self, db, trip_id, version, kind):
+        """
+        Return the file of a kind ("points" or "depths") for a version
+        of a trip. The files are exported from the database if they do
+        not exist. Returns None if the trip has since changed.
+        """
+        key = (trip_id, version, kind)
+        with self.lock:
+            archive_file = self.files.pop(key, None)
+            if archive_file is not None:
+                self.files[key] = archive_file
+                return archive_file
+
+        path = archive_path(self.archive_dir, trip_id, version, kind)
+        if not os.path.exists(path):
+            with self.export_lock:
+                if not os.path.exists(path):
+                    export_trip(db, self.archive_dir, trip_id)
+        try:
+            archive_file = ArchiveFile(path)
+        except (IOError, OSError):
+            # Replaced by a newer version.
+            return None
+
+        with self.lock:
+            self.files[key] = archive_file
+            while len(self.files) > self.max_open:
+                # The file is unmapped when its last reader is done.
+                self.files.popitem(last=False)
+        return archive_file
+
+    def trip_points(self, db, trip_id, version, coord_range, display_range,
+                    epoch_time=False):
+        """
+        Return the points of a version of a trip in coord_range (or
+        all if None) with a display range of at least display_range,
+        as the rows of db_trip_points_fetch in ColumnRows. Returns None
+        if the trip has changed.
+        """
+        archive_file = self.get(db, trip_id, version, "points")
+        if archive_file is None:
+            return None
+        return api_rows(archive_file.select(coord_range, display_range,
+                                            point_names),
+                        epoch_time)
+
+    def depths(self, db, coord_range, display_range, epoch_time=False):
+        """
+        Return the depths of all the trips in coord_range with a
+        display range of at least display_range, as the rows of
+        db_depths_fetch in ColumnRows. Returns None if a trip has
+        changed during the query.
+        """
+        selected = dict((name, []) for name in depth_names + ("t_id", ))
+        for (trip_id, version) in db_trip_versions_fetch(db, coord_range):
+            archive_file = self.get(db, trip_id, version, "depths")
+            if archive_file is None:
+                return None
+            trip_selected = archive_file.select(coord_range, display_range,
+                                                depth_names)
+            for name in depth_names:
+                selected[name].extend(trip_selected[name])
+            selected["t_id"].extend([trip_id] * len(trip_selected["p_id"]))
+        return api_rows(selected, epoch_time)
+
+def api_rows(selected, epoch_time):
+    """
+    Make ColumnRows like those of the database queries from the
+    selected values, ordered by the position id.
+    """
+    count = len(selected["p_id"])
+    order = sorted(xrange(count), key=selected["p_id"].__getitem__)
+    values = {}
+    for (name, column_values) in selected.items():
+        column_values = [column_values[i] for i in order]
+        if name == "t":
+            name = "t_utc"
+            if not epoch_time:
+                column_values = [time.strftime("%Y%m%d%H%M%S",
+                                               time.gmtime(t))
+                                 for t in column_values]
+        elif name in nullable_names:
+            column_values = [None if value != value else value
+                             for value in column_values]
+        values[name] = column_values
+    return columns.ColumnRows(values, count)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+from nmea_file_loader import bump_data_version, update_trip_summary, \
+    db_conn
+
+# Fix the dates of the positions of trips that are already in the
+# database. The loader dates the positions after midnight on the next
+# day; the trips loaded before it did had all of their positions on
+# the date of the trip. Running this again for a fixed trip changes
+# nothing.
+
+def fix_day_rollover(db, trip_id):
+    """Fix the dates of a trip. Returns the number of positions fixed."""
+    fix_cursor = db.cursor()
+    fix_cursor.execute("SELECT fix_day_rollover(%s)", (trip_id, ))
+    changed = fix_cursor.fetchone()[0]
+    fix_cursor.close()
+    return changed
+
+def main():
+    parser = argparse.ArgumentParser(description="Fix the dates of the "
+                                     "positions of the trips that go "
+                                     "past midnight.")
+    parser.add_argument('trip_ids', metavar="trip_id",
+                        type=int,
+                        nargs="*",
+                        help="Trips to fix. By default all the trips "
+                        "are checked")
+    parser.add_argument('-d', '--db-name', dest="db_name",
+                        help="Database name")
+    parser.add_argument('-u', '--db-user', dest="db_user",
+                        help="Database user name")
+    parser.add_argument('-p', '--db-passwd', dest="db_passwd",
+                        help="Database password")
+    args = parser.parse_args()
+
+    db = db_conn(args.db_name, args.db_user, args.db_passwd)
+    trip_ids = args.trip_ids
+    if not trip_ids:
+        trip_cursor = db.cursor()
+        trip_cursor.execute("SELECT id FROM trip ORDER BY id")
+        trip_ids = [row[0] for row in trip_cursor.fetchall()]
+        trip_cursor.close()
+
+    for trip_id in trip_ids:
+        changed = fix_day_rollover(db, trip_id)
+        if changed:
+            update_trip_summary(db, trip_id)
+            bump_data_version(db, trip_id)
+        db.commit()
+        print("Trip {}: {} positions fixed".format(trip_id, changed))
+
+    db.close()
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
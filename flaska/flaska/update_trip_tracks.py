@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+from nmea_file_loader import update_trip_tracks, db_conn
+
+# Compute the simplified tracks of trips that are already in the
+# database. The loader does this for new trips; this is for the trips
+# loaded before the trip_track table existed, and for recomputing the
+# tracks after the display ranges have been changed.
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute the simplified "
+                                     "tracks of the trips.")
+    parser.add_argument('trip_ids', metavar="trip_id",
+                        type=int,
+                        nargs="*",
+                        help="Trips to update. By default the trips "
+                        "without a track are updated")
+    parser.add_argument('-d', '--db-name', dest="db_name",
+                        help="Database name")
+    parser.add_argument('-u', '--db-user', dest="db_user",
+                        help="Database user name")
+    parser.add_argument('-p', '--db-passwd', dest="db_passwd",
+                        help="Database password")
+    args = parser.parse_args()
+
+    db = db_conn(args.db_name, args.db_user, args.db_passwd)
+    trip_ids = args.trip_ids
+    if not trip_ids:
+        trip_cursor = db.cursor()
+        trip_cursor.execute("SELECT t.id "
+                            "FROM trip t "
+                            "WHERE NOT EXISTS (SELECT 1 FROM trip_track k "
+                            "                  WHERE k.trip_id = t.id) "
+                            "ORDER BY t.id")
+        trip_ids = [row[0] for row in trip_cursor.fetchall()]
+        trip_cursor.close()
+
+    for trip_id in trip_ids:
+        update_trip_tracks(db, trip_id)
+        db.commit()
+        print("Trip {}: done".format(trip_id))
+
+    db.close()
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+import os
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extras
+
+from flaska.nmea_file_loader import do_file_loading, update_display_ranges, \
+    bump_data_version, fetch_trip_area, AppContext
+from flaska.profiling import metrics
+
+# Background processing of the uploaded files.
+#
+# An upload is saved to a file and recorded in the upload_job table;
+# a pool of worker threads loads the queued files. The table is shared
+# by all the application processes, and jobs that are still queued
+# when the application is restarted are picked up again. A job is
+# processed in two steps, each in its own transaction: loading the
+# data into a new trip, and computing the display ranges of the trip.
+# The trip is recorded in the job in the transaction that loads it.
+# A running job whose process has died (no update for stale_after
+# seconds) is queued again and continues from the step it was in.
+# While a job runs, its worker updates it at least every
+# HEARTBEAT_INTERVAL seconds. Each claim of a job starts a new
+# attempt, and a worker stops updating a job, and rolls back its load,
+# once its attempt is no longer the current one.
+
+# Seconds between progress updates written to the job table.
+PROGRESS_INTERVAL = 1.0
+
+# Longest time between updates of a running job, in seconds.
+HEARTBEAT_INTERVAL = 60.0
+
+class JobTakenOver(Exception):
+    """The job of a worker has been taken over by another worker."""
+    def __init__(self):
+        Exception.__init__(self, "The job was taken over by another worker")
+
+job_fields = ("id", "state", "phase", "lines_parsed", "rows_inserted",
+              "trip_id", "messages")
+
+class JobContext(AppContext):
+    """Loader context that records the progress of a job."""
+    def __init__(self, queue, job):
+        AppContext.__init__(self)
+        self.queue = queue
+        self.job = job
+        self.trip_id = None
+        self.reported = 0
+
+    def data_changed(self, trip_id, areas):
+        AppContext.data_changed(self, trip_id, areas)
+        self.trip_id = trip_id
+
+    def trip_loaded(self, db, trip_id):
+        if not update_job(db, self.job, trip_id=trip_id):
+            raise JobTakenOver()
+
+    def progress(self, phase, lines=None, rows=None):
+        now = time.time()
+        if phase == "loading" and now - self.reported < PROGRESS_INTERVAL:
+            return
+        self.reported = now
+        if not self.queue.update_job(self.job,
+                                     phase=phase,
+                                     lines_parsed=lines,
+                                     rows_inserted=rows):
+            raise JobTakenOver()
+
+    def timings(self, timings):
+        AppContext.timings(self, timings)
+        metrics.observe_timings("loca_loader_seconds", (), timings)
+
+class UploadJobQueue:
+    """
+    The upload jobs of this process. workers threads take jobs from
+    the upload_job table; each thread has its own database connection
+    for the loading. Short queries (progress updates, job status) use
+    connections from pool.
+
+    on_data_changed(trip_id, areas) is called after a job has
+    completed. If keep_files is False, the uploaded files are removed
+    once their jobs are finished.
+    """
+
+    def __init__(self, pool, connect_string,
+                 workers=1,
+                 poll_interval=5,
+                 stale_after=600,
+                 keep_files=True,
+                 on_data_changed=None):
+        self.pool = pool
+        self.connect_string = connect_string
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.keep_files = keep_files
+        self.on_data_changed = on_data_changed
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        """Start the worker threads, unless they have been started."""
+        if self.threads:
+            return
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.work,
+                                      name="upload-worker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, db, input_info):
+        """Queue a job for loading a file. Return the id of the job."""
+        job_cursor = db.cursor()
+        job_cursor.execute("INSERT INTO upload_job "
+                           "(user_id, input_file, trip_name, trip_date, "
+                           "vessel_name) "
+                           "SELECT id, %s, %s, %s, %s "
+                           "FROM users WHERE user_email = %s "
+                           "RETURNING id",
+                           (input_info.input_file,
+                            input_info.trip_name,
+                            input_info.trip_date,
+                            input_info.vessel_name,
+                            input_info.user_email))
+        job = job_cursor.fetchone()
+        job_cursor.close()
+        db.commit()
+
+        if not job:
+            raise Exception("Unknown user e-mail address")
+        with self.cond:
+            self.cond.notify()
+        return job[0]
+
+    def update_job(self, job, **values):
+        """
+        Set the columns of a job in a transaction of its own. See
+        update_job.
+        """
+        db = self.pool.getconn()
+        try:
+            updated = update_job(db, job, **values)
+            db.commit()
+        finally:
+            self.pool.putconn(db)
+        return updated
+
+    def heartbeat(self, job, stop):
+        """Update a running job until stop is set."""
+        interval = min(HEARTBEAT_INTERVAL, self.stale_after / 4.0)
+        while not stop.wait(interval):
+            try:
+                if not self.update_job(job):
+                    return
+            except psycopg2.Error:
+                traceback.print_exc()
+
+    def work(self):
+        db = None
+        while True:
+            try:
+                if db is None or db.closed:
+                    db = psycopg2.connect(self.connect_string)
+                job = self.claim(db)
+            except psycopg2.Error:
+                job = None
+                db = None
+
+            if job is None:
+                with self.cond:
+                    self.cond.wait(self.poll_interval)
+                continue
+
+            try:
+                self.run(db, job)
+            except Exception:
+                # The job is restarted when it has become stale.
+                traceback.print_exc()
+                db.close()
+
+    def claim(self, db):
+        """
+        Take the oldest queued job for this worker, or return None if
+        there is none. Jobs abandoned by dead workers are queued again
+        first.
+        """
+        job_cursor = db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        job_cursor.execute("UPDATE upload_job "
+                           "SET state = 'queued' "
+                           "WHERE state = 'running' "
+                           "AND updated < CURRENT_TIMESTAMP - "
+                           "%s * INTERVAL '1 second'",
+                           (self.stale_after, ))
+        job_cursor.execute("UPDATE upload_job "
+                           "SET state = 'running', "
+                           "updated = CURRENT_TIMESTAMP, "
+                           "attempt = attempt + 1 "
+                           "WHERE id = (SELECT id FROM upload_job "
+                           "            WHERE state = 'queued' "
+                           "            ORDER BY id LIMIT 1 "
+                           "            FOR UPDATE) "
+                           "AND state = 'queued' "
+                           "RETURNING id, attempt, user_id, input_file, "
+                           "trip_name, trip_date, vessel_name, trip_id")
+        job = job_cursor.fetchone()
+        job_cursor.close()
+        db.commit()
+        return job
+
+    def run(self, db, job):
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat,
+                                     args=(job, stop),
+                                     name="upload-heartbeat-{}"
+                                     .format(job["id"]))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            self.run_steps(db, job)
+        finally:
+            stop.set()
+
+    def run_steps(self, db, job):
+        context = JobContext(self, job)
+        try:
+            trip_id = job["trip_id"]
+            if trip_id is None:
+                if not self.update_job(job, phase="loading"):
+                    raise JobTakenOver()
+                if not do_file_loading(db, JobInputInfo(job),
+                                       context=context,
+                                       user_id=job["user_id"],
+                                       update_ranges=False):
+                    self.finish(job, "failed", context)
+                    return
+                trip_id = context.trip_id
+
+            if not self.update_job(job, phase="display_ranges",
+                                   trip_id=trip_id):
+                raise JobTakenOver()
+            update_display_ranges(db, trip_id)
+            bump_data_version(db, trip_id)
+            if not context.changes:
+                # The trip was loaded by an earlier run of the job.
+                area = fetch_trip_area(db, trip_id)
+                context.data_changed(trip_id, [area] if area else [])
+            db.commit()
+        except Exception, ex:
+            context.log_err("Loading data failed: {0}".format(ex))
+            db.rollback()
+            self.finish(job, "failed", context)
+            return
+
+        self.finish(job, "done", context)
+        if self.on_data_changed:
+            for (trip_id, areas) in context.changes:
+                self.on_data_changed(trip_id, areas)
+
+    def finish(self, job, state, context):
+        """
+        Record the end of a job. The file is left to the worker that
+        has taken the job over, if one has.
+        """
+        if not self.update_job(job,
+                               state=state,
+                               phase=state,
+                               messages=context.get_error_msgs() or
+                               context.get_log_msgs()):
+            return
+        if not self.keep_files:
+            try:
+                os.remove(job["input_file"])
+            except OSError:
+                pass
+
+def update_job(db, job, **values):
+    """
+    Set the columns of a job, and the time of its last update, unless
+    another worker has taken the job over. Values that are None are
+    skipped. Returns False if the job was taken over.
+    """
+    values = dict((column, value) for (column, value) in values.items()
+                  if value is not None)
+    job_cursor = db.cursor()
+    job_cursor.execute("UPDATE upload_job SET " +
+                       "".join("{} = %s, ".format(column)
+                               for column in values) +
+                       "updated = CURRENT_TIMESTAMP "
+                       "WHERE id = %s "
+                       "AND attempt = %s",
+                       values.values() + [job["id"], job["attempt"]])
+    updated = job_cursor.rowcount == 1
+    job_cursor.close()
+    return updated
+
+def fetch_job(db, job_id, user_email):
+    """
+    Return the status of a job of the user as a dict, or None if
+    there is no such job.
+    """
+    job_cursor = db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    job_cursor.execute("SELECT " +
+                       ", ".join("j." + field for field in job_fields) +
+                       ", to_char(j.created, 'YYYYMMDDHH24MISS') "
+                       "AS created, "
+                       "to_char(j.updated, 'YYYYMMDDHH24MISS') "
+                       "AS updated "
+                       "FROM upload_job j "
+                       "JOIN users u ON j.user_id = u.id "
+                       "WHERE j.id = %s "
+                       "AND u.user_email = %s",
+                       (job_id, user_email))
+    job = job_cursor.fetchone()
+    job_cursor.close()
+    db.commit()
+    return job
+
+class JobInputInfo:
+    """The loader arguments of a job."""
+    def __init__(self, job):
+        self.trip_id = 0
+        self.append = False
+        self.user_email = None
+        self.input_file = job["input_file"]
+        self.trip_name = job["trip_name"]
+        self.trip_date = job["trip_date"] and \
+            job["trip_date"].strftime("%Y-%m-%d")
+        self.vessel_name = job["vessel_name"]
@@ -1,9 +1,8 @@
 
 import threading
 
-from flaska import app
+from flaska import db_pool
 from flaska.depth_data import db_load_user
-from flaska.depth_data import db_conn, db_disconn
 
 class User:
     def __init__(self, user_email, access_token = None):
@@ -51,20 +50,15 @@ class UserSessions:
             if user:
                 return user
 
-            # TODO, dbconn should be outside the lock.
-            # TODO: set up a db conn pool
-
-            result = None
-            db = db_conn(app.config['DB_NAME'],
-                         app.config['DB_USERNAME'],
-                         app.config['DB_PASSWORD'])
-            if not db:
-                return None
-
+        result = None
+        db = db_pool.getconn()
+        try:
             userdata = db_load_user(db, user_email)
-            if userdata:
-                result = User(user_email = userdata["user_email"])
+        finally:
+            db_pool.putconn(db)
+        if userdata:
+            result = User(user_email = userdata["user_email"])
 
-            db_disconn(db)
+        with cls.lock:
             cls.users[user_email] = result
             return result
@@ -30,14 +30,13 @@ d.erroneous as d_bad
 FROM position p
 JOIN depth d
 ON p.id = d.position_id
-WHERE p.latitude > $1 and p.latitude < $2
-AND p.longitude > $3 and p.longitude < $4
-AND d.display_range >= get_display_range($5)
+WHERE point(p.longitude, p.latitude) <@ box(point($1, $2), point($3, $4))
+AND d.display_range >= (SELECT get_display_range($5))
 ORDER BY p.id`
 
 func LoadDepthData(lat0 float64, lat1 float64, lon0 float64, lon1 float64, mpp float64) (*Depths, error) {
 	var depthList []Depth
-	rows, err := DBConn.Pool.Query(depthDataQueryString, lat0, lat1, lon0, lon1, mpp)
+	rows, err := DBConn.Pool.Query(depthDataQueryString, lon0, lat0, lon1, lat1, mpp)
 	if err != nil {
 		return nil, err
 	}
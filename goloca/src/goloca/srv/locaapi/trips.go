@@ -33,45 +33,36 @@ type TripPoints struct {
 	TripPoints *[]TripPoint `json:"trip_points"`
 }
 
+// Measurements are nil if none were recorded for the position.
 type TripPoint struct {
-	PId               int32   `json:"p_id"`
-	TimeStampUTC      string  `json:"t_utc"`
-	Lat               float64 `json:"lat"`
-	Lon               float64 `json:"lon"`
-	PosBad            bool    `json:"pos_bad"`
-	WaterSpeedId      int32   `json:"ws_id"`
-	WaterSpeed        float64 `json:"ws"`
-	GroundSpeedId     int32   `json:"gs_id"`
-	GroundSpeed       float64 `json:"gs"`
-	GroundSpeedCourse float64 `json:"course"`
-	GroundSpeedBad    bool    `json:"gs_bad"`
+	PId          int32    `json:"p_id"`
+	TimeStampUTC string   `json:"t_utc"`
+	Lat          float64  `json:"lat"`
+	Lon          float64  `json:"lon"`
+	Depth        *float64 `json:"depth"`
+	WaterSpeed   *float64 `json:"ws"`
+	GroundSpeed  *float64 `json:"gs"`
+	Course       *float64 `json:"course"`
 }
 
-func (t *TripPoint) fields() (*int32, *string, *float64, *float64, *bool, *int32, *float64, *int32, *float64, *float64, *bool) {
-	return &t.PId, &t.TimeStampUTC, &t.Lat, &t.Lon, &t.PosBad,
-		&t.WaterSpeedId, &t.WaterSpeed,
-		&t.GroundSpeedId, &t.GroundSpeed, &t.GroundSpeedCourse, &t.GroundSpeedBad
+func (t *TripPoint) fields() (*int32, *string, *float64, *float64, **float64, **float64, **float64, **float64) {
+	return &t.PId, &t.TimeStampUTC, &t.Lat, &t.Lon,
+		&t.Depth, &t.WaterSpeed, &t.GroundSpeed, &t.Course
 }
 
-var tripPointStmt = `SELECT p.id AS p_id,
+var tripPointStmt = `SELECT p.position_id AS p_id,
 to_char(p.pos_time_utc, 'YYYYMMDDHH24MISS') AS t_utc,
 p.latitude AS lat,
 p.longitude AS lon,
-p.erroneous AS pos_bad,
-wsp.id AS ws_id,
-wsp.speed AS ws,
-gsc.id AS gs_id,
-gsc.speed AS gs,
-gsc.course AS course,
-gsc.erroneous AS gs_bad
-FROM position p
-JOIN water_speed wsp ON p.id = wsp.position_id
-JOIN ground_speed_course gsc ON p.id = gsc.position_id
+p.depth AS depth,
+p.water_speed AS ws,
+p.ground_speed AS gs,
+p.course AS course
+FROM position_sample p
 WHERE
 p.trip_id = $1
-AND p.display_range >= get_display_range($2)
-AND p.latitude > $3 AND p.latitude < $4
-AND p.longitude > $5 AND p.longitude < $6`
+AND p.display_range >= (SELECT get_display_range($2))
+AND point(p.longitude, p.latitude) <@ box(point($3, $4), point($5, $6))`
 
 func LoadTrips() (*Trips, error) {
 	var tripList []Trip
@@ -112,7 +103,7 @@ func LoadTripPoints(tripId string, lat0 float64, lat1 float64, lon0 float64, lon
 		return nil, err
 	}
 	var tripPoints []TripPoint
-	rows, err := DBConn.Pool.Query(tripPointStmt, tripId, mpp, lat0, lat1, lon0, lon1)
+	rows, err := DBConn.Pool.Query(tripPointStmt, tripId, mpp, lon0, lat0, lon1, lat1)
 	if err != nil {
 		return nil, err
 	}
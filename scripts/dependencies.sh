@@ -2,5 +2,5 @@
 
 pip install werkzeug flask flask-login flask_oauth flask-wtf
 pip install psycopg2
-pip install python-magic
-brew install libmagic
+# Optional: faster conversion of NMEA data in the loader.
+pip install numpy